@@ -59,7 +59,7 @@ class LayerItemAdmin(CompareVersionAdmin):
 class LayerBranchAdmin(CompareVersionAdmin):
     list_filter = ['layer__name']
     search_fields = ['layer__name', 'layer__vcs_url']
-    readonly_fields = ('vcs_last_fetch', 'vcs_last_rev', 'vcs_last_commit')
+    readonly_fields = ('vcs_last_fetch', 'vcs_last_rev', 'vcs_last_commit', 'layerconf_hash', 'layerconf_depends', 'layerconf_recommends')
     inlines = [
         LayerDependencyInline,
         LayerMaintainerInline,
@@ -110,6 +110,10 @@ class StaticBuildDepAdmin(admin.ModelAdmin):
     search_fields = ['name']
     filter_horizontal = ('recipes',)
 
+class InheritedClassAdmin(admin.ModelAdmin):
+    search_fields = ['name']
+    filter_horizontal = ('recipes',)
+
 class DynamicBuildDepAdmin(admin.ModelAdmin):
     search_fields = ['name']
     filter_horizontal = ('package_configs',)
@@ -131,6 +135,18 @@ class ClassicRecipeAdmin(admin.ModelAdmin):
     def has_delete_permission(self, request, obj=None):
         return False
 
+class RecipeParseProfileAdmin(admin.ModelAdmin):
+    search_fields = ['recipe__filename', 'recipe__pn']
+    list_filter = ['recipe__layerbranch__layer__name', 'recipe__layerbranch__branch__name', 'parsed']
+    list_display = ['recipe', 'layerbranch', 'parsed', 'parse_time', 'write_time', 'peak_memory']
+    list_select_related = ['recipe__layerbranch__layer', 'recipe__layerbranch__branch']
+    ordering = ['-parse_time']
+    readonly_fields = ['recipe', 'parsed', 'parse_time', 'write_time', 'peak_memory']
+    def layerbranch(self, obj):
+        return obj.recipe.layerbranch
+    def has_add_permission(self, request, obj=None):
+        return False
+
 class MachineAdmin(admin.ModelAdmin):
     search_fields = ['name']
     list_filter = ['layerbranch__layer__name', 'layerbranch__branch__name']
@@ -192,10 +208,13 @@ admin.site.register(Update, UpdateAdmin)
 admin.site.register(LayerUpdate, LayerUpdateAdmin)
 admin.site.register(PackageConfig, PackageConfigAdmin)
 admin.site.register(StaticBuildDep, StaticBuildDepAdmin)
+admin.site.register(InheritedClass, InheritedClassAdmin)
 admin.site.register(DynamicBuildDep, DynamicBuildDepAdmin)
 admin.site.register(Source, SourceAdmin)
 admin.site.register(Recipe, RecipeAdmin)
 admin.site.register(RecipeFileDependency)
+admin.site.register(RecipeExternalFileDependency)
+admin.site.register(RecipeParseProfile, RecipeParseProfileAdmin)
 admin.site.register(Machine, MachineAdmin)
 admin.site.register(Distro, DistroAdmin)
 admin.site.register(BBAppend, BBAppendAdmin)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2018-09-25 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0025_update_retcode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='layerbranch',
+            name='layerconf_depends',
+            field=models.TextField(blank=True, verbose_name='LAYERDEPENDS value'),
+        ),
+        migrations.AddField(
+            model_name='layerbranch',
+            name='layerconf_hash',
+            field=models.CharField(blank=True, help_text='Git object hash of conf/layer.conf when LAYERDEPENDS and LAYERRECOMMENDS were last read', max_length=40, verbose_name='layer.conf hash'),
+        ),
+        migrations.AddField(
+            model_name='layerbranch',
+            name='layerconf_recommends',
+            field=models.TextField(blank=True, verbose_name='LAYERRECOMMENDS value'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2018-09-26 14:03
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+# NOTE: the indexed expressions must match those used by
+# simplesearch.get_fulltext_query() or the index won't be used
+
+def create_fulltext_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'mysql':
+        schema_editor.execute('CREATE FULLTEXT INDEX layerindex_recipe_fulltext ON layerindex_recipe (summary, description)')
+    elif vendor == 'postgresql':
+        schema_editor.execute("CREATE INDEX layerindex_recipe_fulltext ON layerindex_recipe USING GIN (to_tsvector('simple', \"summary\" || ' ' || \"description\"))")
+
+def drop_fulltext_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'mysql':
+        schema_editor.execute('DROP INDEX layerindex_recipe_fulltext ON layerindex_recipe')
+    elif vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX layerindex_recipe_fulltext')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0026_layerbranch_layerconf'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_index, reverse_code=drop_fulltext_index),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2018-09-27 11:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_preferred_count(apps, schema_editor):
+    # Equivalent to utils.update_recipe_preferred_counts(), but using the
+    # historical models
+    Branch = apps.get_model('layerindex', 'Branch')
+    Recipe = apps.get_model('layerindex', 'Recipe')
+    for branch in Branch.objects.all():
+        recipes_by_pn = {}
+        for values in Recipe.objects.filter(layerbranch__branch=branch).values_list('id', 'pn', 'layerbranch_id', 'layerbranch__layer__index_preference', 'layerbranch__layer__layer_type'):
+            recipes_by_pn.setdefault(values[1], []).append(values)
+        counts = {}
+        for pn_recipes in recipes_by_pn.values():
+            for recipe_id, _, layerbranch_id, preference, _ in pn_recipes:
+                count = 0
+                for _, _, layerbranch_id2, preference2, layer_type2 in pn_recipes:
+                    if layerbranch_id2 != layerbranch_id and layer_type2 in ('S', 'A') and preference2 > preference:
+                        count += 1
+                if count:
+                    counts.setdefault(count, []).append(recipe_id)
+        for count, recipe_ids in counts.items():
+            for i in range(0, len(recipe_ids), 500):
+                Recipe.objects.filter(id__in=recipe_ids[i:i+500]).update(preferred_count=count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0027_recipe_fulltext_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='preferred_count',
+            field=models.IntegerField(db_index=True, default=0, help_text='Number of recipes with the same name in software / base layers with a higher index preference on the same branch'),
+        ),
+        migrations.RunPython(populate_preferred_count, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2018-10-02 10:15
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0028_recipe_preferred_count'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='bbappend',
+            index_together=set([('layerbranch', 'filename')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='recipe',
+            index_together=set([('layerbranch', 'pn'), ('layerbranch', 'filepath', 'filename')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='recipefiledependency',
+            index_together=set([('layerbranch', 'path')]),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2018-10-04 14:32
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_inherited_classes(apps, schema_editor):
+    Recipe = apps.get_model('layerindex', 'Recipe')
+    InheritedClass = apps.get_model('layerindex', 'InheritedClass')
+    Through = InheritedClass.recipes.through
+    class_ids = {}
+    links = []
+    for recipe_id, inherits in Recipe.objects.exclude(inherits='').values_list('id', 'inherits').iterator():
+        for name in set(inherits.split()):
+            class_id = class_ids.get(name, None)
+            if class_id is None:
+                class_id = InheritedClass.objects.create(name=name).id
+                class_ids[name] = class_id
+            links.append(Through(recipe_id=recipe_id, inheritedclass_id=class_id))
+        if len(links) >= 1000:
+            Through.objects.bulk_create(links)
+            links = []
+    Through.objects.bulk_create(links)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0029_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InheritedClass',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(db_index=True, max_length=100)),
+                ('recipes', models.ManyToManyField(to='layerindex.Recipe')),
+            ],
+            options={
+                'verbose_name_plural': 'Inherited classes',
+            },
+        ),
+        migrations.RunPython(populate_inherited_classes, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2018-10-08 09:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0030_inheritedclass'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='layerbranch',
+            name='dependency_closure',
+            field=models.TextField(blank=True, editable=False, help_text='Cached IDs of the layer branches this one depends upon recursively (see get_recursive_dependencies())', verbose_name='Recursive dependencies'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2018-10-11 16:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0031_layerbranch_dependency_closure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipeExternalFileDependency',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(db_index=True, help_text='Path relative to LAYER_FETCH_DIR', max_length=255)),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='layerindex.Recipe')),
+            ],
+            options={
+                'verbose_name_plural': 'Recipe external file dependencies',
+            },
+        ),
+    ]
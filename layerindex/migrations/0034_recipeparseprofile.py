@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2018-10-12 15:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0033_layerupdate_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipeParseProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('parsed', models.DateTimeField(db_index=True)),
+                ('parse_time', models.FloatField(help_text='Time taken to parse the recipe (in seconds)')),
+                ('write_time', models.FloatField(help_text='Time taken to write the data for the recipe to the database (in seconds)')),
+                ('peak_memory', models.IntegerField(help_text='Peak memory allocated by Python code while parsing the recipe (in bytes)')),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='layerindex.Recipe')),
+            ],
+        ),
+    ]
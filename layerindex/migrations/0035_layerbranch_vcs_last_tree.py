@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2018-10-15 09:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0034_recipeparseprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='layerbranch',
+            name='vcs_last_tree',
+            field=models.CharField(blank=True, help_text='Git object hash of the tree for the layer (subdirectory) as of the last revision fetched, used to quickly check whether anything has changed', max_length=80, verbose_name='Last tree fetched'),
+        ),
+    ]
@@ -9,12 +9,14 @@ from datetime import datetime
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.core.validators import URLValidator
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from collections import namedtuple
 import os.path
 import re
 import posixpath
+import json
+import uuid
 
 from . import utils
 
@@ -150,6 +152,20 @@ class LayerItem(models.Model):
     def change_status(self, newstatus, username):
         self.status = newstatus
 
+    def save(self, *args, **kwargs):
+        preference_changed = False
+        if self.pk:
+            old = LayerItem.objects.filter(pk=self.pk).values_list('index_preference', 'layer_type').first()
+            if old and old != (self.index_preference, self.layer_type):
+                preference_changed = True
+        super(LayerItem, self).save(*args, **kwargs)
+        if preference_changed:
+            # Recipes with the same names in other layers may now be more
+            # or less preferred than this layer's
+            for layerbranch in self.layerbranch_set.all():
+                pns = Recipe.objects.filter(layerbranch=layerbranch).values('pn')
+                utils.update_recipe_preferred_counts(layerbranch.branch, pns)
+
     def get_layerbranch(self, branchname):
         if branchname:
             res = list(self.layerbranch_set.filter(branch__name=branchname)[:1])
@@ -234,9 +250,14 @@ class LayerBranch(models.Model):
     vcs_subdir = models.CharField('Repository subdirectory', max_length=40, blank=True, help_text='Subdirectory within the repository where the layer is located, if not in the root (usually only used if the repository contains more than one layer)')
     vcs_last_fetch = models.DateTimeField('Last successful fetch', blank=True, null=True)
     vcs_last_rev = models.CharField('Last revision fetched', max_length=80, blank=True)
+    vcs_last_tree = models.CharField('Last tree fetched', max_length=80, blank=True, help_text='Git object hash of the tree for the layer (subdirectory) as of the last revision fetched, used to quickly check whether anything has changed')
     vcs_last_commit = models.DateTimeField('Last commit date', blank=True, null=True)
     actual_branch = models.CharField('Actual Branch', max_length=80, blank=True, help_text='Name of the actual branch in the repository matching the core branch')
     yp_compatible_version = models.ForeignKey(YPCompatibleVersion, verbose_name='Yocto Project Compatible version', null=True, blank=True, on_delete=models.SET_NULL, help_text='Which version of the Yocto Project Compatible program has this layer been approved for for?')
+    layerconf_hash = models.CharField('layer.conf hash', max_length=40, blank=True, help_text='Git object hash of conf/layer.conf when LAYERDEPENDS and LAYERRECOMMENDS were last read')
+    layerconf_depends = models.TextField('LAYERDEPENDS value', blank=True)
+    layerconf_recommends = models.TextField('LAYERRECOMMENDS value', blank=True)
+    dependency_closure = models.TextField('Recursive dependencies', blank=True, editable=False, help_text='Cached IDs of the layer branches this one depends upon recursively (see get_recursive_dependencies())')
 
     updated = models.DateTimeField(auto_now=True)
 
@@ -246,6 +267,16 @@ class LayerBranch(models.Model):
             ("set_yp_compatibility", "Can set YP compatibility"),
         )
 
+    @classmethod
+    def fields_except_closure(cls):
+        """
+        Get the fields to pass as update_fields when saving a layer branch
+        that was loaded before its dependencies may have changed, so that
+        a stale copy of dependency_closure (which is written separately,
+        and cleared whenever dependencies change) isn't written back
+        """
+        return [f.name for f in cls._meta.concrete_fields if not f.primary_key and f.name != 'dependency_closure']
+
     def sorted_recipes(self):
         return self.recipe_set.order_by('pn', '-pv')
 
@@ -349,23 +380,70 @@ class LayerBranch(models.Model):
     def get_recommends(self):
         return self.dependencies_set.filter(required=False)
 
+    @staticmethod
+    def get_dependency_closures(branch_id):
+        """
+        Resolve the recursive dependencies of all layer branches on the
+        specified branch with two queries. Returns a dict mapping layer
+        branch ID to a dict with 'required' (required dependencies only) and
+        'all' (including recommends) lists of layer branch IDs, in the order
+        they are encountered walking the dependencies depth-first.
+        """
+        layerbranch_ids = dict(LayerBranch.objects.filter(branch_id=branch_id).values_list('layer_id', 'id'))
+        deps = {}
+        for layerbranch_id, dependency_id, required in LayerDependency.objects.filter(layerbranch__branch_id=branch_id).order_by('id').values_list('layerbranch_id', 'dependency_id', 'required'):
+            deplayerbranch_id = layerbranch_ids.get(dependency_id, None)
+            if deplayerbranch_id:
+                deps.setdefault(layerbranch_id, []).append((deplayerbranch_id, required))
+
+        def walk(layerbranch_id, required):
+            deplist = [layerbranch_id]
+            def recurse_deps(layerbranch_id):
+                for deplayerbranch_id, deprequired in deps.get(layerbranch_id, []):
+                    if (deprequired or not required) and deplayerbranch_id not in deplist:
+                        deplist.append(deplayerbranch_id)
+                        recurse_deps(deplayerbranch_id)
+            recurse_deps(layerbranch_id)
+            return deplist[1:]
+
+        closures = {}
+        for layerbranch_id in layerbranch_ids.values():
+            closures[layerbranch_id] = {'required': walk(layerbranch_id, True),
+                                        'all': walk(layerbranch_id, False)}
+        return closures
+
+    def get_dependency_closure(self, required=True):
+        """
+        Get the IDs of the layer branches this one depends upon recursively.
+        The result is cached in the database until any layer dependencies or
+        layer branches on the same branch change.
+        """
+        if self.dependency_closure and not self.dependency_closure.startswith('?'):
+            closure = json.loads(self.dependency_closure)
+        else:
+            # Put a unique marker in place before reading the dependencies,
+            # and only store the result if it's still there afterwards - if
+            # the dependencies were changed in the meantime then
+            # clear_dependency_closures() will have removed the marker and
+            # what we read may already be stale
+            marker = '?%s' % uuid.uuid4().hex
+            LayerBranch.objects.filter(id=self.id).exclude(dependency_closure__startswith='{').update(dependency_closure=marker)
+            closure = LayerBranch.get_dependency_closures(self.branch_id)[self.id]
+            if LayerBranch.objects.filter(id=self.id, dependency_closure=marker).update(dependency_closure=json.dumps(closure)):
+                self.dependency_closure = json.dumps(closure)
+        if required:
+            return closure['required']
+        else:
+            return closure['all']
+
     def get_recursive_dependencies(self, required=True, include_self=False):
-        deplist = []
-        def recurse_deps(layerbranch):
-            deplist.append(layerbranch)
-            if required:
-                dep_set = layerbranch.dependencies_set.filter(required=True)
-            else:
-                dep_set = layerbranch.dependencies_set.all()
-            for dep in dep_set:
-                deplayerbranch = dep.dependency.get_layerbranch(layerbranch.branch.name)
-                if deplayerbranch and deplayerbranch not in deplist:
-                    recurse_deps(deplayerbranch)
-        recurse_deps(self)
+        depids = self.get_dependency_closure(required)
+        layerbranches = LayerBranch.objects.select_related('layer', 'branch').in_bulk(depids)
+        deplist = [layerbranches[depid] for depid in depids if depid in layerbranches]
         if include_self:
-            return deplist
+            return [self] + deplist
         else:
-            return deplist[1:]
+            return deplist
 
 class LayerMaintainer(models.Model):
     MAINTAINER_STATUS_CHOICES = (
@@ -397,6 +475,42 @@ class LayerDependency(models.Model):
         return "%s depends on %s" % (self.layerbranch.layer.name, self.dependency.name)
 
 
+def clear_dependency_closures(branch_id):
+    # NOTE: this also clears any markers left by get_dependency_closure()
+    # for calculations in progress, so that they don't store their results
+    LayerBranch.objects.filter(branch_id=branch_id).exclude(dependency_closure='').update(dependency_closure='')
+
+@receiver(post_save, sender=LayerDependency)
+@receiver(post_delete, sender=LayerDependency)
+def layerdependency_changed(sender, instance, **kwargs):
+    # Use the ID rather than instance.layerbranch, since the layer branch
+    # may be in the process of being deleted
+    for branch_id in LayerBranch.objects.filter(id=instance.layerbranch_id).values_list('branch_id', flat=True):
+        clear_dependency_closures(branch_id)
+
+@receiver(post_save, sender=LayerBranch)
+def layerbranch_saved(sender, instance, created, **kwargs):
+    # A new layer branch can satisfy existing dependencies on its layer
+    if created:
+        clear_dependency_closures(instance.branch_id)
+
+@receiver(pre_delete, sender=LayerBranch)
+def layerbranch_deleting(sender, instance, **kwargs):
+    # The recipes will be gone by the time post_delete is sent, so note
+    # their names now (this also covers deleting the LayerItem, since that
+    # cascades to its LayerBranches)
+    instance._deleted_recipe_pns = list(Recipe.objects.filter(layerbranch=instance).values_list('pn', flat=True).distinct())
+
+@receiver(post_delete, sender=LayerBranch)
+def layerbranch_deleted(sender, instance, **kwargs):
+    clear_dependency_closures(instance.branch_id)
+    # Recipes with the same names in other layers may no longer be shadowed
+    pns = getattr(instance, '_deleted_recipe_pns', None)
+    if pns:
+        for i in range(0, len(pns), 500):
+            utils.update_recipe_preferred_counts(instance.branch, pns[i:i+500])
+
+
 class LayerNote(models.Model):
     layer = models.ForeignKey(LayerItem)
     text = models.TextField()
@@ -417,6 +531,18 @@ class LayerUpdate(models.Model):
     vcs_after_rev = models.CharField('Revision after', max_length=80, blank=True)
     log = models.TextField(blank=True)
     retcode = models.IntegerField(default=0)
+    # JSON object: number of recipes parsed and time taken by each phase
+    stats = models.TextField(blank=True, editable=False)
+
+    def get_stats(self):
+        if self.stats:
+            return json.loads(self.stats)
+        return {}
+
+    def get_timings(self):
+        """Get a list of (phase, seconds) tuples in the order the phases happen"""
+        timings = self.get_stats().get('timings', {})
+        return [(phase, timings[phase]) for phase in utils.UPDATE_PHASES if phase in timings]
 
     def layerbranch_exists(self):
         """Helper function for linking"""
@@ -469,6 +595,14 @@ class Recipe(models.Model):
     inherits = models.CharField(max_length=255, blank=True)
     updated = models.DateTimeField(auto_now=True)
     blacklisted = models.CharField(max_length=255, blank=True)
+    preferred_count = models.IntegerField(default=0, db_index=True, help_text='Number of recipes with the same name in software / base layers with a higher index preference on the same branch')
+
+    class Meta:
+        # Used by update_layer.py and the RRS scripts to look up recipes
+        index_together = [
+            ('layerbranch', 'filepath', 'filename'),
+            ('layerbranch', 'pn'),
+        ]
 
     def vcs_web_url(self):
         url = self.layerbranch.file_url(os.path.join(self.filepath, self.filename))
@@ -589,6 +723,19 @@ class StaticBuildDep(models.Model):
     def __str__(self):
         return self.name
 
+class InheritedClass(models.Model):
+    # Classes are matched by name rather than linked to BBClass records,
+    # since a class may be provided by any of the layers a recipe is parsed
+    # with (or by bitbake itself)
+    recipes = models.ManyToManyField(Recipe)
+    name = models.CharField(max_length=100, db_index=True)
+
+    class Meta:
+        verbose_name_plural = "Inherited classes"
+
+    def __str__(self):
+        return self.name
+
 class DynamicBuildDep(models.Model):
     package_configs = models.ManyToManyField(PackageConfig)
     recipes = models.ManyToManyField(Recipe)
@@ -604,6 +751,9 @@ class RecipeFileDependency(models.Model):
 
     class Meta:
         verbose_name_plural = "Recipe file dependencies"
+        index_together = [
+            ('layerbranch', 'path'),
+        ]
 
     def layer_path(self):
         return os.path.relpath(self.path, self.layerbranch.vcs_subdir)
@@ -616,6 +766,31 @@ class RecipeFileDependency(models.Model):
         return '%s' % self.path
 
 
+class RecipeExternalFileDependency(models.Model):
+    # Used to find recipes that need to be reparsed when a file they use in
+    # another layer (e.g. a class or include file) changes
+    recipe = models.ForeignKey(Recipe)
+    path = models.CharField(max_length=255, db_index=True, help_text='Path relative to LAYER_FETCH_DIR')
+
+    class Meta:
+        verbose_name_plural = "Recipe external file dependencies"
+
+    def __str__(self):
+        return '%s: %s' % (self.recipe.pn, self.path)
+
+
+class RecipeParseProfile(models.Model):
+    # Recorded by update_layer.py when run with --profile
+    recipe = models.ForeignKey(Recipe)
+    parsed = models.DateTimeField(db_index=True)
+    parse_time = models.FloatField(help_text='Time taken to parse the recipe (in seconds)')
+    write_time = models.FloatField(help_text='Time taken to write the data for the recipe to the database (in seconds)')
+    peak_memory = models.IntegerField(help_text='Peak memory allocated by Python code while parsing the recipe (in bytes)')
+
+    def __str__(self):
+        return '%s: %s: %.2fs' % (self.recipe.layerbranch, self.recipe.filename, self.parse_time)
+
+
 class ClassicRecipe(Recipe):
     COVER_STATUS_CHOICES = [
         ('U', 'Unknown'),
@@ -720,6 +895,9 @@ class BBAppend(models.Model):
 
     class Meta:
         verbose_name = "Append"
+        index_together = [
+            ('layerbranch', 'filename'),
+        ]
 
     def vcs_web_url(self):
         url = self.layerbranch.file_url(os.path.join(self.filepath, self.filename))
@@ -11,7 +11,6 @@ import os.path
 import utils
 import tempfile
 import re
-import fnmatch
 
 class RecipeParseError(Exception):
     def __init__(self, msg):
@@ -22,24 +21,40 @@ class RecipeParseError(Exception):
 
 
 
+def get_bitbake_ref(branch):
+    """Get the revision of BitBake to check out for the specified branch"""
+    if re.match('[0-9a-f]{40}', branch.bitbake_branch):
+        # SHA1 hash
+        return branch.bitbake_branch
+    else:
+        # Branch name
+        return 'origin/%s' % branch.bitbake_branch
+
+def checkout_core_layers(settings, branch, bitbakepath, logger=None):
+    """
+    Check out BitBake and the core layer as needed to parse layers on
+    the specified branch
+    """
+    utils.checkout_repo(bitbakepath, get_bitbake_ref(branch), logger=logger)
+    core_layer = utils.get_layer(settings.CORE_LAYER_NAME)
+    if core_layer:
+        core_layerbranch = core_layer.get_layerbranch(branch.name)
+        core_branchname = branch.name
+        if core_layerbranch and core_layerbranch.actual_branch:
+            core_branchname = core_layerbranch.actual_branch
+        utils.checkout_layer_repo(settings, core_layer.get_fetch_dir(), branch.name, "origin/%s" % core_branchname, logger=logger)
+
 def init_parser(settings, branch, bitbakepath, enable_tracking=False, nocheckout=False, classic=False, logger=None):
     if not (nocheckout or classic):
         # Check out the branch of BitBake appropriate for this branch and clean out any stale files (e.g. *.pyc)
-        if re.match('[0-9a-f]{40}', branch.bitbake_branch):
-            # SHA1 hash
-            bitbake_ref = branch.bitbake_branch
-        else:
-            # Branch name
-            bitbake_ref = 'origin/%s' % branch.bitbake_branch
-        utils.checkout_repo(bitbakepath, bitbake_ref, logger=logger)
+        utils.checkout_repo(bitbakepath, get_bitbake_ref(branch), logger=logger)
 
     # Skip sanity checks
     os.environ['BB_ENV_EXTRAWHITE'] = 'DISABLE_SANITY_CHECKS'
     os.environ['DISABLE_SANITY_CHECKS'] = '1'
 
-    fetchdir = settings.LAYER_FETCH_DIR
-
     if not classic:
+        fetchdir = utils.get_layer_checkout_dir(settings, branch.name)
         # Ensure we have OE-Core set up to get some base configuration
         core_layer = utils.get_layer(settings.CORE_LAYER_NAME)
         if not core_layer:
@@ -56,7 +71,7 @@ def init_parser(settings, branch, bitbakepath, enable_tracking=False, nocheckout
         core_repodir = os.path.join(fetchdir, core_urldir)
         core_layerdir = os.path.join(core_repodir, core_subdir)
         if not nocheckout:
-            utils.checkout_repo(core_repodir, "origin/%s" % core_branchname, logger=logger)
+            utils.checkout_layer_repo(settings, core_urldir, branch.name, "origin/%s" % core_branchname, logger=logger)
         if not os.path.exists(os.path.join(core_layerdir, 'conf/bitbake.conf')):
             raise RecipeParseError("conf/bitbake.conf not found in core layer %s - is subdirectory set correctly?" % core_layer.name)
         # The directory above where this script exists should contain our conf/layer.conf,
@@ -100,12 +115,17 @@ def setup_layer(config_data, fetchdir, layerdir, layer, layerbranch, logger):
     # for include/require/inherit to work outside of the current directory
     # or across layers, but also because custom variable values might be
     # set in layer.conf.
+    from layerindex.models import LayerBranch
     config_data_copy = bb.data.createCopy(config_data)
     utils.parse_layer_conf(layerdir, config_data_copy)
-    for dep in layerbranch.dependencies_set.all():
+    deps = list(layerbranch.dependencies_set.select_related('dependency'))
+    deplayerbranches = {}
+    for deplayerbranch in LayerBranch.objects.filter(branch_id=layerbranch.branch_id, layer__in=[dep.dependency for dep in deps]):
+        deplayerbranches[deplayerbranch.layer_id] = deplayerbranch
+    for dep in deps:
         depurldir = dep.dependency.get_fetch_dir()
         deprepodir = os.path.join(fetchdir, depurldir)
-        deplayerbranch = dep.dependency.get_layerbranch(layerbranch.branch.name)
+        deplayerbranch = deplayerbranches.get(dep.dependency_id, None)
         if not deplayerbranch:
             if dep.required:
                 raise RecipeParseError('Dependency %s of layer %s does not have branch record for branch %s' % (dep.dependency.name, layer.name, layerbranch.branch.name))
@@ -117,37 +137,34 @@ def setup_layer(config_data, fetchdir, layerdir, layer, layerbranch, logger):
     config_data_copy.delVar('LAYERDIR')
     return config_data_copy
 
-machine_conf_re = re.compile(r'conf/machine/([^/.]*).conf$')
-distro_conf_re = re.compile(r'conf/distro/([^/.]*).conf$')
-bbclass_re = re.compile(r'classes/([^/.]*).bbclass$')
+# Matches the files within a layer that we're interested in (by path
+# relative to the layer directory), with the group name giving the type
+layer_file_re = re.compile(r'(?:.*/)?(?P<recipe>[^/]*\.bb)$|'
+                           r'(?:.*/)?(?P<bbappend>[^/]*\.bbappend)$|'
+                           r'conf/machine/(?P<machine>[^/.]*)\.conf$|'
+                           r'classes/(?P<bbclass>[^/.]*)\.bbclass$|'
+                           r'conf/distro/(?P<distro>[^/.]*)\.conf$')
+
+def classify_layer_file(subpath):
+    """
+    Get the type of a file from its path relative to the layer directory.
+    Returns a (typename, name) tuple where name is the file name for
+    recipes and bbappends, or the machine / distro / class name.
+    """
+    res = layer_file_re.match(subpath)
+    if res:
+        return (res.lastgroup, res.group(res.lastgroup))
+    return (None, None)
+
 def detect_file_type(path, subdir_start):
-    typename = None
-    if fnmatch.fnmatch(path, "*.bb"):
-        typename = 'recipe'
-    elif fnmatch.fnmatch(path, "*.bbappend"):
-        typename = 'bbappend'
-    else:
-        # Check if it's a machine conf file
-        subpath = path[len(subdir_start):]
-        res = machine_conf_re.match(subpath)
-        if res:
-            typename = 'machine'
-            return (typename, None, res.group(1))
-        res = bbclass_re.match(subpath)
-        if res:
-            typename = 'bbclass'
-            return (typename, None, res.group(1))
-        res = distro_conf_re.match(subpath)
-        if res:
-            typename = 'distro'
-            return (typename, None, res.group(1))
+    (typename, name) = classify_layer_file(path[len(subdir_start):])
 
     if typename == 'recipe' or typename == 'bbappend':
         if subdir_start:
             filepath = os.path.relpath(os.path.dirname(path), subdir_start)
         else:
             filepath = os.path.dirname(path)
-        return (typename, filepath, os.path.basename(path))
+        return (typename, filepath, name)
 
-    return (None, None, None)
+    return (typename, None, name)
 
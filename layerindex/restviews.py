@@ -1,5 +1,7 @@
 from layerindex.models import Branch, LayerItem, LayerMaintainer, YPCompatibleVersion, LayerNote, LayerBranch, LayerDependency, Recipe, Machine, Distro, BBClass
 from rest_framework import viewsets, serializers
+from rest_framework.decorators import action
+from rest_framework.response import Response
 from layerindex.querysethelper import params_to_queryset, get_search_tuple
 
 class DynamicFieldsModelSerializer(serializers.ModelSerializer):
@@ -51,7 +53,7 @@ class LayerItemViewSet(ParametricSearchableModelViewSet):
 class LayerBranchSerializer(serializers.ModelSerializer):
     class Meta:
         model = LayerBranch
-        fields = '__all__'
+        exclude = ('dependency_closure',)
 
 class LayerBranchViewSet(ParametricSearchableModelViewSet):
     queryset = LayerBranch.objects.filter(layer__status__in=['P', 'X'])
@@ -136,7 +138,7 @@ class LayerSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = LayerBranch
-        fields = '__all__'
+        exclude = ('dependency_closure',)
 
     def get_maintainers(self, layerbranch):
         qs = layerbranch.layermaintainer_set.filter(status='A')
@@ -150,3 +152,15 @@ class LayerViewSet(ParametricSearchableModelViewSet):
     queryset = LayerBranch.objects.filter(layer__status__in=['P', 'X'])
     serializer_class = LayerSerializer
 
+    @action(detail=True)
+    def dependencies(self, request, pk=None):
+        """
+        All of the layers that this layer depends upon, directly or
+        indirectly (add ?recommends=1 to include recommended layers)
+        """
+        layerbranch = self.get_object()
+        required = request.query_params.get('recommends', '') not in ['1', 'true', 'True']
+        deps = layerbranch.get_recursive_dependencies(required=required)
+        serializer = self.get_serializer(deps, many=True)
+        return Response(serializer.data)
+
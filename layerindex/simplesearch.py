@@ -37,3 +37,101 @@ def get_query(query_string, search_fields):
         else:
             query = query & or_query
     return query
+
+# Words shorter than this are ignored by MySQL full-text indexes by default
+# (innodb_ft_min_token_size), so we fall back to substring matching for them
+FULLTEXT_MIN_WORD_LENGTH = 3
+
+def _split_fulltext_terms(query_string):
+    fulltext_terms = []
+    other_terms = []
+    for term in normalize_query(query_string):
+        words = re.findall(r'\w+', term, re.UNICODE)
+        if len(words) == 1 and len(words[0]) >= FULLTEXT_MIN_WORD_LENGTH:
+            fulltext_terms.append(words[0])
+        else:
+            other_terms.append(term)
+    return fulltext_terms, other_terms
+
+def _get_fulltext_sql(fulltext_terms, model, search_fields, qualify=False):
+    ''' Returns (where, rank, param) SQL fragments for matching and scoring
+        the given terms against the full-text index, or None if the database
+        doesn't have one. Set qualify to prefix the columns with the table
+        name (needed if the query may join other tables with the same
+        column names).
+
+    '''
+    from django.db import connection
+
+    if connection.vendor not in ['mysql', 'postgresql']:
+        return None
+    qn = connection.ops.quote_name
+    columns = [qn(model._meta.get_field(field_name).column) for field_name in search_fields]
+    if qualify:
+        columns = ['%s.%s' % (qn(model._meta.db_table), column) for column in columns]
+    if connection.vendor == 'mysql':
+        where = 'MATCH (%s) AGAINST (%%s IN BOOLEAN MODE)' % ', '.join(columns)
+        rank = where
+        param = ' '.join(['+%s*' % term for term in fulltext_terms])
+    else:
+        vector = "to_tsvector('simple', %s)" % " || ' ' || ".join(columns)
+        where = "%s @@ to_tsquery('simple', %%s)" % vector
+        rank = "ts_rank(%s, to_tsquery('simple', %%s))" % vector
+        param = ' & '.join(['%s:*' % term for term in fulltext_terms])
+    return where, rank, param
+
+def get_fulltext_query(query_string, model, search_fields):
+    ''' Returns a query (Q object) that matches records containing all of the
+        keywords within the given fields, using the full-text index on those
+        fields where the database supports it, otherwise falling back to
+        get_query(). The index must have been created by a migration for
+        exactly the same fields - see 0027_recipe_fulltext_index for the
+        recipe index.
+
+        NOTE: the full-text index matches whole words and word prefixes
+        rather than arbitrary substrings, so on MySQL and PostgreSQL "ssl"
+        matches "SSL library" or "sslh" but not "OpenSSL", whereas on other
+        databases (and for keywords too short to be in the index) any
+        substring matches.
+
+    '''
+    fulltext_terms, other_terms = _split_fulltext_terms(query_string)
+
+    query = None
+    sql = None
+    if fulltext_terms:
+        sql = _get_fulltext_sql(fulltext_terms, model, search_fields)
+    if sql:
+        where, _, param = sql
+        matches = model.objects.extra(where=[where], params=[param]).values('pk')
+        query = Q(pk__in=matches)
+    else:
+        other_terms = fulltext_terms + other_terms
+
+    if other_terms:
+        other_query = get_query(' '.join(['"%s"' % term for term in other_terms]), search_fields)
+        if query is None:
+            query = other_query
+        else:
+            query = query & other_query
+    return query
+
+def get_fulltext_rank(query_string, model, search_fields):
+    ''' Returns an expression giving the relevance of each record to the
+        keywords according to the full-text index (the MATCH score on MySQL,
+        ts_rank on PostgreSQL), for use alongside get_fulltext_query(), or
+        None if the database has no full-text index or none of the keywords
+        can be looked up in it.
+
+    '''
+    from django.db.models import FloatField
+    from django.db.models.expressions import RawSQL
+
+    fulltext_terms, _ = _split_fulltext_terms(query_string)
+    if not fulltext_terms:
+        return None
+    sql = _get_fulltext_sql(fulltext_terms, model, search_fields, qualify=True)
+    if not sql:
+        return None
+    _, rank, param = sql
+    return RawSQL(rank, [param], output_field=FloatField())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Report the slowest recipes / layers to parse, from the data recorded by
+# update.py / update_layer.py when run with --profile
+#
+# Copyright (C) 2018 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+
+import sys
+import os
+
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))
+
+import optparse
+import utils
+import logging
+from datetime import datetime, timedelta
+
+logger = utils.logger_create('LayerIndexParseProfile')
+
+
+def format_memory(value):
+    return '%.1fM' % (value / (1024 * 1024))
+
+def print_table(headings, rows):
+    widths = [len(heading) for heading in headings]
+    for row in rows:
+        for i, value in enumerate(row):
+            widths[i] = max(widths[i], len(value))
+    # Left-align the first column, right-align the rest
+    fmt = '  '.join(['%%-%ds' % widths[0]] + ['%%%ds' % width for width in widths[1:]])
+    print(fmt % tuple(headings))
+    for row in rows:
+        print(fmt % tuple(row))
+
+def report_recipes(profiles, count):
+    from django.db.models import Count, Avg, Max
+
+    results = profiles.values('recipe__layerbranch__layer__name', 'recipe__layerbranch__branch__name', 'recipe__filepath', 'recipe__filename')
+    results = results.annotate(runs=Count('id'), avg_parse=Avg('parse_time'), max_parse=Max('parse_time'), avg_write=Avg('write_time'), max_memory=Max('peak_memory'))
+    results = results.order_by('-avg_parse')[:count]
+    rows = []
+    for result in results:
+        rows.append(('%s:%s:%s' % (result['recipe__layerbranch__layer__name'],
+                                   result['recipe__layerbranch__branch__name'],
+                                   os.path.join(result['recipe__filepath'], result['recipe__filename'])),
+                     str(result['runs']),
+                     '%.2fs' % result['avg_parse'],
+                     '%.2fs' % result['max_parse'],
+                     '%.2fs' % result['avg_write'],
+                     format_memory(result['max_memory'])))
+    print_table(['Recipe', 'Runs', 'Avg parse', 'Max parse', 'Avg write', 'Peak memory'], rows)
+
+def report_layers(profiles, count):
+    from django.db.models import Count, Sum, Avg, Max
+
+    results = profiles.values('recipe__layerbranch__layer__name', 'recipe__layerbranch__branch__name')
+    # All of the records for a layer from one update share the same timestamp
+    results = results.annotate(runs=Count('parsed', distinct=True), recipes=Count('recipe', distinct=True), total_parse=Sum('parse_time'), total_write=Sum('write_time'), avg_parse=Avg('parse_time'), max_memory=Max('peak_memory'))
+    results = sorted(results, key=lambda result: result['total_parse'] / result['runs'], reverse=True)[:count]
+    rows = []
+    for result in results:
+        rows.append(('%s:%s' % (result['recipe__layerbranch__layer__name'], result['recipe__layerbranch__branch__name']),
+                     str(result['runs']),
+                     str(result['recipes']),
+                     '%.1fs' % (result['total_parse'] / result['runs']),
+                     '%.1fs' % (result['total_write'] / result['runs']),
+                     '%.2fs' % result['avg_parse'],
+                     format_memory(result['max_memory'])))
+    print_table(['Layer', 'Runs', 'Recipes', 'Parse per run', 'Write per run', 'Avg parse', 'Peak memory'], rows)
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage = """
+    %prog [options]""")
+
+    parser.add_option("-b", "--branch",
+            help = "Only report on the specified branch",
+            action="store", dest="branch")
+    parser.add_option("-l", "--layer",
+            help = "Only report on the specified layers (use commas to separate multiple)",
+            action="store", dest="layers")
+    parser.add_option("-c", "--count",
+            help = "Number of items to report (default 20)",
+            type="int", action="store", dest="count", default=20)
+    parser.add_option("", "--days",
+            help = "Only consider data recorded within the specified number of days",
+            type="int", action="store", dest="days")
+    parser.add_option("", "--by-layer",
+            help = "Report the slowest layers rather than the slowest recipes",
+            action="store_true", dest="by_layer")
+    parser.add_option("-d", "--debug",
+            help = "Enable debug output",
+            action="store_const", const=logging.DEBUG, dest="loglevel", default=logging.INFO)
+    parser.add_option("-q", "--quiet",
+            help = "Hide all output except error messages",
+            action="store_const", const=logging.ERROR, dest="loglevel")
+
+    options, args = parser.parse_args(sys.argv)
+    if len(args) > 1:
+        logger.error('unexpected argument "%s"' % args[1])
+        parser.print_help()
+        sys.exit(1)
+
+    utils.setup_django()
+    from layerindex.models import RecipeParseProfile
+
+    logger.setLevel(options.loglevel)
+
+    profiles = RecipeParseProfile.objects.all()
+    if options.branch:
+        if not utils.get_branch(options.branch):
+            logger.error("Specified branch %s is not valid" % options.branch)
+            sys.exit(1)
+        profiles = profiles.filter(recipe__layerbranch__branch__name=options.branch)
+    if options.layers:
+        profiles = profiles.filter(recipe__layerbranch__layer__name__in=options.layers.split(','))
+    if options.days:
+        profiles = profiles.filter(parsed__gte=datetime.now() - timedelta(days=options.days))
+
+    if not profiles.exists():
+        logger.info('No profiling data found - run update.py with --profile to record some')
+        sys.exit(0)
+
+    if options.by_layer:
+        report_layers(profiles, options.count)
+    else:
+        report_recipes(profiles, options.count)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
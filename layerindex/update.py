@@ -12,14 +12,20 @@ import sys
 import os
 import optparse
 import codecs
+import io
 import logging
 import subprocess
 from datetime import datetime, timedelta
 from distutils.version import LooseVersion
 import utils
+import recipeparse
 import operator
 import re
 import multiprocessing
+import signal
+import time
+import json
+import threading
 
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
@@ -34,13 +40,16 @@ except ImportError:
     sys.exit(1)
 
 
-def prepare_update_layer_command(options, branch, layer, initial=False):
+def prepare_update_layer_command(options, branch, layer, initial=False, worker=False):
     """Prepare the update_layer.py command line"""
     if branch.update_environment:
         cmdprefix = branch.update_environment.get_command()
     else:
         cmdprefix = 'python3'
-    cmd = '%s update_layer.py -l %s -b %s' % (cmdprefix, layer.name, branch.name)
+    if worker:
+        cmd = '%s update_layer.py --worker -b %s' % (cmdprefix, branch.name)
+    else:
+        cmd = '%s update_layer.py -l %s -b %s' % (cmdprefix, layer.name, branch.name)
     if options.reload:
         cmd += ' --reload'
     if options.fullreload:
@@ -59,8 +68,362 @@ def prepare_update_layer_command(options, branch, layer, initial=False):
         cmd += ' --keep-temp'
     if options.stop_on_error:
         cmd += ' --stop-on-error'
+    if options.profile:
+        cmd += ' --profile'
     return cmd
 
+class UpdateLayerJob():
+    """The update of a single layer by an UpdateLayerWorker"""
+    def __init__(self, linefunc=None):
+        self.output = ''
+        self.linefunc = linefunc
+        self.retcode = None
+        self.finished = threading.Event()
+        # Progress and timings reported by the worker
+        self.parsed = 0
+        self.total = None
+        self.timings = {}
+
+    def add_output(self, line):
+        self.output += line
+        if self.linefunc:
+            self.linefunc(line)
+
+    def add_event(self, data):
+        """Record an event reported by the worker (see UpdateEvents in update_layer.py)"""
+        try:
+            event = json.loads(data)
+        except ValueError:
+            logger.warning('Invalid event from layer update worker: %s' % data)
+            return
+        if event['event'] == 'progress':
+            self.parsed = event['parsed']
+            self.total = event['total']
+        elif event['event'] == 'phase':
+            if event['phase'] == 'parse':
+                # This is the total for the whole update
+                self.timings['parse'] = event['seconds']
+            else:
+                self.timings[event['phase']] = self.timings.get(event['phase'], 0) + event['seconds']
+
+    def get_progress(self):
+        """Get the fraction of the recipes to be parsed that have been parsed"""
+        if self.retcode is not None:
+            return 1
+        if not self.total:
+            return 0
+        return min(self.parsed / self.total, 1)
+
+    def get_stats(self):
+        """Get the progress and timings as a dict, for storing in LayerUpdate.stats"""
+        return {'parsed': self.parsed, 'total': self.total, 'timings': dict(self.timings)}
+
+    def finish(self, retcode):
+        if self.retcode is None:
+            self.retcode = retcode
+            self.finished.set()
+
+    def poll(self):
+        """Return the exit code if the update has finished, otherwise None"""
+        return self.retcode
+
+    def wait(self):
+        self.finished.wait()
+        return self.retcode
+
+class UpdateLayerWorker():
+    """
+    A persistent "update_layer.py --worker" process, which updates layers one
+    at a time as they are requested and keeps bitbake initialised in between.
+    """
+    def __init__(self, cmd):
+        def reenable_sigint():
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        logger.debug('Starting layer update worker: %s' % cmd)
+        self.process = subprocess.Popen(
+            cmd, cwd=os.path.dirname(sys.argv[0]), shell=True, preexec_fn=reenable_sigint, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        self.lock = threading.Lock()
+        self.job = None
+        self.jobcount = 0
+        self.exited = False
+        # Output that arrived when there was no job to attach it to
+        self.unclaimed = []
+        self.reader = threading.Thread(target=self._read_output)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def _read_output(self):
+        # Note: unlike codecs' StreamReader, TextIOWrapper doesn't wait for more
+        # data than is available before returning a line
+        reader = io.TextIOWrapper(self.process.stdout, encoding='utf-8', errors='surrogateescape')
+        for line in reader:
+            with self.lock:
+                job = self.job
+                if line.startswith(utils.UPDATE_WORKER_DONE):
+                    self.job = None
+                elif line.startswith(utils.UPDATE_WORKER_EVENT):
+                    if job:
+                        job.add_event(line[len(utils.UPDATE_WORKER_EVENT):].strip())
+                    continue
+                elif not job:
+                    self.unclaimed.append(line)
+                    continue
+            if line.startswith(utils.UPDATE_WORKER_DONE):
+                if job:
+                    job.finish(int(line.split()[-1]))
+            else:
+                job.add_output(line)
+        ret = self.process.wait()
+        with self.lock:
+            self.exited = True
+            job = self.job
+            self.job = None
+        if job:
+            # The worker died part way through the update
+            job.finish(ret or 1)
+
+    def run(self, layer, initial=False, linefunc=None, reparse=None):
+        """
+        Start updating the specified layer, returning an UpdateLayerJob.
+        reparse is an optional list of IDs of recipes within the layer to
+        reparse even if the layer itself hasn't changed.
+        """
+        job = UpdateLayerJob(linefunc)
+        with self.lock:
+            for line in self.unclaimed:
+                job.add_output(line)
+            self.unclaimed = []
+            if self.exited:
+                job.finish(self.process.returncode or 1)
+                return job
+            self.job = job
+        self.jobcount += 1
+        try:
+            self.process.stdin.write((json.dumps({'layer': layer.name, 'initial': initial, 'reparse': reparse or []}) + '\n').encode('utf-8'))
+            self.process.stdin.flush()
+        except OSError:
+            # The worker has exited, the reader thread will finish the job
+            pass
+        return job
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+        self.reader.join()
+
+class UpdateLayerWorkerPool():
+    """
+    A set of UpdateLayerWorkers for a branch. Workers are reused for
+    subsequent layers unless the update failed (in which case the parser
+    state can't be trusted) or the worker has already updated maxlayers
+    layers, to limit the effect of any leaks within bitbake.
+    """
+    def __init__(self, options, branch, maxlayers):
+        self.cmd = prepare_update_layer_command(options, branch, None, worker=True)
+        self.maxlayers = maxlayers
+        self.idle = []
+        self.busy = []
+
+    def _reclaim(self):
+        for worker in self.busy[:]:
+            ret = worker.job_handle.poll()
+            if ret is None:
+                continue
+            self.busy.remove(worker)
+            if ret == 0 and worker.jobcount < self.maxlayers and worker.is_alive():
+                self.idle.append(worker)
+            else:
+                worker.close()
+
+    def run(self, layer, initial=False, linefunc=None, reparse=None):
+        """Start updating the specified layer on an idle worker (starting a new one if needed)"""
+        self._reclaim()
+        if self.idle:
+            worker = self.idle.pop()
+        else:
+            worker = UpdateLayerWorker(self.cmd)
+        worker.job_handle = worker.run(layer, initial, linefunc, reparse)
+        self.busy.append(worker)
+        return worker.job_handle
+
+    def close(self):
+        for worker in self.idle + self.busy:
+            worker.close()
+        self.idle = []
+        self.busy = []
+
+def run_initial_layer_update(workers, layer):
+    """
+    Run the initial (layer.conf only) update for the layer with output displayed
+    on the console, ensuring any Ctrl+C is processed only by the worker.
+    """
+    def linefunc(line):
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        job = workers.run(layer, initial=True, linefunc=linefunc)
+        ret = job.wait()
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+    return ret, job.output
+
+def start_layer_update(options, update, branchobj, layer, failedrepos, workers, linefunc=None, reparse=None):
+    """
+    Create a LayerUpdate record and start updating the layer using the
+    specified UpdateLayerWorkerPool (reparsing the recipes with the IDs in
+    reparse, if specified). Returns a tuple of (layerupdate, job), where job
+    is None if the layer was skipped.
+    """
+    from layerindex.models import LayerUpdate
+
+    layerupdate = LayerUpdate()
+    layerupdate.update = update
+    layerupdate.layer = layer
+    layerupdate.branch = branchobj
+    layerbranch = layer.get_layerbranch(branchobj.name)
+    if layerbranch:
+        layerupdate.vcs_before_rev = layerbranch.vcs_last_rev
+
+    errmsg = failedrepos.get(layer.vcs_url, '')
+    if errmsg:
+        logger.info("Skipping update of layer %s as fetch of repository %s failed:\n%s" % (layer.name, layer.vcs_url, errmsg))
+        layerupdate.started = datetime.now()
+        layerupdate.finished = datetime.now()
+        layerupdate.log = 'ERROR: fetch failed: %s' % errmsg
+        if not options.dryrun:
+            layerupdate.save()
+        return layerupdate, None
+
+    layerupdate.started = datetime.now()
+    if not options.dryrun:
+        layerupdate.save()
+    logger.debug('Updating layer %s' % layer.name)
+    return layerupdate, workers.run(layer, linefunc=linefunc, reparse=reparse)
+
+def finish_layer_update(options, layerupdate, ret, output, stats=None):
+    """Record the result of running update_layer.py in the LayerUpdate record"""
+    layerupdate.finished = datetime.now()
+    # We need to get layerbranch here because it might not have existed until
+    # layer_update.py created it, but it still may not create one (e.g. if subdir
+    # didn't exist) so we still need to check
+    layerbranch = layerupdate.layer.get_layerbranch(layerupdate.branch.name)
+    if layerbranch:
+        layerupdate.vcs_after_rev = layerbranch.vcs_last_rev
+    layerupdate.log = output
+    layerupdate.retcode = ret
+    if stats:
+        layerupdate.stats = json.dumps(stats)
+    if not options.dryrun:
+        layerupdate.save()
+
+# How often (in seconds) to report progress of the running layer updates
+LAYER_PROGRESS_INTERVAL = 5
+
+def run_layer_updates(layers, waitfor, checkout_keys, maxjobs, options, update, branchobj, failedrepos, workers, reparse=None, progressfunc=None):
+    """
+    Update each of the specified layers (which must be sorted in
+    dependency order) using workers, running up to maxjobs of them at once.
+    A layer is only started once all of the layers in waitfor[layer] have
+    finished, and never at the same time as another layer that needs a
+    repository it uses (its own or one of its dependencies') checked out
+    at a different branch - checkout_keys maps each layer to the set of
+    (repository, checkout branch) pairs it needs. reparse optionally maps layers to lists of IDs of
+    recipes to reparse regardless of whether the layer has changed.
+    progressfunc, if specified, is called periodically with the fraction
+    of the layers that have been updated (including partial progress
+    reported by the workers), and the progress and timings of the running
+    layers are saved to their LayerUpdate records at the same time.
+    Returns 254 if the update was interrupted, 1 if a layer failed with
+    --stop-on-error, otherwise 0.
+    """
+    if reparse is None:
+        reparse = {}
+    pending = list(layers)
+    running = {}
+    done = set()
+    retcode = 0
+    last_progress = 0
+
+    def make_linefunc(layer):
+        if maxjobs > 1:
+            # Prefix the output so it's possible to tell which layer it relates to
+            def linefunc(line):
+                sys.stdout.write('%s: %s' % (layer.name, line))
+                sys.stdout.flush()
+        else:
+            def linefunc(line):
+                sys.stdout.write(line)
+                sys.stdout.flush()
+        return linefunc
+
+    def can_start(layer):
+        if not waitfor[layer].issubset(done):
+            return False
+        for repo, checkout_branch in checkout_keys[layer]:
+            for other in running:
+                for other_repo, other_checkout_branch in checkout_keys[other]:
+                    if other_repo == repo and other_checkout_branch != checkout_branch:
+                        return False
+        return True
+
+    # Ensure any Ctrl+C is processed only by the child processes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        while pending or running:
+            if not retcode:
+                for layer in pending[:]:
+                    if len(running) >= maxjobs:
+                        break
+                    if not can_start(layer):
+                        continue
+                    pending.remove(layer)
+                    layerupdate, command = start_layer_update(options, update, branchobj, layer, failedrepos, workers, make_linefunc(layer), reparse.get(layer, None))
+                    if command:
+                        running[layer] = (layerupdate, command)
+                    else:
+                        done.add(layer)
+            elif not running:
+                break
+
+            for layer, (layerupdate, command) in list(running.items()):
+                ret = command.poll()
+                if ret is None:
+                    continue
+                del running[layer]
+                done.add(layer)
+                finish_layer_update(options, layerupdate, ret, command.output, command.get_stats())
+                if ret == 254:
+                    # Interrupted by user, don't start anything else
+                    retcode = 254
+                elif options.stop_on_error and ret != 0 and not retcode:
+                    logger.error('Update of layer %s failed' % layer.name)
+                    retcode = 1
+
+            if time.time() - last_progress >= LAYER_PROGRESS_INTERVAL or not (pending or running):
+                last_progress = time.time()
+                if progressfunc and layers:
+                    progressfunc((len(done) + sum([command.get_progress() for _, command in running.values()])) / len(layers))
+                if not options.dryrun:
+                    for layerupdate, command in running.values():
+                        layerupdate.log = command.output
+                        layerupdate.stats = json.dumps(command.get_stats())
+                        layerupdate.save()
+            if running:
+                time.sleep(0.1)
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+    return retcode
+
 def update_actual_branch(layerquery, fetchdir, branch, options, update_bitbake, bitbakepath):
     """Update actual branch for layers and bitbake in database"""
     to_save = set()
@@ -99,17 +462,153 @@ def update_actual_branch(layerquery, fetchdir, branch, options, update_bitbake,
         for s in to_save:
             s.save()
 
-def fetch_repo(vcs_url, repodir, urldir, fetchdir, layer_name):
+FETCH_MODES = ['full', 'shared', 'blobless']
+
+def get_shared_objects_dir(fetchdir):
+    # Fetch directory names never contain '.' so this can't clash with a repository
+    return os.path.join(fetchdir, '.shared-objects.git')
+
+def init_shared_objects(fetchdir):
+    """
+    Create the bare repository used to store objects shared between all of
+    the layer repositories in the 'shared' fetch mode
+    """
+    storedir = get_shared_objects_dir(fetchdir)
+    if not os.path.exists(storedir):
+        utils.runcmd(['git', 'init', '--bare', '--quiet', storedir], fetchdir, logger=logger, shell=False)
+        # Objects here may be in use by any of the layer repositories (even
+        # once they are no longer referenced here), so never prune them
+        utils.runcmd(['git', 'config', 'gc.auto', '0'], storedir, logger=logger, shell=False)
+        utils.runcmd(['git', 'config', 'gc.pruneExpire', 'never'], storedir, logger=logger, shell=False)
+    return storedir
+
+def fetch_repo(vcs_url, repodir, urldir, fetchdir, layer_name, fetchmode='full'):
+    """
+    Clone or fetch the specified repository. fetchmode is one of:
+      full: standalone clone of the repository
+      shared: objects are fetched into a bare repository shared by all
+          repositories in the fetch directory, which each repository
+          then refers to via git alternates (saving a lot of space where
+          repositories are forks of each other)
+      blobless: new clones are partial clones, with file contents only
+          fetched when needed (e.g. when checking out)
+    Returns a tuple of (vcs_url, error, fetch time in seconds), where error
+    is None if the fetch succeeded.
+    """
     logger.info("Fetching remote repository %s" % vcs_url)
+    started = time.time()
     try:
+        if fetchmode == 'shared':
+            storedir = get_shared_objects_dir(fetchdir)
+            # Keep each repository's refs in a separate namespace within the
+            # shared repository, so that everything they need stays referenced
+            utils.runcmd(['git', 'fetch', '--quiet', '--no-tags', vcs_url,
+                          '+refs/heads/*:refs/shared/%s/heads/*' % urldir,
+                          '+refs/tags/*:refs/shared/%s/tags/*' % urldir],
+                         storedir, logger=logger, printerr=False, shell=False)
         if not os.path.exists(repodir):
-            utils.runcmd(['git', 'clone', vcs_url, urldir], fetchdir, logger=logger, printerr=False, shell=False)
+            cmd = ['git', 'clone']
+            if fetchmode == 'shared':
+                cmd += ['--reference', storedir]
+            elif fetchmode == 'blobless':
+                cmd += ['--filter=blob:none']
+            utils.runcmd(cmd + [vcs_url, urldir], fetchdir, logger=logger, printerr=False, shell=False)
         else:
+            if fetchmode == 'shared':
+                alternates = os.path.join(repodir, '.git', 'objects', 'info', 'alternates')
+                if not os.path.exists(alternates):
+                    # Existing standalone clone - point it at the shared
+                    # repository and drop the objects that are now found there
+                    logger.info("Moving objects for %s to shared repository" % vcs_url)
+                    with open(alternates, 'w') as f:
+                        f.write(os.path.join(storedir, 'objects') + '\n')
+                    utils.runcmd(['git', 'repack', '-a', '-d', '-l', '-q'], repodir, logger=logger, printerr=False, shell=False)
             utils.runcmd("git fetch -p", repodir, logger=logger, printerr=False)
-        return (vcs_url, None)
+        return (vcs_url, None, time.time() - started)
     except subprocess.CalledProcessError as e:
         logger.error("Fetch of layer %s failed: %s" % (layer_name, e.output))
-        return (vcs_url, e.output)
+        return (vcs_url, e.output, time.time() - started)
+
+def get_objects_size(repodir):
+    """Get the size of the objects stored within a repository, not counting alternates"""
+    output = utils.runcmd(['git', 'count-objects', '-v'], repodir, logger=logger, shell=False)
+    values = dict(line.split(': ', 1) for line in output.splitlines() if ': ' in line)
+    return (int(values.get('size', 0)) + int(values.get('size-pack', 0))) * 1024
+
+def get_reachable_objects_size(repodir):
+    """Get the size of all objects reachable from a repository's refs, wherever they are stored"""
+    try:
+        return int(utils.runcmd(['git', 'rev-list', '--all', '--objects', '--disk-usage'], repodir, logger=logger, printerr=False, shell=False))
+    except (subprocess.CalledProcessError, ValueError):
+        # Requires git 2.31 or later
+        return None
+
+def print_fetch_report(allrepos, fetchtimes, fetchdir, fetchmode):
+    """Log the time taken to fetch each repository and how much space it is using"""
+    from django.template.defaultfilters import filesizeformat
+    logger.info('Fetch report (mode: %s):' % fetchmode)
+    logger.info('  %-60s %8s %12s %12s' % ('Repository', 'Time', 'Size', 'Unshared'))
+    total_size = 0
+    total_unshared = 0
+    for vcs_url in sorted(allrepos):
+        repodir = allrepos[vcs_url][0]
+        if not os.path.exists(repodir):
+            continue
+        size = get_objects_size(repodir)
+        total_size += size
+        if fetchmode == 'shared':
+            # What this repository would take up as a standalone clone
+            unshared = get_reachable_objects_size(repodir)
+        else:
+            unshared = size
+        if unshared is None or total_unshared is None:
+            total_unshared = None
+        else:
+            total_unshared += unshared
+        if vcs_url in fetchtimes:
+            timestr = '%.1fs' % fetchtimes[vcs_url]
+        else:
+            timestr = '-'
+        logger.info('  %-60s %8s %12s %12s' % (vcs_url, timestr, filesizeformat(size), filesizeformat(unshared) if unshared is not None else '?'))
+    if fetchmode == 'shared':
+        storesize = get_objects_size(get_shared_objects_dir(fetchdir))
+        logger.info('Shared object repository: %s' % filesizeformat(storesize))
+        total_size += storesize
+    if total_unshared is not None and total_unshared > total_size:
+        logger.info('Total: %s (%s saved)' % (filesizeformat(total_size), filesizeformat(total_unshared - total_size)))
+    else:
+        logger.info('Total: %s' % filesizeformat(total_size))
+
+def get_changed_paths(repo, urldir, fromrev, tocommit):
+    """
+    Get the paths (relative to the fetch directory) of the files changed in
+    a repository between two revisions
+    """
+    try:
+        diff = repo.commit(fromrev).diff(tocommit)
+    except Exception as e:
+        logger.debug('Unable to get diff from %s in %s: %s' % (fromrev, urldir, str(e)))
+        return set()
+    paths = set()
+    for diffitem in diff:
+        for path in [diffitem.a_path, diffitem.b_path]:
+            if path:
+                paths.add(os.path.join(urldir, path))
+    return paths
+
+def get_external_dependents(branchobj, paths):
+    """
+    Find recipes on the branch that use any of the specified files (paths
+    relative to the fetch directory) from outside of their own layer.
+    Returns a dict mapping layer IDs to sets of recipe IDs.
+    """
+    from layerindex.models import RecipeExternalFileDependency
+    dependents = {}
+    paths = sorted(paths)
+    for i in range(0, len(paths), 500):
+        for layer_id, recipe_id in RecipeExternalFileDependency.objects.filter(recipe__layerbranch__branch=branchobj, path__in=paths[i:i + 500]).values_list('recipe__layerbranch__layer_id', 'recipe_id'):
+            dependents.setdefault(layer_id, set()).add(recipe_id)
+    return dependents
 
 def print_subdir_error(newbranch, layername, vcs_subdir, branchdesc):
     # This will error out if the directory is completely invalid or had never existed at this point
@@ -158,12 +657,21 @@ def main():
     parser.add_option("-x", "--nofetch",
             help = "Don't fetch repositories",
             action="store_true", dest="nofetch")
+    parser.add_option("", "--fetch-mode",
+            help = "How to fetch repositories: %s (default from LAYER_FETCH_MODE setting)" % ', '.join(FETCH_MODES),
+            action="store", dest="fetch_mode", choices=FETCH_MODES)
+    parser.add_option("", "--fetch-report",
+            help = "Report fetch time and disk usage for each repository",
+            action="store_true", dest="fetch_report")
     parser.add_option("", "--nocheckout",
             help = "Don't check out branches",
             action="store_true", dest="nocheckout")
     parser.add_option("", "--stop-on-error",
             help = "Stop on first parsing error",
             action="store_true", default=False, dest="stop_on_error")
+    parser.add_option("", "--profile",
+            help = "Record the time taken and peak memory used to parse each recipe (see tools/parse_profile_report.py)",
+            action="store_true", dest="profile")
     parser.add_option("-a", "--actual-branch",
             help = "Update actual branch for layer and bitbake",
             action="store", dest="actual_branch", default='')
@@ -176,6 +684,9 @@ def main():
     parser.add_option("", "--keep-temp",
             help = "Preserve temporary directory at the end instead of deleting it",
             action="store_true")
+    parser.add_option("-u", "--update",
+            help = "Specify update record to link to (e.g. when run as a task)",
+            action="store", dest="update")
 
     options, args = parser.parse_args(sys.argv)
     if len(args) > 1:
@@ -185,7 +696,7 @@ def main():
 
     utils.setup_django()
     import settings
-    from layerindex.models import Branch, LayerItem, Update, LayerUpdate, LayerBranch
+    from layerindex.models import Branch, LayerItem, Update, LayerUpdate, LayerBranch, RecipeParseProfile, Recipe
 
     logger.setLevel(options.loglevel)
 
@@ -236,6 +747,11 @@ def main():
             logger.error("Only one branch should be used with -a")
             sys.exit(1)
 
+    fetchmode = options.fetch_mode or getattr(settings, 'LAYER_FETCH_MODE', 'full')
+    if fetchmode not in FETCH_MODES:
+        logger.error("Invalid LAYER_FETCH_MODE setting %s (must be one of: %s)" % (fetchmode, ', '.join(FETCH_MODES)))
+        sys.exit(1)
+
     if not os.path.exists(fetchdir):
         os.makedirs(fetchdir)
 
@@ -243,6 +759,7 @@ def main():
     fetchedresult = []
     fetchedrepos = []
     failedrepos = {}
+    fetchtimes = {}
 
     # We don't want git to prompt for any passwords (e.g. when accessing renamed/hidden github repos)
     os.environ['SSH_ASKPASS'] = ''
@@ -253,8 +770,19 @@ def main():
     listhandler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
     logger.addHandler(listhandler)
 
-    update = Update()
-    update.started = datetime.now()
+    if options.update:
+        update = Update.objects.filter(id=int(options.update)).first()
+        if not update:
+            logger.error("Specified update id %s does not exist in database" % options.update)
+            sys.exit(1)
+    else:
+        update = Update()
+        update.started = datetime.now()
+    logdir = getattr(settings, 'TASK_LOG_DIR', None)
+    if update.task_id and logdir:
+        pwriter = utils.ProgressWriter(logdir, update.task_id, logger=logger)
+    else:
+        pwriter = None
     if options.fullreload or options.reload:
         update.reload = True
     else:
@@ -267,6 +795,7 @@ def main():
         if not lockfile:
             logger.error("Layer index lock timeout expired")
             sys.exit(1)
+        workers = None
         try:
             bitbakepath = os.path.join(fetchdir, 'bitbake')
 
@@ -286,40 +815,74 @@ def main():
                         allrepos[layer.vcs_url] = (repodir, urldir, fetchdir, layer.name)
                 # Add bitbake
                 allrepos[settings.BITBAKE_REPO_URL] = (bitbakepath, "bitbake", fetchdir, "bitbake")
+                if fetchmode == 'shared':
+                    init_shared_objects(fetchdir)
                 # Parallel fetching
                 pool = multiprocessing.Pool(int(settings.PARALLEL_JOBS))
                 for url in allrepos:
                     fetchedresult.append(pool.apply_async(fetch_repo, \
-                        (url, allrepos[url][0], allrepos[url][1], allrepos[url][2], allrepos[url][3],)))
+                        (url, allrepos[url][0], allrepos[url][1], allrepos[url][2], allrepos[url][3], fetchmode)))
                 pool.close()
                 pool.join()
 
-                for url in fetchedresult[:]:
-                    # The format is (url, error), the error is None when succeed.
-                    if url.get()[1]:
-                        failedrepos[url.get()[0]] = url.get()[1]
+                for result in fetchedresult:
+                    # The format is (url, error, time taken), the error is None when succeed.
+                    (url, error, fetchtime) = result.get()
+                    fetchtimes[url] = fetchtime
+                    if error:
+                        failedrepos[url] = error
                     else:
-                        fetchedrepos.append(url.get()[0])
+                        fetchedrepos.append(url)
+
+                if options.fetch_report:
+                    print_fetch_report(allrepos, fetchtimes, fetchdir, fetchmode)
 
                 if not (fetchedrepos or update_bitbake):
                     logger.error("No repositories could be fetched, exiting")
                     sys.exit(1)
 
+            if getattr(settings, 'LAYER_WORKTREES', False) and not options.nocheckout:
+                # Clean up worktrees for branches / repositories that have gone away
+                utils.prune_worktrees(settings, Branch.objects.values_list('name', flat=True), logger=logger)
+
             if options.actual_branch:
                 update_actual_branch(layerquery, fetchdir, branches[0], options, update_bitbake, bitbakepath)
                 return
 
+            if not options.nocheckout:
+                # We need to check this out because we're using stuff from bb.utils
+                # below, and if we don't it might be a python 2 revision which would
+                # be an issue. bb.utils has to be imported before any workers are
+                # started since they need bitbake to stay at the revision for their
+                # branch from then on.
+                utils.checkout_repo(bitbakepath, 'origin/master', logger=logger)
+                utils.explode_dep_versions2(bitbakepath, '')
+
             # Process and extract data from each layer
-            # We now do this by calling out to a separate script; doing otherwise turned out to be
-            # unreliable due to leaking memory (we're using bitbake internals in a manner in which
-            # they never get used during normal operation).
+            # We now do this by calling out to separate worker processes (one set per
+            # branch, recycled periodically); doing otherwise turned out to be
+            # unreliable due to leaking memory (we're using bitbake internals in a manner
+            # in which they never get used during normal operation).
+            maxlayers = getattr(settings, 'UPDATE_WORKER_MAX_LAYERS', 20)
             failed_layers = {}
-            for branch in branches:
+            for branchidx, branch in enumerate(branches):
                 failed_layers[branch] = []
+                if workers:
+                    workers.close()
+                workers = UpdateLayerWorkerPool(options, utils.get_branch(branch), maxlayers)
+                # Where the layers are checked out for this branch
+                layerfetchdir = utils.get_layer_checkout_dir(settings, branch)
                 # If layer_A depends(or recommends) on layer_B, add layer_B before layer_A
                 deps_dict_all = {}
                 layerquery_sorted = []
+                layer_collections = {}
+                layer_requires = {}
                 collections = set()
+                # Files changed in the layers being updated
+                changed_paths = set()
+                # (repository, branch) -> {subdirectory: tree hash}
+                subdir_trees = {}
+                uptodate_layers = []
                 branchobj = utils.get_branch(branch)
                 for layer in layerquery_all:
                     # Get all collections from database, but we can't trust the
@@ -362,14 +925,17 @@ def main():
                     # Collect repo info
                     urldir = layer.get_fetch_dir()
                     repodir = os.path.join(fetchdir, urldir)
+                    checkoutdir = os.path.join(layerfetchdir, urldir)
+                    if options.nocheckout and not os.path.exists(checkoutdir):
+                        # Nothing has checked the branch out into a worktree
+                        # yet, so use whatever is checked out in the repository
+                        checkoutdir = repodir
                     repo = git.Repo(repodir)
                     assert repo.bare == False
                     try:
                         # Always get origin/branchname, so it raises error when branch doesn't exist when nocheckout
                         topcommit = repo.commit('origin/%s' % branchname)
-                        if options.nocheckout:
-                            topcommit = repo.commit('HEAD')
-                    except:
+                    except (git.BadName, git.BadObject, ValueError):
                         if newbranch:
                             logger.info("Skipping update of layer %s - branch %s doesn't exist" % (layer.name, branchdesc))
                         else:
@@ -377,11 +943,31 @@ def main():
                             if not options.dryrun:
                                 layerbranch.delete()
                         continue
+                    if options.nocheckout:
+                        topcommit = git.Repo(checkoutdir).commit('HEAD')
 
+                    treehash = None
                     if layerbranch.vcs_subdir and not options.nocheckout:
-                        # Find latest commit in subdirectory
-                        # A bit odd to do it this way but apparently there's no other way in the GitPython API
-                        topcommit = next(repo.iter_commits('origin/%s' % branchname, paths=layerbranch.vcs_subdir), None)
+                        # If the subdirectory's tree hasn't changed then neither has
+                        # the latest commit touching it, so avoid walking the history.
+                        # Look up the trees for all layers in the repository at once.
+                        treekey = (urldir, branchname)
+                        if treekey not in subdir_trees:
+                            subdirs = [layerbranch.vcs_subdir]
+                            subdirs.extend(LayerBranch.objects.filter(branch=branchobj, layer__vcs_url=layer.vcs_url).values_list('vcs_subdir', flat=True))
+                            subdir_trees[treekey] = utils.get_subdir_tree_hashes(repodir, 'origin/%s' % branchname, subdirs, logger=logger)
+                        topcommit = None
+                        treehash = subdir_trees[treekey].get(layerbranch.vcs_subdir.strip('/'), None)
+                        if layerbranch.vcs_last_rev and treehash and treehash == layerbranch.vcs_last_tree:
+                            try:
+                                topcommit = repo.commit(layerbranch.vcs_last_rev)
+                            except ValueError:
+                                # Commit no longer exists (history rewritten?)
+                                pass
+                        if not topcommit:
+                            # Find latest commit in subdirectory
+                            # A bit odd to do it this way but apparently there's no other way in the GitPython API
+                            topcommit = next(repo.iter_commits('origin/%s' % branchname, paths=layerbranch.vcs_subdir), None)
                         if not topcommit:
                             print_subdir_error(newbranch, layer.name, layerbranch.vcs_subdir, branchdesc)
                             if not (newbranch and layerbranch.vcs_subdir):
@@ -390,13 +976,18 @@ def main():
 
                     if layerbranch.vcs_last_rev == topcommit.hexsha and not update.reload:
                         logger.info("Layer %s is already up-to-date for branch %s" % (layer.name, branchdesc))
+                        if treehash and treehash != layerbranch.vcs_last_tree and not options.dryrun:
+                            # Record the tree so that the check is quicker next time
+                            # (without changing the updated timestamp)
+                            LayerBranch.objects.filter(id=layerbranch.id).update(vcs_last_tree=treehash)
                         collections.add((layerbranch.collection, layerbranch.version))
+                        uptodate_layers.append(layer)
                         continue
                     else:
                         # Check out appropriate branch
                         if not options.nocheckout:
-                            utils.checkout_layer_branch(layerbranch, repodir, logger=logger)
-                        layerdir = os.path.join(repodir, layerbranch.vcs_subdir)
+                            utils.checkout_layer_branch(layerbranch, repodir, logger=logger, worktreedir=checkoutdir)
+                        layerdir = os.path.join(checkoutdir, layerbranch.vcs_subdir)
                         if layerbranch.vcs_subdir and not os.path.exists(layerdir):
                             print_subdir_error(newbranch, layer.name, layerbranch.vcs_subdir, branchdesc)
                             continue
@@ -405,45 +996,53 @@ def main():
                             logger.error("conf/layer.conf not found for layer %s - is subdirectory set correctly?" % layer.name)
                             continue
 
-                    cmd = prepare_update_layer_command(options, branchobj, layer, initial=True)
-                    logger.debug('Running layer update command: %s' % cmd)
-                    ret, output = utils.run_command_interruptible(cmd)
-                    logger.debug('output: %s' % output)
-                    if ret == 254:
-                        # Interrupted by user, break out of loop
-                        logger.info('Update interrupted, exiting')
-                        sys.exit(254)
-                    elif ret != 0:
-                        output = output.rstrip()
-                        # Save a layerupdate here or we won't see this output
-                        layerupdate = LayerUpdate()
-                        layerupdate.update = update
-                        layerupdate.layer = layer
-                        layerupdate.branch = branchobj
-                        layerupdate.started = datetime.now()
-                        layerupdate.log = output
-                        layerupdate.retcode = ret
-                        if not options.dryrun:
-                            layerupdate.save()
-                        continue
+                    if layerbranch.vcs_last_rev and not update.reload:
+                        changed_paths.update(get_changed_paths(repo, urldir, layerbranch.vcs_last_rev, topcommit))
 
-                    col = extract_value('BBFILE_COLLECTIONS', output)
-                    if not col:
-                        logger.error('Unable to find BBFILE_COLLECTIONS value in initial output')
-                        # Assume (perhaps naively) that it's an error specific to the layer
-                        continue
-                    ver = extract_value('LAYERVERSION', output)
-                    deps = extract_value('LAYERDEPENDS', output)
-                    recs = extract_value('LAYERRECOMMENDS', output)
+                    layerconf_hash = utils.get_layerconf_hash(topcommit, layerbranch.vcs_subdir)
+                    if layerbranch.collection and layerbranch.layerconf_hash == layerconf_hash and not update.reload:
+                        # conf/layer.conf hasn't changed since it was last parsed,
+                        # so there's no need to parse it again
+                        logger.debug('Using stored layer.conf values for layer %s' % layer.name)
+                        col = layerbranch.collection.split()[0]
+                        ver = layerbranch.version or ''
+                        deps = layerbranch.layerconf_depends
+                        recs = layerbranch.layerconf_recommends
+                    else:
+                        logger.debug('Running initial update for layer %s' % layer.name)
+                        ret, output = run_initial_layer_update(workers, layer)
+                        logger.debug('output: %s' % output)
+                        if ret == 254:
+                            # Interrupted by user, break out of loop
+                            logger.info('Update interrupted, exiting')
+                            sys.exit(254)
+                        elif ret != 0:
+                            output = output.rstrip()
+                            # Save a layerupdate here or we won't see this output
+                            layerupdate = LayerUpdate()
+                            layerupdate.update = update
+                            layerupdate.layer = layer
+                            layerupdate.branch = branchobj
+                            layerupdate.started = datetime.now()
+                            layerupdate.log = output
+                            layerupdate.retcode = ret
+                            if not options.dryrun:
+                                layerupdate.save()
+                            continue
 
-                    if not options.nocheckout:
-                        # We need to check this out because we're using stuff from bb.utils
-                        # below, and if we don't it might be a python 2 revision which would
-                        # be an issue
-                        utils.checkout_repo(bitbakepath, 'origin/master', logger=logger)
+                        col = extract_value('BBFILE_COLLECTIONS', output)
+                        if not col:
+                            logger.error('Unable to find BBFILE_COLLECTIONS value in initial output')
+                            # Assume (perhaps naively) that it's an error specific to the layer
+                            continue
+                        ver = extract_value('LAYERVERSION', output)
+                        deps = extract_value('LAYERDEPENDS', output)
+                        recs = extract_value('LAYERRECOMMENDS', output)
 
                     deps_dict = utils.explode_dep_versions2(bitbakepath, deps)
                     recs_dict = utils.explode_dep_versions2(bitbakepath, recs)
+                    layer_collections[layer] = col
+                    layer_requires[layer] = set(deps_dict.keys()) | set(recs_dict.keys())
                     if not (deps_dict or recs_dict):
                         # No depends, add it firstly
                         layerquery_sorted.append(layer)
@@ -506,51 +1105,96 @@ def main():
                         logger.warning("Known collections on branch %s: %s" % (branch, collections))
                         break
 
-                for layer in layerquery_sorted:
-                    layerupdate = LayerUpdate()
-                    layerupdate.update = update
-                    layerupdate.layer = layer
-                    layerupdate.branch = branchobj
-                    layerbranch = layer.get_layerbranch(branch)
+                # Recipes in other layers that use (e.g. inherit or require)
+                # files changed in the layers being updated need to be
+                # reparsed as well, even if their own layers haven't changed
+                reparse = {}
+                extra_deps = {}
+                if changed_paths:
+                    layers_by_id = dict([(layer.id, layer) for layer in layerquery_all])
+                    for layer_id, recipe_ids in get_external_dependents(branchobj, changed_paths).items():
+                        layer = layers_by_id.get(layer_id, None)
+                        if not layer or layer.vcs_url in failedrepos:
+                            continue
+                        if layer not in layerquery_sorted:
+                            if layer in layerquery and layer not in uptodate_layers:
+                                # Excluded for some other reason (e.g. unsatisfied dependencies)
+                                continue
+                            layerbranch = layer.get_layerbranch(branch)
+                            extra_deps[layer] = set([lb.layer for lb in layerbranch.get_recursive_dependencies(required=False)])
+                        logger.info('Reparsing %d recipes in layer %s due to changes in other layers' % (len(recipe_ids), layer.name))
+                        reparse[layer] = sorted(recipe_ids)
+                    # Put layers with fewer dependencies first so that they
+                    # generally come before the layers depending on them
+                    layerquery_sorted.extend(sorted(extra_deps, key=lambda layer: (len(extra_deps[layer]), layer.name)))
+
+                if not options.nocheckout and layerquery_sorted:
+                    # The update_layer.py workers will do their own checkouts, but
+                    # if several of them are running at once these need to already
+                    # be at the right revision so that they are no-ops
+                    recipeparse.checkout_core_layers(settings, branchobj, bitbakepath, logger=logger)
+                    for layer in layerquery_sorted:
+                        layerbranch = layer.get_layerbranch(branch)
+                        if layerbranch:
+                            checkout_branch = layerbranch.get_checkout_branch()
+                        else:
+                            checkout_branch = branch
+                        utils.checkout_layer_repo(settings, layer.get_fetch_dir(), branch, 'origin/%s' % checkout_branch, logger=logger)
+
+                # Work out which layers each layer needs to wait for, i.e. those
+                # earlier in the sorted list providing collections it depends on
+                # or recommends
+                waitfor = {}
+                for idx, layer in enumerate(layerquery_sorted):
+                    if layer in extra_deps:
+                        waitfor[layer] = set([l for l in layerquery_sorted[:idx] if l in extra_deps[layer]])
+                    else:
+                        requires = layer_requires.get(layer, set())
+                        waitfor[layer] = set([l for l in layerquery_sorted[:idx] if layer_collections.get(l) in requires])
+
+                # Layers can only be updated at the same time if any repositories
+                # they share need the same branch checked out. This includes the
+                # repositories of their dependencies, since setup_layer() reads
+                # the dependencies' layer.conf files from their checkouts.
+                def get_checkout_key(layer, layerbranch):
                     if layerbranch:
-                        layerupdate.vcs_before_rev = layerbranch.vcs_last_rev
-
-                    errmsg = failedrepos.get(layer.vcs_url, '')
-                    if errmsg:
-                        logger.info("Skipping update of layer %s as fetch of repository %s failed:\n%s" % (layer.name, layer.vcs_url, errmsg))
-                        layerupdate.started = datetime.now()
-                        layerupdate.finished = datetime.now()
-                        layerupdate.log = 'ERROR: fetch failed: %s' % errmsg
-                        if not options.dryrun:
-                            layerupdate.save()
-                        continue
+                        checkout_branch = layerbranch.get_checkout_branch()
+                    else:
+                        checkout_branch = branch
+                    return (layer.get_fetch_dir(), checkout_branch)
 
-                    layerupdate.started = datetime.now()
-                    if not options.dryrun:
-                        layerupdate.save()
-                    cmd = prepare_update_layer_command(options, branchobj, layer)
-                    logger.debug('Running layer update command: %s' % cmd)
-                    ret, output = utils.run_command_interruptible(cmd)
-                    layerupdate.finished = datetime.now()
-
-                    # We need to get layerbranch here because it might not have existed until
-                    # layer_update.py created it, but it still may not create one (e.g. if subdir
-                    # didn't exist) so we still need to check
+                checkout_keys = {}
+                for layer in layerquery_sorted:
                     layerbranch = layer.get_layerbranch(branch)
+                    checkout_keys[layer] = set([get_checkout_key(layer, layerbranch)])
                     if layerbranch:
-                        layerupdate.vcs_after_rev = layerbranch.vcs_last_rev
-                    layerupdate.log = output
-                    layerupdate.retcode = ret
-                    if not options.dryrun:
-                        layerupdate.save()
+                        for dep in layerbranch.dependencies_set.select_related('dependency'):
+                            deplayerbranch = dep.dependency.get_layerbranch(branch)
+                            if deplayerbranch:
+                                checkout_keys[layer].add(get_checkout_key(dep.dependency, deplayerbranch))
 
-                    if ret == 254:
-                        # Interrupted by user, break out of loop
-                        logger.info('Update interrupted, exiting')
-                        sys.exit(254)
-                    if options.stop_on_error and ret != 0:
-                        logger.info('Layer update failed with --stop-on-error, stopping')
-                        sys.exit(1)
+                if pwriter:
+                    def progressfunc(progress):
+                        pwriter.write(int((branchidx + progress) / len(branches) * 100))
+                else:
+                    progressfunc = None
+
+                branch_start = datetime.now()
+                ret = run_layer_updates(layerquery_sorted, waitfor, checkout_keys, int(settings.PARALLEL_JOBS), options, update, branchobj, failedrepos, workers, reparse, progressfunc)
+                if ret == 254:
+                    # Interrupted by user
+                    logger.info('Update interrupted, exiting')
+                    sys.exit(254)
+                elif ret:
+                    logger.info('Layer update failed with --stop-on-error, stopping')
+                    sys.exit(1)
+                if layerquery_sorted and not options.dryrun:
+                    # update_layer.py recalculates these for the recipes it
+                    # changes, but layers updated in parallel can't see each
+                    # other's changes until they're committed, so go over the
+                    # names of the recipes changed during this run again
+                    pns = Recipe.objects.filter(layerbranch__branch=branchobj, updated__gte=branch_start).values('pn')
+                    utils.update_recipe_preferred_counts(branchobj, pns)
             if failed_layers:
                 for branch, err_msg_list in failed_layers.items():
                     if err_msg_list:
@@ -558,6 +1202,8 @@ def main():
                         logger.error("Issues found on branch %s:\n    %s" % (branch, "\n    ".join(err_msg_list)))
                         print()
         finally:
+            if workers:
+                workers.close()
             utils.unlock_file(lockfile)
 
     except KeyboardInterrupt:
@@ -577,6 +1223,7 @@ def main():
         # Purge old update records
         update_purge_days = getattr(settings, 'UPDATE_PURGE_DAYS', 30)
         Update.objects.filter(started__lte=datetime.now()-timedelta(days=update_purge_days)).delete()
+        RecipeParseProfile.objects.filter(parsed__lte=datetime.now()-timedelta(days=update_purge_days)).delete()
 
     sys.exit(0)
 
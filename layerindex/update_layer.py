@@ -20,6 +20,11 @@ import errno
 import codecs
 from distutils.version import LooseVersion
 import itertools
+import time
+import json
+import contextlib
+import tracemalloc
+import hashlib
 import utils
 import recipeparse
 import layerconfparse
@@ -99,7 +104,6 @@ def collect_patch(recipe, patchfn, layerdir_start, stop_on_error):
             break
         else:
             logger.error('Unable to find suitable encoding to read patch %s' % patchfn)
-        patchrec.save()
     except DatabaseError:
         raise
     except Exception as e:
@@ -107,81 +111,489 @@ def collect_patch(recipe, patchfn, layerdir_start, stop_on_error):
             raise
         else:
             logger.error("Unable to read patch %s: %s", patchfn, str(e))
-            patchrec.save()
+    return patchrec
 
-def collect_patches(recipe, envdata, layerdir_start, stop_on_error):
+def collect_patches(recipe, patches, layerdir_start, stop_on_error):
     from layerindex.models import Patch
 
-    try:
-        import oe.recipeutils
-    except ImportError:
-        logger.warn('Failed to find lib/oe/recipeutils.py in layers - patches will not be imported')
-        return
-
     Patch.objects.filter(recipe=recipe).delete()
-    patches = oe.recipeutils.get_recipe_patches(envdata)
+    patchrecs = []
     for patch in patches:
         if not patch.startswith(layerdir_start):
             # Likely a remote patch, skip it
             continue
-        collect_patch(recipe, patch, layerdir_start, stop_on_error)
-
-def update_recipe_file(tinfoil, data, path, recipe, layerdir_start, repodir, stop_on_error, skip_patches=False):
+        patchrecs.append(collect_patch(recipe, patch, layerdir_start, stop_on_error))
+    Patch.objects.bulk_create(patchrecs)
+
+def chunks(items, size=500):
+    """Split a list into chunks, to keep the number of query parameters sane"""
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def reconcile_layer_items(model, layerbranch, keyfields, wanted):
+    """
+    Bring the records of a model (Machine, Distro, BBAppend or BBClass)
+    for a layer branch into line with wanted, a dict mapping tuples of the
+    values of keyfields to dicts of the values of any other fields. Only
+    the records that need to be added, changed or removed are written
+    (in bulk where possible), so the remaining records keep their ids.
+    Returns a tuple of the numbers of records added, changed and removed.
+    """
+    valuefields = set()
+    for fieldvalues in wanted.values():
+        valuefields.update(fieldvalues.keys())
+    existing = {}
+    delete_ids = []
+    for values in model.objects.filter(layerbranch=layerbranch).values('id', *(list(keyfields) + sorted(valuefields))):
+        key = tuple([values[field] for field in keyfields])
+        if key in existing:
+            # Shouldn't happen, but drop any duplicates
+            delete_ids.append(values['id'])
+        else:
+            existing[key] = values
+
+    adds = []
+    changed = 0
+    for key, fieldvalues in wanted.items():
+        values = existing.pop(key, None)
+        if values is None:
+            adds.append(model(layerbranch=layerbranch, **dict(zip(keyfields, key)), **fieldvalues))
+        elif any([values[field] != value for field, value in fieldvalues.items()]):
+            # Changes are rare, so just save these individually (this also
+            # takes care of any auto_now fields)
+            obj = model(id=values['id'], layerbranch=layerbranch, **dict(zip(keyfields, key)), **fieldvalues)
+            obj.save()
+            changed += 1
+    delete_ids.extend([values['id'] for values in existing.values()])
+
+    for chunk in chunks(delete_ids):
+        model.objects.filter(id__in=chunk).delete()
+    model.objects.bulk_create(adds)
+    return (len(adds), changed, len(delete_ids))
+
+class RecipeDataBatch:
+    """
+    Collects the build dependencies, inherits and file dependencies of the recipes
+    updated within a layer so that they can be written out with a handful
+    of bulk queries once all of the recipes have been parsed, rather than
+    with several queries per dependency of each recipe. If profile is True,
+    RecipeParseProfile records are collected as well.
+    """
+    def __init__(self, profile=False):
+        # recipe id -> set of StaticBuildDep names
+        self.static_deps = {}
+        # recipe id -> set of DynamicBuildDep names
+        self.dynamic_deps = {}
+        # PackageConfig id -> set of DynamicBuildDep names (new PackageConfigs only)
+        self.packageconfig_deps = {}
+        # recipe id -> set of InheritedClass names
+        self.inherits = {}
+        # recipe id -> list of new RecipeFileDependency objects
+        self.filedeps = {}
+        # recipe id -> set of RecipeExternalFileDependency paths
+        self.external_filedeps = {}
+        self.profile = profile
+        # list of (recipe, parse time, write time, peak memory) tuples
+        self.profiles = []
+
+    def set_build_deps(self, recipe, static_deps, dynamic_deps, packageconfig_deps):
+        self.static_deps[recipe.id] = set(static_deps)
+        self.dynamic_deps[recipe.id] = set(dynamic_deps)
+        for packageconfig, deps in packageconfig_deps:
+            self.packageconfig_deps[packageconfig.id] = set(deps)
+
+    def set_inherits(self, recipe, inherits):
+        self.inherits[recipe.id] = set(inherits)
+
+    def set_new_filedeps(self, recipe, filedeps):
+        self.filedeps[recipe.id] = filedeps
+
+    def set_external_filedeps(self, recipe, paths):
+        self.external_filedeps[recipe.id] = set(paths)
+
+    def add_profile(self, recipe, parse_time, write_time, peak_memory):
+        # Keep the recipe object since new recipes may not have been saved yet
+        self.profiles.append((recipe, parse_time, write_time, peak_memory))
+
+    def _get_name_ids(self, model, names):
+        # Not using get_or_create() here since other layers may be being updated in
+        # parallel, and nothing prevents more than one record with the same name
+        # being created if they race - so always use the first one
+        def query(names):
+            ids = {}
+            for chunk in chunks(names):
+                for name, depid in model.objects.filter(name__in=chunk).order_by('-id').values_list('name', 'id'):
+                    ids[name] = depid
+            return ids
+        ids = query(names)
+        missing = set(names) - set(ids)
+        if missing:
+            model.objects.bulk_create([model(name=name) for name in sorted(missing)])
+            ids.update(query(missing))
+        return ids
+
+    def _update_links(self, through, fromfield, tofield, wanted, dep_ids):
+        """
+        Make the rows in the through table for the specified objects (fromfield)
+        link them to the named records (tofield) and nothing else
+        """
+        wanted_rows = set()
+        for fromid, names in wanted.items():
+            for name in names:
+                wanted_rows.add((fromid, dep_ids[name]))
+        delete_ids = []
+        for chunk in chunks(wanted.keys()):
+            for rowid, fromid, toid in through.objects.filter(**{'%s__in' % fromfield: chunk}).values_list('id', fromfield, tofield):
+                if (fromid, toid) in wanted_rows:
+                    wanted_rows.remove((fromid, toid))
+                else:
+                    delete_ids.append(rowid)
+        for chunk in chunks(delete_ids):
+            through.objects.filter(id__in=chunk).delete()
+        through.objects.bulk_create([through(**{fromfield: fromid, tofield: toid}) for fromid, toid in wanted_rows])
+
+    def flush(self):
+        """Write out all of the collected data"""
+        from layerindex.models import StaticBuildDep, DynamicBuildDep, InheritedClass, RecipeFileDependency, RecipeExternalFileDependency, RecipeParseProfile
+
+        if self.static_deps:
+            names = set(itertools.chain(*self.static_deps.values()))
+            dep_ids = self._get_name_ids(StaticBuildDep, names)
+            self._update_links(StaticBuildDep.recipes.through, 'recipe_id', 'staticbuilddep_id', self.static_deps, dep_ids)
+        if self.dynamic_deps or self.packageconfig_deps:
+            names = set(itertools.chain(*itertools.chain(self.dynamic_deps.values(), self.packageconfig_deps.values())))
+            dep_ids = self._get_name_ids(DynamicBuildDep, names)
+            self._update_links(DynamicBuildDep.recipes.through, 'recipe_id', 'dynamicbuilddep_id', self.dynamic_deps, dep_ids)
+            self._update_links(DynamicBuildDep.package_configs.through, 'packageconfig_id', 'dynamicbuilddep_id', self.packageconfig_deps, dep_ids)
+        if self.inherits:
+            names = set(itertools.chain(*self.inherits.values()))
+            class_ids = self._get_name_ids(InheritedClass, names)
+            self._update_links(InheritedClass.recipes.through, 'recipe_id', 'inheritedclass_id', self.inherits, class_ids)
+        filedeps = []
+        for recipe_filedeps in self.filedeps.values():
+            filedeps.extend(recipe_filedeps)
+        RecipeFileDependency.objects.bulk_create(filedeps)
+        if self.external_filedeps:
+            wanted = set()
+            for recipe_id, paths in self.external_filedeps.items():
+                for path in paths:
+                    wanted.add((recipe_id, path))
+            delete_ids = []
+            for chunk in chunks(self.external_filedeps.keys()):
+                for depid, recipe_id, path in RecipeExternalFileDependency.objects.filter(recipe_id__in=chunk).values_list('id', 'recipe_id', 'path'):
+                    if (recipe_id, path) in wanted:
+                        wanted.remove((recipe_id, path))
+                    else:
+                        delete_ids.append(depid)
+            for chunk in chunks(delete_ids):
+                RecipeExternalFileDependency.objects.filter(id__in=chunk).delete()
+            RecipeExternalFileDependency.objects.bulk_create([RecipeExternalFileDependency(recipe_id=recipe_id, path=path) for recipe_id, path in wanted])
+        if self.profiles:
+            now = datetime.now()
+            profiles = []
+            for recipe, parse_time, write_time, peak_memory in self.profiles:
+                if recipe.id:
+                    profiles.append(RecipeParseProfile(recipe_id=recipe.id, parsed=now, parse_time=parse_time, write_time=write_time, peak_memory=peak_memory))
+            RecipeParseProfile.objects.bulk_create(profiles)
+            self.profiles = []
+
+class RecipeFileDependencyIndex:
+    """
+    Reverse index of the RecipeFileDependency records for a layer branch,
+    mapping each file path (relative to the repository) to the recipes
+    that depend upon it. Loaded with a single query.
+    """
+    def __init__(self, layerbranch):
+        from layerindex.models import RecipeFileDependency
+        self.recipe_ids = {}
+        for path, recipe_id in RecipeFileDependency.objects.filter(layerbranch=layerbranch).values_list('path', 'recipe_id'):
+            self.recipe_ids.setdefault(path, set()).add(recipe_id)
+
+    def get_recipe_ids(self, paths):
+        """Get the IDs of all recipes depending upon any of the specified paths"""
+        recipe_ids = set()
+        for path in paths:
+            recipe_ids.update(self.recipe_ids.get(path, []))
+        return recipe_ids
+
+class RecipeParseCache:
+    """
+    Persistent cache of the data extracted from the recipes in a layer (see
+    get_recipe_data()), so that a recipe doesn't need to be parsed again
+    (e.g. when reloading) unless the recipe itself, any of the files it
+    depends upon, the configuration or the revision of BitBake / the core
+    layer have changed. Stored as a JSON file per layer branch.
+    """
+    # Increment this if the format of the data changes
+    version = 1
+
+    def __init__(self, cachedir, layerbranch, config_data, revisions):
+        self.fn = os.path.join(cachedir, 'layerbranch-%d.json' % layerbranch.id)
+        self.filehashes = {}
+        configdeps = set([depstr for depstr, _ in (config_data.getVar('__depends', True) or [])])
+        confighash = hashlib.sha256()
+        confighash.update(json.dumps([self.version, revisions, config_data.getVar('BBPATH', True), config_data.getVar('BBFILE_COLLECTIONS', True)]).encode('utf-8'))
+        for path in sorted(configdeps):
+            confighash.update(('%s\0%s\0' % (path, self._get_file_hash(path))).encode('utf-8'))
+        self.confighash = confighash.hexdigest()
+        self.entries = {}
+        self.hits = 0
+        try:
+            with open(self.fn, 'r') as f:
+                cachedata = json.load(f)
+            if cachedata.get('confighash', None) == self.confighash:
+                self.entries = cachedata['entries']
+            else:
+                logger.debug('Configuration changed, ignoring parse cache %s' % self.fn)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.warning('Ignoring invalid parse cache %s: %s' % (self.fn, str(e)))
+
+    def _get_file_hash(self, path):
+        # Files shouldn't change during the update, so only hash each one once
+        filehash = self.filehashes.get(path, None)
+        if filehash is None:
+            try:
+                with open(path, 'rb') as f:
+                    filehash = hashlib.sha256(f.read()).hexdigest()
+            except (FileNotFoundError, NotADirectoryError):
+                # Missing files are recorded in __depends too (e.g. for
+                # include), since the result changes if they appear
+                filehash = ''
+            self.filehashes[path] = filehash
+        return filehash
+
+    def _get_hash(self, fn, depends):
+        recipehash = hashlib.sha256(self.confighash.encode('utf-8'))
+        for path in [fn] + depends:
+            recipehash.update(('%s\0%s\0' % (path, self._get_file_hash(path))).encode('utf-8'))
+        return recipehash.hexdigest()
+
+    def get(self, fn, skip_patches=False):
+        """Get the cached data for the specified recipe file, or None if it needs to be parsed"""
+        entry = self.entries.get(fn, None)
+        if not entry:
+            return None
+        if entry['data']['patches'] is None and not skip_patches:
+            return None
+        if self._get_hash(fn, entry['depends']) != entry['hash']:
+            return None
+        self.hits += 1
+        return entry['data']
+
+    def set(self, fn, recipedata):
+        depends = sorted(set(recipedata['file_depends']) - set([fn]))
+        self.entries[fn] = {'hash': self._get_hash(fn, depends), 'depends': depends, 'data': recipedata}
+
+    def save(self):
+        # Drop entries for recipes that no longer exist
+        for fn in list(self.entries.keys()):
+            if not os.path.exists(fn):
+                del self.entries[fn]
+        os.makedirs(os.path.dirname(self.fn), exist_ok=True)
+        with open(self.fn + '.temp', 'w') as f:
+            json.dump({'confighash': self.confighash, 'entries': self.entries}, f)
+        os.rename(self.fn + '.temp', self.fn)
+
+class UpdateEvents:
+    """
+    Keeps track of progress and how long each phase takes while updating a
+    layer. If enabled (i.e. in worker mode), these are also written to stdout
+    as utils.UPDATE_WORKER_EVENT lines for update.py to pick up.
+    """
+    # Minimum interval between progress events
+    progress_interval = 1
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.timings = {}
+        self.parsed = 0
+        self.total = None
+        self.last_progress = 0
+
+    def emit(self, event, **kwargs):
+        if not self.enabled:
+            return
+        kwargs['event'] = event
+        # Make sure the event doesn't end up in the middle of other output
+        sys.stderr.flush()
+        sys.stdout.flush()
+        print('%s %s' % (utils.UPDATE_WORKER_EVENT, json.dumps(kwargs)))
+        sys.stdout.flush()
+
+    def add_time(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        """Time the enclosed block, reporting it when it finishes"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            self.add_time(phase, seconds)
+            self.emit('phase', phase=phase, seconds=seconds)
+
+    def set_total(self, total):
+        """Set the total number of recipes expected to be parsed (if known)"""
+        self.total = total
+        self.progress(force=True)
+
+    def recipe_parsed(self, seconds):
+        self.parsed += 1
+        self.add_time('parse', seconds)
+        self.progress()
+
+    def progress(self, force=False):
+        now = time.time()
+        if force or now - self.last_progress >= self.progress_interval:
+            self.last_progress = now
+            self.emit('progress', parsed=self.parsed, total=self.total)
+
+    def finish(self):
+        """Report the total parse time (which accumulates over many recipes)"""
+        self.progress(force=True)
+        if 'parse' in self.timings:
+            self.emit('phase', phase='parse', seconds=self.timings['parse'])
+        logger.debug('Recipes parsed: %d, timings: %s' % (self.parsed, ', '.join(['%s %.1fs' % (phase, self.timings[phase]) for phase in utils.UPDATE_PHASES if phase in self.timings])))
+
+def get_recipe_data(envdata, data, skip_patches=False):
+    """
+    Extract the values we need from the parsed data for a recipe into a
+    dict, which can be stored in a RecipeParseCache
+    """
+    configdeps = set([depstr for depstr, _ in (data.getVar('__depends', True) or [])])
+    pn = envdata.getVar("PN", True)
+    # Handle recipe inherits for this recipe
+    gr = set(data.getVar("__inherit_cache", True) or [])
+    lr = set(envdata.getVar("__inherit_cache", True) or [])
+    recipedata = {
+        'pn': pn,
+        'pv': envdata.getVar("PV", True),
+        'summary': envdata.getVar("SUMMARY", True),
+        'description': envdata.getVar("DESCRIPTION", True),
+        'section': envdata.getVar("SECTION", True),
+        'license': envdata.getVar("LICENSE", True),
+        'homepage': envdata.getVar("HOMEPAGE", True),
+        'bugtracker': envdata.getVar("BUGTRACKER", True) or "",
+        'provides': envdata.getVar("PROVIDES", True) or "",
+        'bbclassextend': envdata.getVar("BBCLASSEXTEND", True) or "",
+        'blacklisted': envdata.getVarFlag('PNBLACKLIST', pn, True) or "",
+        'inherits': sorted({os.path.splitext(os.path.basename(r))[0] for r in lr if r not in gr}),
+        'depends': (envdata.getVar("DEPENDS", True) or "").split(),
+        'src_uri': (envdata.getVar('SRC_URI', True) or '').split(),
+        'packageconfig': dict([(key, value) for key, value in (envdata.getVarFlags("PACKAGECONFIG") or {}).items() if key != 'doc']),
+        # Files that are part of the configuration are left out, since
+        # they're the same for every recipe
+        'file_depends': [depstr for depstr, _ in (envdata.getVar('__depends', True) or []) if depstr not in configdeps],
+        'patches': None,
+    }
+    if not skip_patches:
+        try:
+            import oe.recipeutils
+        except ImportError:
+            logger.warn('Failed to find lib/oe/recipeutils.py in layers - patches will not be imported')
+        else:
+            recipedata['patches'] = oe.recipeutils.get_recipe_patches(envdata)
+    return recipedata
+
+def update_recipe_file(tinfoil, data, path, recipe, layerdir_start, repodir, stop_on_error, skip_patches=False, batch=None, events=None, parsecache=None):
+    """
+    Parse a recipe and update its record and related data. If batch (a
+    RecipeDataBatch) is specified, build dependencies, inherits and file
+    dependencies are added to it
+    to be written out later; otherwise they are written out immediately.
+    If events (an UpdateEvents object) is specified, the time taken is
+    recorded against it. If batch.profile is True, the time taken to parse
+    the recipe and write its data, and the peak memory allocated while
+    parsing, are also recorded in the batch. If parsecache (a
+    RecipeParseCache) is specified, the recipe is only parsed if it isn't
+    in the cache.
+    """
     from django.db import DatabaseError
 
     fn = str(os.path.join(path, recipe.filename))
-    from layerindex.models import PackageConfig, StaticBuildDep, DynamicBuildDep, Source, Patch
+    from layerindex.models import PackageConfig, Source, Patch
+    profile = batch is not None and batch.profile
+    parse_end = None
+    peak_memory = 0
+    cached = False
+    start = time.time()
     try:
         logger.debug('Updating recipe %s' % fn)
-        if hasattr(tinfoil, 'parse_recipe_file'):
-            envdata = tinfoil.parse_recipe_file(fn, appends=False, config_data=data)
+        recipedata = None
+        if parsecache:
+            recipedata = parsecache.get(fn, skip_patches)
+        if recipedata is None:
+            if profile:
+                tracemalloc.start()
+            if hasattr(tinfoil, 'parse_recipe_file'):
+                envdata = tinfoil.parse_recipe_file(fn, appends=False, config_data=data)
+            else:
+                envdata = bb.cache.Cache.loadDataFull(fn, [], data)
+            parse_end = time.time()
+            if profile:
+                _, peak_memory = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            envdata.setVar('SRCPV', 'X')
+            recipedata = get_recipe_data(envdata, data, skip_patches)
+            if parsecache:
+                parsecache.set(fn, recipedata)
         else:
-            envdata = bb.cache.Cache.loadDataFull(fn, [], data)
-        envdata.setVar('SRCPV', 'X')
-        recipe.pn = envdata.getVar("PN", True)
-        recipe.pv = envdata.getVar("PV", True)
-        recipe.summary = envdata.getVar("SUMMARY", True)
-        recipe.description = envdata.getVar("DESCRIPTION", True)
-        recipe.section = envdata.getVar("SECTION", True)
-        recipe.license = envdata.getVar("LICENSE", True)
-        recipe.homepage = envdata.getVar("HOMEPAGE", True)
-        recipe.bugtracker = envdata.getVar("BUGTRACKER", True) or ""
-        recipe.provides = envdata.getVar("PROVIDES", True) or ""
-        recipe.bbclassextend = envdata.getVar("BBCLASSEXTEND", True) or ""
-        # Handle recipe inherits for this recipe
-        gr = set(data.getVar("__inherit_cache", True) or [])
-        lr = set(envdata.getVar("__inherit_cache", True) or [])
-        recipe.inherits = ' '.join(sorted({os.path.splitext(os.path.basename(r))[0] for r in lr if r not in gr}))
-        recipe.blacklisted = envdata.getVarFlag('PNBLACKLIST', recipe.pn, True) or ""
+            logger.debug('Using cached parse results for %s' % fn)
+            cached = True
+        recipe.pn = recipedata['pn']
+        recipe.pv = recipedata['pv']
+        recipe.summary = recipedata['summary']
+        recipe.description = recipedata['description']
+        recipe.section = recipedata['section']
+        recipe.license = recipedata['license']
+        recipe.homepage = recipedata['homepage']
+        recipe.bugtracker = recipedata['bugtracker']
+        recipe.provides = recipedata['provides']
+        recipe.bbclassextend = recipedata['bbclassextend']
+        recipe.inherits = ' '.join(recipedata['inherits'])
+        recipe.blacklisted = recipedata['blacklisted']
         recipe.save()
 
+        if batch:
+            recipebatch = batch
+        else:
+            recipebatch = RecipeDataBatch()
+
+        recipebatch.set_inherits(recipe, recipedata['inherits'])
+
         # Handle static build dependencies for this recipe
-        static_dependencies = envdata.getVar("DEPENDS", True) or ""
-        for dep in static_dependencies.split():
-            static_build_dependency, created = StaticBuildDep.objects.get_or_create(name=dep)
-            if created:
-                static_build_dependency.save()
-            static_build_dependency.recipes.add(recipe)
+        static_dependencies = recipedata['depends']
 
         # Handle sources
         old_urls = list(recipe.source_set.values_list('url', flat=True))
-        for url in (envdata.getVar('SRC_URI', True) or '').split():
+        new_sources = []
+        for url in recipedata['src_uri']:
             if not url.startswith('file://'):
                 url = url.split(';')[0]
                 if url in old_urls:
                     old_urls.remove(url)
                 else:
-                    src = Source(recipe=recipe, url=url)
-                    src.save()
-        for url in old_urls:
-            recipe.source_set.filter(url=url).delete()
+                    new_sources.append(Source(recipe=recipe, url=url))
+        if old_urls:
+            recipe.source_set.filter(url__in=old_urls).delete()
+        Source.objects.bulk_create(new_sources)
 
         # Handle the PACKAGECONFIG variables for this recipe
-        PackageConfig.objects.filter(recipe=recipe).delete()
-        package_config_VarFlags = envdata.getVarFlags("PACKAGECONFIG")
-        for key, value in package_config_VarFlags.items():
-            if key == "doc":
-                continue
+        old_package_configs = {}
+        package_configs_delete = []
+        for package_config in recipe.packageconfig_set.all():
+            if package_config.feature in old_package_configs:
+                package_configs_delete.append(package_config.id)
+            else:
+                old_package_configs[package_config.feature] = package_config
+        new_package_configs = []
+        dynamic_dependencies = set()
+        for key, value in recipedata['packageconfig'].items():
             package_config = PackageConfig()
             package_config.feature = key
             package_config.recipe = recipe
@@ -198,25 +610,36 @@ def update_recipe_file(tinfoil, data, path, recipe, layerdir_start, repodir, sto
                 package_config.without_option = package_config_vals[1]
             except IndexError:
                 pass
-            package_config.save()
             # Handle the dynamic dependencies for the PACKAGECONFIG variable
-            if package_config.build_deps:
-                for dep in package_config.build_deps.split():
-                    dynamic_build_dependency, created = DynamicBuildDep.objects.get_or_create(name=dep)
-                    if created:
-                        dynamic_build_dependency.save()
-                    dynamic_build_dependency.package_configs.add(package_config)
-                    dynamic_build_dependency.recipes.add(recipe)
-
-        if not skip_patches:
+            dynamic_dependencies.update(package_config.build_deps.split())
+            old_package_config = old_package_configs.get(key, None)
+            if old_package_config and (old_package_config.with_option, old_package_config.without_option, old_package_config.build_deps) == (package_config.with_option, package_config.without_option, package_config.build_deps):
+                # Unchanged, keep the existing record (and its dependencies)
+                del old_package_configs[key]
+            else:
+                new_package_configs.append(package_config)
+        package_configs_delete.extend([pc.id for pc in old_package_configs.values()])
+        if package_configs_delete:
+            PackageConfig.objects.filter(id__in=package_configs_delete).delete()
+        package_config_deps = []
+        if new_package_configs:
+            PackageConfig.objects.bulk_create(new_package_configs)
+            # Not all database backends set the id on bulk_create(), so look them up
+            new_ids = dict(recipe.packageconfig_set.filter(feature__in=[pc.feature for pc in new_package_configs]).values_list('feature', 'id'))
+            for package_config in new_package_configs:
+                package_config.id = new_ids[package_config.feature]
+                package_config_deps.append((package_config, package_config.build_deps.split()))
+        recipebatch.set_build_deps(recipe, static_dependencies, dynamic_dependencies, package_config_deps)
+
+        if not skip_patches and recipedata['patches'] is not None:
             # Handle patches
-            collect_patches(recipe, envdata, layerdir_start, stop_on_error)
+            collect_patches(recipe, recipedata['patches'], layerdir_start, stop_on_error)
 
-        # Get file dependencies within this layer
-        deps = envdata.getVar('__depends', True)
+        # Get file dependencies within this layer (including any of the
+        # configuration files, which get_recipe_data() leaves out)
+        configdeps = set([depstr for depstr, _ in (data.getVar('__depends', True) or [])])
         filedeps = []
-        for depstr, date in deps:
-            found = False
+        for depstr in itertools.chain(recipedata['file_depends'], sorted(configdeps)):
             if depstr.startswith(layerdir_start) and not depstr.endswith('/conf/layer.conf'):
                 filedeps.append(os.path.relpath(depstr, repodir))
         from layerindex.models import RecipeFileDependency
@@ -229,6 +652,7 @@ def update_recipe_file(tinfoil, data, path, recipe, layerdir_start, repodir, sto
             if 'path' in values:
                 recipedeps_delete.append(values['path'])
 
+        recipedeps_add = []
         for filedep in filedeps:
             if filedep in recipedeps_delete:
                 recipedeps_delete.remove(filedep)
@@ -238,10 +662,24 @@ def update_recipe_file(tinfoil, data, path, recipe, layerdir_start, repodir, sto
             recipedep.layerbranch = recipe.layerbranch
             recipedep.recipe = recipe
             recipedep.path = filedep
-            recipedep.save()
+            recipedeps_add.append(recipedep)
+        recipebatch.set_new_filedeps(recipe, recipedeps_add)
+
+        if recipedeps_delete:
+            recipedeps.filter(path__in=recipedeps_delete).delete()
 
-        for filedep in recipedeps_delete:
-            recipedeps.filter(path=filedep).delete()
+        # Get file dependencies in other layers, so that the recipe can be
+        # reparsed when they change. Files that are part of the configuration
+        # are excluded, since every recipe depends upon those.
+        fetchdir_start = os.path.join(os.path.dirname(os.path.normpath(repodir)), '')
+        externaldeps = set()
+        for depstr in recipedata['file_depends']:
+            if depstr.startswith(fetchdir_start) and not depstr.startswith(layerdir_start):
+                externaldeps.add(os.path.relpath(depstr, fetchdir_start))
+        recipebatch.set_external_filedeps(recipe, externaldeps)
+
+        if not batch:
+            recipebatch.flush()
 
     except KeyboardInterrupt:
         raise
@@ -254,6 +692,19 @@ def update_recipe_file(tinfoil, data, path, recipe, layerdir_start, repodir, sto
             if not recipe.pn:
                 recipe.pn = recipe.filename[:-3].split('_')[0]
             logger.error("Unable to read %s: %s", fn, str(e))
+    finally:
+        end = time.time()
+        if events:
+            events.recipe_parsed(end - start)
+        if profile and not cached:
+            if tracemalloc.is_tracing():
+                # Parsing failed
+                _, peak_memory = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            if parse_end is None:
+                batch.add_profile(recipe, end - start, 0, peak_memory)
+            else:
+                batch.add_profile(recipe, parse_end - start, end - parse_end, peak_memory)
 
 def update_machine_conf_file(path, machine):
     logger.debug('Updating machine %s' % path)
@@ -323,6 +774,12 @@ def main():
     parser.add_option("", "--stop-on-error",
             help = "Stop on first parsing error",
             action="store_true", default=False, dest="stop_on_error")
+    parser.add_option("", "--profile",
+            help = "Record the time taken and peak memory used to parse each recipe (see tools/parse_profile_report.py)",
+            action="store_true", dest="profile")
+    parser.add_option("", "--reparse",
+            help = "Reparse the specified recipes (IDs, separated by commas) even if the layer hasn't changed",
+            action="store", dest="reparse", default='')
     parser.add_option("-i", "--initial",
             help = "Print initial values parsed from layer.conf only",
             action="store_true")
@@ -335,6 +792,9 @@ def main():
     parser.add_option("", "--keep-temp",
             help = "Preserve temporary directory at the end instead of deleting it",
             action="store_true")
+    parser.add_option("", "--worker",
+            help = "Run as a worker, updating each layer named on stdin (one per line, as JSON) and reusing the same parser",
+            action="store_true")
 
     options, args = parser.parse_args(sys.argv)
     if len(args) > 1:
@@ -347,8 +807,6 @@ def main():
 
     utils.setup_django()
     import settings
-    from layerindex.models import LayerItem, LayerBranch, Recipe, RecipeFileDependency, Machine, Distro, BBAppend, BBClass
-    from django.db import transaction
 
     logger.setLevel(options.loglevel)
 
@@ -362,13 +820,136 @@ def main():
         logger.error("Please set LAYER_FETCH_DIR in settings.py")
         sys.exit(1)
 
+    if options.worker:
+        run_worker(options, settings, branch)
+    else:
+        try:
+            update_layer(options, settings, branch)
+        finally:
+            shutdown_parser(options)
+    sys.exit(0)
+
+
+def run_worker(options, settings, branch):
+    """
+    Update each layer requested on stdin in turn, keeping the parser around
+    between layers so that we only pay the cost of initialising it once. After
+    each layer a line starting with utils.UPDATE_WORKER_DONE followed by the
+    exit code that a separate update_layer.py process would have returned is
+    written to stdout.
+    """
+    from django.db import close_old_connections
+    import json
+    import copy
+
+    try:
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            joboptions = copy.copy(options)
+            joboptions.layer = job['layer']
+            joboptions.initial = job.get('initial', False)
+            joboptions.reparse = ','.join([str(recipe_id) for recipe_id in job.get('reparse', [])])
+            close_old_connections()
+            try:
+                update_layer(joboptions, settings, branch)
+                ret = 0
+            except SystemExit as e:
+                if e.code is None:
+                    ret = 0
+                elif isinstance(e.code, int):
+                    ret = e.code
+                else:
+                    ret = 1
+            except KeyboardInterrupt:
+                ret = 254
+            sys.stderr.flush()
+            sys.stdout.flush()
+            print('%s %d' % (utils.UPDATE_WORKER_DONE, ret))
+            sys.stdout.flush()
+            if ret == 254:
+                # Interrupted by user, don't try to do anything else
+                break
+    finally:
+        shutdown_parser(options)
+
+
+def get_core_revisions(settings, branch, bitbakepath):
+    """Get the revisions of BitBake and the core layer that are checked out"""
+    revisions = [git.Repo(bitbakepath).head.commit.hexsha]
+    core_layer = utils.get_layer(settings.CORE_LAYER_NAME)
+    if core_layer:
+        core_repodir = os.path.join(utils.get_layer_checkout_dir(settings, branch.name), core_layer.get_fetch_dir())
+        revisions.append(git.Repo(core_repodir).head.commit.hexsha)
+    return revisions
+
+
+_parser = None
+
+def get_parser(settings, branch, bitbakepath, options):
+    """
+    Get the (tinfoil, tempdir) tuple for parsing, initialising the parser
+    on first use.
+    """
+    global _parser
+    if not _parser:
+        _parser = recipeparse.init_parser(settings, branch, bitbakepath, nocheckout=options.nocheckout, logger=logger)
+        tinfoil = _parser[0]
+        logger.debug('Using temp directory %s' % _parser[1])
+        # Clear the default value of SUMMARY so that we can use DESCRIPTION instead if it hasn't been set
+        tinfoil.config_data.setVar('SUMMARY', '')
+        # Clear the default value of DESCRIPTION so that we can see where it's not set
+        tinfoil.config_data.setVar('DESCRIPTION', '')
+        # Clear the default value of HOMEPAGE ('unknown')
+        tinfoil.config_data.setVar('HOMEPAGE', '')
+        # Set a blank value for LICENSE so that it doesn't cause the parser to die (e.g. with meta-ti -
+        # why won't they just fix that?!)
+        tinfoil.config_data.setVar('LICENSE', '')
+    return _parser
+
+def shutdown_parser(options):
+    global _parser
+    if not _parser:
+        return
+    (tinfoil, tempdir) = _parser
+    _parser = None
+    if LooseVersion(bb.__version__) > LooseVersion("1.27"):
+        tinfoil.shutdown()
+    if options.keep_temp:
+        logger.debug('Preserving temp directory %s' % tempdir)
+    else:
+        logger.debug('Deleting temp directory')
+        shutil.rmtree(tempdir, onerror=rm_tempdir_onerror)
+
+
+def update_layer(options, settings, branch):
+    from layerindex.models import LayerItem, LayerBranch, Recipe, Machine, Distro, BBAppend, BBClass
+    from django.db import transaction
+
+    fetchdir = settings.LAYER_FETCH_DIR
     bitbakepath = os.path.join(fetchdir, 'bitbake')
 
     layer = utils.get_layer(options.layer)
+    if not layer:
+        logger.error("Specified layer %s is not valid" % options.layer)
+        sys.exit(1)
     urldir = layer.get_fetch_dir()
-    repodir = os.path.join(fetchdir, urldir)
+    gitdir = os.path.join(fetchdir, urldir)
+    # Where the layer is checked out (not the same as gitdir if using worktrees)
+    layerfetchdir = utils.get_layer_checkout_dir(settings, branch.name)
+    repodir = os.path.join(layerfetchdir, urldir)
+    if options.nocheckout and not os.path.exists(repodir):
+        # Nothing has checked the branch out into a worktree yet, so use
+        # whatever is checked out in the repository (as update.py does)
+        repodir = gitdir
 
     layerbranch = layer.get_layerbranch(options.branch)
+    events = UpdateEvents(enabled=options.worker)
 
     branchname = options.branch
     branchdesc = options.branch
@@ -378,14 +959,12 @@ def main():
             branchdesc = "%s (%s)" % (options.branch, branchname)
 
     # Collect repo info
-    repo = git.Repo(repodir)
+    repo = git.Repo(gitdir)
     assert repo.bare == False
     topcommit = repo.commit('origin/%s' % branchname)
     if options.nocheckout:
-        topcommit = repo.commit('HEAD')
+        topcommit = git.Repo(repodir).commit('HEAD')
 
-    tinfoil = None
-    tempdir = None
     try:
         with transaction.atomic():
             newbranch = False
@@ -409,9 +988,18 @@ def main():
                         maintainer.save()
 
             if layerbranch.vcs_subdir and not options.nocheckout:
-                # Find latest commit in subdirectory
-                # A bit odd to do it this way but apparently there's no other way in the GitPython API
-                topcommit = next(repo.iter_commits('origin/%s' % branchname, paths=layerbranch.vcs_subdir), None)
+                # The hash is empty if the subdirectory doesn't exist (and
+                # vcs_last_tree may not have been recorded yet), in which case
+                # we need to look through the history to find out what happened
+                treehash = utils.get_layer_tree_hash(topcommit, layerbranch.vcs_subdir)
+                if layerbranch.vcs_last_rev and treehash and layerbranch.vcs_last_tree == treehash:
+                    # Nothing in the subdirectory has changed, so neither has
+                    # the latest commit touching it
+                    topcommit = repo.commit(layerbranch.vcs_last_rev)
+                else:
+                    # Find latest commit in subdirectory
+                    # A bit odd to do it this way but apparently there's no other way in the GitPython API
+                    topcommit = next(repo.iter_commits('origin/%s' % branchname, paths=layerbranch.vcs_subdir), None)
 
             layerdir = os.path.join(repodir, layerbranch.vcs_subdir)
             layerdir_start = os.path.normpath(layerdir) + os.sep
@@ -421,33 +1009,30 @@ def main():
             layerdistros = Distro.objects.filter(layerbranch=layerbranch)
             layerappends = BBAppend.objects.filter(layerbranch=layerbranch)
             layerclasses = BBClass.objects.filter(layerbranch=layerbranch)
-            if layerbranch.vcs_last_rev != topcommit.hexsha or options.reload or options.initial:
+            # Recipes using files in other layers that have changed
+            reparse_ids = set([int(recipe_id) for recipe_id in options.reparse.split(',') if recipe_id])
+            if layerbranch.vcs_last_rev != topcommit.hexsha or options.reload or options.initial or reparse_ids:
+                # Note the recipe names before updating so that we can
+                # recalculate preferred counts for any that get removed
+                old_pns = set(layerrecipes.values_list('pn', flat=True))
+
                 # Check out appropriate branch
                 if not options.nocheckout:
-                    utils.checkout_layer_branch(layerbranch, repodir, logger=logger)
+                    with events.phase('checkout'):
+                        utils.checkout_layer_branch(layerbranch, gitdir, logger=logger, worktreedir=repodir)
 
                 logger.info("Collecting data for layer %s on branch %s" % (layer.name, branchdesc))
                 try:
-                    (tinfoil, tempdir) = recipeparse.init_parser(settings, branch, bitbakepath, nocheckout=options.nocheckout, logger=logger)
+                    with events.phase('tinfoil'):
+                        (tinfoil, tempdir) = get_parser(settings, branch, bitbakepath, options)
                 except recipeparse.RecipeParseError as e:
                     logger.error(str(e))
                     sys.exit(1)
-                logger.debug('Using temp directory %s' % tempdir)
-                # Clear the default value of SUMMARY so that we can use DESCRIPTION instead if it hasn't been set
-                tinfoil.config_data.setVar('SUMMARY', '')
-                # Clear the default value of DESCRIPTION so that we can see where it's not set
-                tinfoil.config_data.setVar('DESCRIPTION', '')
-                # Clear the default value of HOMEPAGE ('unknown')
-                tinfoil.config_data.setVar('HOMEPAGE', '')
-                # Set a blank value for LICENSE so that it doesn't cause the parser to die (e.g. with meta-ti -
-                # why won't they just fix that?!)
-                tinfoil.config_data.setVar('LICENSE', '')
 
                 layerconfparser = layerconfparse.LayerConfParse(logger=logger, tinfoil=tinfoil)
                 layer_config_data = layerconfparser.parse_layer(layerdir)
                 if not layer_config_data:
                     logger.info("Skipping update of layer %s for branch %s - conf/layer.conf may have parse issues" % (layer.name, branchdesc))
-                    layerconfparser.shutdown()
                     sys.exit(1)
                 utils.set_layerbranch_collection_version(layerbranch, layer_config_data, logger=logger)
                 if options.initial:
@@ -467,46 +1052,64 @@ def main():
 
                 utils.add_dependencies(layerbranch, layer_config_data, logger=logger)
                 utils.add_recommends(layerbranch, layer_config_data, logger=logger)
-                layerbranch.save()
+                # Record what we read from layer.conf so that update.py doesn't
+                # need to parse it again until it changes
+                layerbranch.layerconf_hash = utils.get_layerconf_hash(topcommit, layerbranch.vcs_subdir)
+                layerbranch.layerconf_depends = utils.get_layer_var(layer_config_data, 'LAYERDEPENDS', logger)
+                layerbranch.layerconf_recommends = utils.get_layer_var(layer_config_data, 'LAYERRECOMMENDS', logger)
+                # The dependencies may have just changed
+                layerbranch.save(update_fields=LayerBranch.fields_except_closure())
 
                 try:
-                    config_data_copy = recipeparse.setup_layer(tinfoil.config_data, fetchdir, layerdir, layer, layerbranch, logger)
+                    with events.phase('tinfoil'):
+                        config_data_copy = recipeparse.setup_layer(tinfoil.config_data, layerfetchdir, layerdir, layer, layerbranch, logger)
                 except recipeparse.RecipeParseError as e:
                     logger.error(str(e))
                     sys.exit(1)
 
+                parsecachedir = getattr(settings, 'PARSE_CACHE_DIR', '')
+                if parsecachedir:
+                    parsecache = RecipeParseCache(parsecachedir, layerbranch, config_data_copy, get_core_revisions(settings, branch, bitbakepath))
+                else:
+                    parsecache = None
+
                 if layerbranch.vcs_last_rev and not options.reload:
                     try:
-                        diff = repo.commit(layerbranch.vcs_last_rev).diff(topcommit)
+                        with events.phase('diff'):
+                            diff = repo.commit(layerbranch.vcs_last_rev).diff(topcommit)
                     except Exception as e:
                         logger.warn("Unable to get diff from last commit hash for layer %s - falling back to slow update: %s" % (layer.name, str(e)))
                         diff = None
                 else:
                     diff = None
 
+                # Dependency records for the recipes we update are written out
+                # together at the end
+                batch = RecipeDataBatch(profile=options.profile)
+
                 # We handle recipes specially to try to preserve the same id
                 # when recipe upgrades happen (so that if a user bookmarks a
                 # recipe page it remains valid)
                 layerrecipes_delete = []
                 layerrecipes_add = []
 
-                # Check if any paths should be ignored because there are layers within this layer
-                removedirs = []
-                for root, dirs, files in os.walk(layerdir):
-                    for diritem in dirs:
-                        if os.path.exists(os.path.join(root, diritem, 'conf', 'layer.conf')):
-                            removedirs.append(os.path.join(root, diritem) + os.sep)
+                if layerbranch.vcs_subdir:
+                    subdir_start = os.path.normpath(layerbranch.vcs_subdir) + os.sep
+                else:
+                    subdir_start = ""
 
-                if diff:
-                    # Apply git changes to existing recipe list
+                # List the files in the layer as of the revision we're updating
+                # to (excluding any layers within this layer), and check which
+                # paths should be ignored because they are in those layers
+                (layerfiles, sublayers) = utils.list_layer_files(layerdir, topcommit.hexsha, logger=logger)
+                removedirs = [subdir_start + sublayer for sublayer in sublayers]
 
-                    if layerbranch.vcs_subdir:
-                        subdir_start = os.path.normpath(layerbranch.vcs_subdir) + os.sep
-                    else:
-                        subdir_start = ""
+                if diff is not None:
+                    # Apply git changes to existing recipe list
 
                     updatedrecipes = set()
-                    dirtyrecipes = set()
+                    # Paths of changed files that recipes may depend upon
+                    dirtypaths = set()
                     other_deletes = []
                     other_adds = []
                     for diffitem in diff.iter_change_type('R'):
@@ -542,7 +1145,7 @@ def main():
                                     recipe.filepath = newfilepath
                                     recipe.filename = newfilename
                                     recipe.save()
-                                    update_recipe_file(tinfoil, config_data_copy, os.path.join(layerdir, newfilepath), recipe, layerdir_start, repodir, options.stop_on_error, skip_patches)
+                                    update_recipe_file(tinfoil, config_data_copy, os.path.join(layerdir, newfilepath), recipe, layerdir_start, repodir, options.stop_on_error, skip_patches, batch, events, parsecache)
                                     updatedrecipes.add(os.path.join(oldfilepath, oldfilename))
                                     updatedrecipes.add(os.path.join(newfilepath, newfilename))
                                 else:
@@ -586,10 +1189,7 @@ def main():
                                     logger.warn("Renamed class %s could not be found" % oldpath)
                                     other_adds.append(diffitem)
 
-                            deps = RecipeFileDependency.objects.filter(layerbranch=layerbranch).filter(path=oldpath)
-                            for dep in deps:
-                                dirtyrecipes.add(dep.recipe)
-
+                            dirtypaths.add(oldpath)
 
                     for diffitem in itertools.chain(diff.iter_change_type('D'), other_deletes):
                         path = diffitem.a_blob.path
@@ -674,7 +1274,7 @@ def main():
                                 results = layerrecipes.filter(filepath=filepath).filter(filename=filename)[:1]
                                 if results:
                                     recipe = results[0]
-                                    update_recipe_file(tinfoil, config_data_copy, os.path.join(layerdir, filepath), recipe, layerdir_start, repodir, options.stop_on_error, skip_patches)
+                                    update_recipe_file(tinfoil, config_data_copy, os.path.join(layerdir, filepath), recipe, layerdir_start, repodir, options.stop_on_error, skip_patches, batch, events, parsecache)
                                     recipe.save()
                                     updatedrecipes.add(recipe.full_path())
                             elif typename == 'machine':
@@ -690,22 +1290,33 @@ def main():
                                     update_distro_conf_file(os.path.join(repodir, path), distro, config_data_copy)
                                     distro.save()
 
-                            deps = RecipeFileDependency.objects.filter(layerbranch=layerbranch).filter(path=path)
-                            for dep in deps:
-                                dirtyrecipes.add(dep.recipe)
-
-                    for recipe in dirtyrecipes:
-                        if not recipe.full_path() in updatedrecipes:
-                            update_recipe_file(tinfoil, config_data_copy, os.path.join(layerdir, recipe.filepath), recipe, layerdir_start, repodir, options.stop_on_error, skip_patches)
+                            dirtypaths.add(path)
+
+                    if dirtypaths or reparse_ids:
+                        # Reparse each recipe affected by the changed files
+                        # once, no matter how many of them it depends upon
+                        dirty_ids = set(reparse_ids)
+                        if dirtypaths:
+                            depindex = RecipeFileDependencyIndex(layerbranch)
+                            dirty_ids.update(depindex.get_recipe_ids(dirtypaths))
+                        dirty_ids = sorted(dirty_ids)
+                        events.set_total(events.parsed + len(dirty_ids))
+                        for chunk in chunks(dirty_ids):
+                            for recipe in layerrecipes.filter(id__in=chunk):
+                                if not recipe.full_path() in updatedrecipes:
+                                    update_recipe_file(tinfoil, config_data_copy, os.path.join(layerdir, recipe.filepath), recipe, layerdir_start, repodir, options.stop_on_error, skip_patches, batch, events, parsecache)
+                                    updatedrecipes.add(recipe.full_path())
                 else:
                     # Collect recipe data from scratch
 
-                    layerrecipe_fns = []
+                    layerrecipe_fns = set()
+                    layerfiles_set = set(layerfiles)
                     if options.fullreload:
                         layerrecipes.delete()
                     else:
                         # First, check which recipes still exist
                         layerrecipe_values = layerrecipes.values('id', 'filepath', 'filename', 'pn')
+                        events.set_total(len(layerrecipe_values))
                         for v in layerrecipe_values:
                             if v['filepath'].startswith('../'):
                                 # FIXME: These recipes were present due to a bug (not handling renames
@@ -714,65 +1325,54 @@ def main():
                             else:
                                 root = os.path.join(layerdir, v['filepath'])
                                 fullpath = os.path.join(root, v['filename'])
-                                if os.path.exists(fullpath):
-                                    preserve = True
-                                    for removedir in removedirs:
-                                        if fullpath.startswith(removedir):
-                                            preserve = False
-                                            break
-                                else:
-                                    preserve = False
+                                preserve = os.path.normpath(os.path.join(v['filepath'], v['filename'])) in layerfiles_set
 
                             if preserve:
                                 # Recipe still exists, update it
                                 results = layerrecipes.filter(id=v['id'])[:1]
                                 recipe = results[0]
-                                update_recipe_file(tinfoil, config_data_copy, root, recipe, layerdir_start, repodir, options.stop_on_error, skip_patches)
+                                update_recipe_file(tinfoil, config_data_copy, root, recipe, layerdir_start, repodir, options.stop_on_error, skip_patches, batch, events, parsecache)
                             else:
                                 # Recipe no longer exists, mark it for later on
                                 layerrecipes_delete.append(v)
-                            layerrecipe_fns.append(fullpath)
-
-                    layermachines.delete()
-                    layerdistros.delete()
-                    layerappends.delete()
-                    layerclasses.delete()
-                    for root, dirs, files in os.walk(layerdir):
-                        if '.git' in dirs:
-                            dirs.remove('.git')
-                        for diritem in dirs[:]:
-                            fullpath = os.path.join(root, diritem) + os.sep
-                            if fullpath in removedirs:
-                                dirs.remove(diritem)
-                        for f in files:
-                            fullpath = os.path.join(root, f)
-                            (typename, _, filename) = recipeparse.detect_file_type(fullpath, layerdir_start)
-                            if typename == 'recipe':
-                                if fullpath not in layerrecipe_fns:
-                                    layerrecipes_add.append(fullpath)
-                            elif typename == 'bbappend':
-                                append = BBAppend()
-                                append.layerbranch = layerbranch
-                                append.filename = f
-                                append.filepath = os.path.relpath(root, layerdir)
-                                append.save()
-                            elif typename == 'machine':
-                                machine = Machine()
-                                machine.layerbranch = layerbranch
-                                machine.name = filename
-                                update_machine_conf_file(fullpath, machine)
-                                machine.save()
-                            elif typename == 'distro':
-                                distro = Distro()
-                                distro.layerbranch = layerbranch
-                                distro.name = filename
-                                update_distro_conf_file(fullpath, distro, config_data_copy)
-                                distro.save()
-                            elif typename == 'bbclass':
-                                bbclass = BBClass()
-                                bbclass.layerbranch = layerbranch
-                                bbclass.name = filename
-                                bbclass.save()
+                            layerrecipe_fns.add(os.path.normpath(fullpath))
+
+                    # Work out which machines, distros, appends and classes
+                    # should exist and then apply only the differences
+                    appends = {}
+                    machines = {}
+                    distros = {}
+                    classes = {}
+                    for path in layerfiles:
+                        (typename, filename) = recipeparse.classify_layer_file(path)
+                        if not typename:
+                            continue
+                        fullpath = os.path.join(layerdir, path)
+                        if typename == 'recipe':
+                            if os.path.normpath(fullpath) not in layerrecipe_fns:
+                                layerrecipes_add.append(fullpath)
+                        elif typename == 'bbappend':
+                            appends[(os.path.relpath(os.path.dirname(fullpath), layerdir), filename)] = {}
+                        elif typename == 'machine':
+                            machine = Machine(name=filename)
+                            update_machine_conf_file(fullpath, machine)
+                            machines[(filename,)] = {'description': machine.description}
+                        elif typename == 'distro':
+                            distro = Distro(name=filename)
+                            update_distro_conf_file(fullpath, distro, config_data_copy)
+                            distros[(filename,)] = {'description': distro.description}
+                        elif typename == 'bbclass':
+                            classes[(filename,)] = {}
+
+                    with events.phase('dbwrite'):
+                        for model, keyfields, wanted in [(BBAppend, ('filepath', 'filename'), appends),
+                                                         (Machine, ('name',), machines),
+                                                         (Distro, ('name',), distros),
+                                                         (BBClass, ('name',), classes)]:
+                            (added, changed, removed) = reconcile_layer_items(model, layerbranch, keyfields, wanted)
+                            logger.debug('%s: %d added, %d changed, %d removed' % (model._meta.verbose_name_plural, added, changed, removed))
+
+                    events.set_total(events.parsed + len(layerrecipes_add))
 
                 for added in layerrecipes_add:
                     # This is good enough without actually parsing the file
@@ -796,23 +1396,37 @@ def main():
                     recipe.filename = os.path.basename(added)
                     root = os.path.dirname(added)
                     recipe.filepath = os.path.relpath(root, layerdir)
-                    update_recipe_file(tinfoil, config_data_copy, root, recipe, layerdir_start, repodir, options.stop_on_error, skip_patches)
+                    update_recipe_file(tinfoil, config_data_copy, root, recipe, layerdir_start, repodir, options.stop_on_error, skip_patches, batch, events, parsecache)
                     recipe.save()
 
-                for deleted in layerrecipes_delete:
-                    logger.debug("Delete %s" % deleted)
-                    results = Recipe.objects.filter(id=deleted['id'])[:1]
-                    recipe = results[0]
-                    recipe.delete()
+                with events.phase('dbwrite'):
+                    batch.flush()
+
+                    for deleted in layerrecipes_delete:
+                        logger.debug("Delete %s" % deleted)
+                        results = Recipe.objects.filter(id=deleted['id'])[:1]
+                        recipe = results[0]
+                        recipe.delete()
+
+                    # Recipes with the same names in other layers may now be
+                    # more or less preferred than the ones in this layer
+                    pns = old_pns | set(layerrecipes.values_list('pn', flat=True))
+                    for chunk in chunks(sorted(pns)):
+                        utils.update_recipe_preferred_counts(branch, chunk)
+                events.finish()
+                if parsecache:
+                    logger.debug('Used cached parse results for %d recipes' % parsecache.hits)
+                    parsecache.save()
 
                 # Save repo info
                 layerbranch.vcs_last_rev = topcommit.hexsha
+                layerbranch.vcs_last_tree = utils.get_layer_tree_hash(topcommit, layerbranch.vcs_subdir)
                 layerbranch.vcs_last_commit = datetime.fromtimestamp(topcommit.committed_date)
             else:
                 logger.info("Layer %s is already up-to-date for branch %s" % (layer.name, branchdesc))
 
             layerbranch.vcs_last_fetch = datetime.now()
-            layerbranch.save()
+            layerbranch.save(update_fields=LayerBranch.fields_except_closure())
 
             if options.dryrun:
                 raise DryRunRollbackException()
@@ -829,17 +1443,6 @@ def main():
         import traceback
         logger.error(traceback.format_exc().rstrip())
         sys.exit(1)
-    finally:
-        if tinfoil and (LooseVersion(bb.__version__) > LooseVersion("1.27")):
-            tinfoil.shutdown()
-
-    if tempdir:
-        if options.keep_temp:
-            logger.debug('Preserving temp directory %s' % tempdir)
-        else:
-            logger.debug('Deleting temp directory')
-            shutil.rmtree(tempdir, onerror=rm_tempdir_onerror)
-    sys.exit(0)
 
 
 if __name__ == "__main__":
@@ -15,6 +15,7 @@ import fcntl
 import signal
 import codecs
 import re
+import shutil
 from datetime import datetime
 from bs4 import BeautifulSoup
 
@@ -48,6 +49,71 @@ def get_layer_var(config_data, var, logger):
         value = config_data.getVar(var, True)
     return value or ''
 
+def get_layerconf_hash(commit, vcs_subdir):
+    """
+    Get the git object hash of conf/layer.conf for a layer as of the
+    specified commit (a GitPython Commit object), or '' if it doesn't exist
+    """
+    try:
+        return (commit.tree / os.path.join(vcs_subdir, 'conf', 'layer.conf')).hexsha
+    except KeyError:
+        return ''
+
+def get_layer_tree_hash(commit, vcs_subdir):
+    """
+    Get the git object hash of the tree for a layer (i.e. the repository
+    subdirectory, or the root if none) as of the specified commit (a
+    GitPython Commit object), or '' if it doesn't exist
+    """
+    subdir = vcs_subdir.strip('/')
+    if not subdir:
+        return commit.tree.hexsha
+    try:
+        return (commit.tree / subdir).hexsha
+    except KeyError:
+        return ''
+
+def get_subdir_tree_hashes(repodir, ref, subdirs, logger=None):
+    """
+    Get the git object hashes of the trees for the specified subdirectories
+    of a repository as of the specified ref with a single git command, as
+    a dict. Subdirectories that don't exist are omitted.
+    """
+    subdirs = sorted(set([subdir.strip('/') for subdir in subdirs if subdir.strip('/')]))
+    if not subdirs:
+        return {}
+    output = runcmd(['git', 'ls-tree', '-d', '-z', ref, '--'] + subdirs, repodir, logger=logger, shell=False)
+    trees = {}
+    for line in output.split('\0'):
+        if line:
+            info, path = line.split('\t', 1)
+            trees[path] = info.split()[2]
+    return trees
+
+def list_layer_files(layerdir, commit='HEAD', logger=None):
+    """
+    List the files in a layer as of the specified commit with a single
+    "git ls-tree" rather than walking the directory (so untracked files
+    are ignored). layerdir needs to be within a checkout of the repository,
+    but need not be at the specified commit. Returns a tuple of the file
+    paths and the subdirectories that are layers in their own right (the
+    files within which are excluded), both relative to the layer directory.
+    """
+    # When run from a subdirectory, ls-tree only lists the files within it
+    # and gives their paths relative to it
+    output = runcmd(['git', 'ls-tree', '-r', '-z', commit], layerdir, logger=logger, shell=False)
+    files = []
+    for line in output.split('\0'):
+        if line:
+            info, path = line.split('\t', 1)
+            # Skip submodules
+            if info.split()[1] == 'blob':
+                files.append(path)
+    sublayers = tuple([path[:-len('conf/layer.conf')] for path in files if path.endswith('/conf/layer.conf')])
+    if sublayers:
+        files = [path for path in files if not path.startswith(sublayers)]
+    return files, list(sublayers)
+
 def is_deps_satisfied(req_col, req_ver, collections):
     """ Check whether required collection and version are in collections"""
     for existed_col, existed_ver in collections:
@@ -178,6 +244,39 @@ def _add_dependency(var, name, layerbranch, config_data, logger=None, required=T
             logger.warn('Dependencies "%s" are not in %s\'s conf/layer.conf' % (need_remove, layer_name))
             logger.warn('Either set REMOVE_LAYER_DEPENDENCIES to remove them from the database, or fix conf/layer.conf')
 
+def update_recipe_preferred_counts(branch, pns=None):
+    """
+    Update the preferred_count field of recipes on the specified branch
+    (optionally limited to those with names in pns, which may be a list
+    or a queryset of pn values), i.e. the number of recipes with the same
+    name in other software / base layers with a higher index preference.
+    This is used to de-emphasise recipes that are "shadowed" by another
+    layer in recipe lists.
+    """
+    from layerindex.models import Recipe
+
+    recipes = Recipe.objects.filter(layerbranch__branch=branch)
+    if pns is not None:
+        recipes = recipes.filter(pn__in=pns)
+
+    recipes_by_pn = {}
+    for values in recipes.values_list('id', 'pn', 'layerbranch_id', 'layerbranch__layer__index_preference', 'layerbranch__layer__layer_type', 'preferred_count'):
+        recipes_by_pn.setdefault(values[1], []).append(values)
+
+    changed = {}
+    for pn_recipes in recipes_by_pn.values():
+        for recipe_id, _, layerbranch_id, preference, _, preferred_count in pn_recipes:
+            count = 0
+            for _, _, layerbranch_id2, preference2, layer_type2, _ in pn_recipes:
+                if layerbranch_id2 != layerbranch_id and layer_type2 in ('S', 'A') and preference2 > preference:
+                    count += 1
+            if count != preferred_count:
+                changed.setdefault(count, []).append(recipe_id)
+
+    for count, recipe_ids in changed.items():
+        for i in range(0, len(recipe_ids), 500):
+            Recipe.objects.filter(id__in=recipe_ids[i:i+500]).update(preferred_count=count)
+
 def set_layerbranch_collection_version(layerbranch, config_data, logger=None):
     layerbranch.collection = config_data.getVar('BBFILE_COLLECTIONS', True)
     ver_str = "LAYERVERSION_"
@@ -233,6 +332,16 @@ def checkout_repo(repodir, commit, logger, force=False):
         except Exception as esc:
             logger.warn(esc)
             currentref = ''
+        if currentref:
+            # Resolve the commit so that we can tell if we're already there (this
+            # matters when several update processes may check out the same repo
+            # at the same time, since we want the redundant checkouts to be no-ops)
+            try:
+                targetref = runcmd(['git', 'rev-parse', '%s^{commit}' % commit], repodir, logger=logger, printerr=False, shell=False).strip()
+            except subprocess.CalledProcessError:
+                targetref = commit
+            if targetref == currentref:
+                return
     if currentref != commit:
         # Reset in case there are added but uncommitted changes
         runcmd("git reset --hard", repodir, logger=logger)
@@ -243,9 +352,85 @@ def checkout_repo(repodir, commit, logger, force=False):
         # Now check out the revision
         runcmd(['git', 'checkout', commit], repodir, logger=logger, shell=False)
 
-def checkout_layer_branch(layerbranch, repodir, logger=None):
+def checkout_layer_branch(layerbranch, repodir, logger=None, worktreedir=None):
     branchname = layerbranch.get_checkout_branch()
-    checkout_repo(repodir, 'origin/%s' % branchname, logger)
+    if worktreedir and worktreedir != repodir:
+        checkout_worktree(repodir, worktreedir, 'origin/%s' % branchname, logger)
+    else:
+        checkout_repo(repodir, 'origin/%s' % branchname, logger)
+
+# Directory within LAYER_FETCH_DIR holding the per-branch worktrees
+WORKTREES_DIR = '.worktrees'
+
+def get_layer_checkout_dir(settings, branchname):
+    """
+    Get the directory in which the layer repositories are checked out for
+    the specified branch. If the LAYER_WORKTREES setting is enabled this
+    is a directory of git worktrees (one per repository, laid out the same
+    way as LAYER_FETCH_DIR) that is kept just for the branch, otherwise it
+    is LAYER_FETCH_DIR itself.
+    """
+    if getattr(settings, 'LAYER_WORKTREES', False):
+        return os.path.join(settings.LAYER_FETCH_DIR, WORKTREES_DIR, branchname.replace('/', '_'))
+    return settings.LAYER_FETCH_DIR
+
+def checkout_worktree(repodir, worktreedir, commit, logger, force=False):
+    """
+    Check out a revision in a worktree of a repository, creating the
+    worktree first if it doesn't exist (or has been broken).
+    WARNING: as with checkout_repo(), this will throw away any
+    untracked/uncommitted files in the worktree
+    """
+    if not os.path.exists(os.path.join(worktreedir, '.git')):
+        if os.path.exists(worktreedir):
+            shutil.rmtree(worktreedir)
+        # Drop git's record of the worktree if it used to exist
+        runcmd(['git', 'worktree', 'prune'], repodir, logger=logger, shell=False)
+        os.makedirs(os.path.dirname(worktreedir), exist_ok=True)
+        runcmd(['git', 'worktree', 'add', '--detach', '--force', worktreedir, commit], repodir, logger=logger, shell=False)
+    else:
+        checkout_repo(worktreedir, commit, logger, force)
+
+def checkout_layer_repo(settings, urldir, branchname, commit, logger=None, force=False):
+    """
+    Check out a revision of a layer repository in the place it should be
+    checked out for the specified branch (see get_layer_checkout_dir()).
+    Returns the path of the checkout.
+    """
+    repodir = os.path.join(settings.LAYER_FETCH_DIR, urldir)
+    checkoutdir = os.path.join(get_layer_checkout_dir(settings, branchname), urldir)
+    if checkoutdir == repodir:
+        checkout_repo(repodir, commit, logger, force)
+    else:
+        checkout_worktree(repodir, checkoutdir, commit, logger, force)
+    return checkoutdir
+
+def prune_worktrees(settings, branchnames, logger=None):
+    """
+    Remove the worktrees for branches that are not in branchnames, and for
+    repositories that are no longer present in LAYER_FETCH_DIR
+    """
+    fetchdir = settings.LAYER_FETCH_DIR
+    worktreesdir = os.path.join(fetchdir, WORKTREES_DIR)
+    if not os.path.isdir(worktreesdir):
+        return
+    branchdirs = [os.path.basename(get_layer_checkout_dir(settings, branchname)) for branchname in branchnames]
+    for branchdir in os.listdir(worktreesdir):
+        branchpath = os.path.join(worktreesdir, branchdir)
+        if branchdir not in branchdirs:
+            if logger:
+                logger.info('Removing worktrees for branch %s' % branchdir)
+            shutil.rmtree(branchpath)
+            continue
+        for urldir in os.listdir(branchpath):
+            if not os.path.isdir(os.path.join(fetchdir, urldir, '.git')):
+                if logger:
+                    logger.info('Removing worktree %s for branch %s' % (urldir, branchdir))
+                shutil.rmtree(os.path.join(branchpath, urldir))
+    for urldir in os.listdir(fetchdir):
+        repodir = os.path.join(fetchdir, urldir)
+        if os.path.isdir(os.path.join(repodir, '.git', 'worktrees')):
+            runcmd(['git', 'worktree', 'prune'], repodir, logger=logger, shell=False)
 
 def is_layer_valid(layerdir):
     conf_file = os.path.join(layerdir, "conf", "layer.conf")
@@ -402,7 +587,7 @@ def setup_core_layer_sys_path(settings, branchname):
     core_layerbranch = core_layer.get_layerbranch(branchname)
     if core_layerbranch:
         core_urldir = core_layer.get_fetch_dir()
-        core_repodir = os.path.join(settings.LAYER_FETCH_DIR, core_urldir)
+        core_repodir = os.path.join(get_layer_checkout_dir(settings, branchname), core_urldir)
         core_layerdir = os.path.join(core_repodir, core_layerbranch.vcs_subdir)
         sys.path.insert(0, os.path.join(core_layerdir, 'lib'))
 
@@ -437,6 +622,17 @@ def run_command_interruptible(cmd):
     return process.returncode, buf
 
 
+# Line written to stdout by "update_layer.py --worker" (followed by the exit
+# code) when it has finished updating a layer
+UPDATE_WORKER_DONE = '--- layerindex update worker: done'
+
+# Line written to stdout by "update_layer.py --worker" (followed by a JSON
+# object) to report progress and timings while updating a layer
+UPDATE_WORKER_EVENT = '--- layerindex update worker: event'
+
+# Phases of a layer update that are timed, in the order that they happen
+UPDATE_PHASES = ['checkout', 'tinfoil', 'diff', 'parse', 'dbwrite']
+
 def sanitise_html(html):
     soup = BeautifulSoup(html, "html.parser")
     for tag in soup.findAll(True):
@@ -22,7 +22,7 @@ from django.contrib.messages.views import SuccessMessageMixin
 from layerindex.forms import EditLayerForm, LayerMaintainerFormSet, EditNoteForm, EditProfileForm, RecipeChangesetForm, AdvancedRecipeSearchForm, BulkChangeEditFormSet, ClassicRecipeForm, ClassicRecipeSearchForm, ComparisonRecipeSelectForm
 from django.db import transaction
 from django.contrib.auth.models import User, Permission
-from django.db.models import Q, Count, Sum
+from django.db.models import Q, Count, Sum, Case, When, Value, IntegerField, FloatField
 from django.db.models.functions import Lower
 from django.db.models.query import QuerySet
 from django.template.loader import get_template
@@ -163,7 +163,8 @@ def edit_layer_view(request, template_name, branch='master', slug=None):
 
                     if reset_last_rev:
                         layerbranch.vcs_last_rev = ''
-                        layerbranch.save()
+                        # The dependencies may have just changed
+                        layerbranch.save(update_fields=LayerBranch.fields_except_closure())
                 else:
                     # Save dependencies
                     for dep in form.cleaned_data['deps']:
@@ -382,6 +383,9 @@ class LayerDetailView(DetailView):
             context['appends'] = layerbranch.bbappend_set.order_by('filename')
             context['classes'] = layerbranch.bbclass_set.order_by('name')
             context['updates'] = LayerUpdate.objects.filter(layer=layerbranch.layer, branch=layerbranch.branch).order_by('-started')
+            deps = list(layerbranch.dependencies_set.select_related('dependency'))
+            context['required_deps'] = [dep for dep in deps if dep.required]
+            context['recommended_deps'] = [dep for dep in deps if not dep.required]
         context['url_branch'] = self.kwargs['branch']
         context['this_url_name'] = resolve(self.request.path_info).url_name
         if 'rrs' in settings.INSTALLED_APPS:
@@ -403,34 +407,13 @@ class LayerReviewDetailView(LayerDetailView):
         return context
 
 
-def recipes_preferred_count(qs):
-    # Add extra column so we can show "duplicate" recipes from other layers de-emphasised
-    # (it's a bit crude having to do this using SQL but I couldn't find a better way...)
-    return qs.extra(
-        select={
-            'preferred_count': """SELECT COUNT(1)
-FROM layerindex_recipe AS recipe2
-, layerindex_layerbranch as branch2
-, layerindex_layeritem as layer1
-, layerindex_layeritem as layer2
-WHERE branch2.id = recipe2.layerbranch_id
-AND layer2.id = branch2.layer_id
-AND layer2.layer_type in ('S', 'A')
-AND branch2.branch_id = layerindex_layerbranch.branch_id
-AND recipe2.pn = layerindex_recipe.pn
-AND recipe2.layerbranch_id <> layerindex_recipe.layerbranch_id
-AND layer1.id = layerindex_layerbranch.layer_id
-AND layer2.index_preference > layer1.index_preference
-"""
-        },
-    )
-
 class RecipeSearchView(ListView):
     context_object_name = 'recipe_list'
     paginate_by = 50
 
     def render_to_response(self, context, **kwargs):
-        if len(self.object_list) == 1:
+        # Only fetch as many results as we need to tell if there is just one
+        if len(self.object_list[:2]) == 1:
             return HttpResponseRedirect(reverse('recipe', args=(self.object_list[0].id,)))
         else:
             return super(ListView, self).render_to_response(context, **kwargs)
@@ -478,31 +461,36 @@ layer name is expected to follow the \"layer:\" prefix without any spaces.')
                                             % query_layername)
             else:
                 query_terms.append(item)
-        if inherits:
-            # FIXME This is a bit ugly, perhaps we should consider having this as a one-many relationship instead
-            for inherit in inherits:
-                init_qs = init_qs.filter(Q(inherits=inherit) | Q(inherits__startswith=inherit + ' ') | Q(inherits__endswith=' ' + inherit) | Q(inherits__contains=' %s ' % inherit))
+        for inherit in inherits:
+            init_qs = init_qs.filter(inheritedclass__name=inherit)
         query_string = ' '.join(query_terms)
 
-        if query_string.strip():
-            order_by = ('pn', 'layerbranch__layer')
-
-            qs0 = init_qs.filter(pn=query_string).order_by(*order_by)
-            qs0 = recipes_preferred_count(qs0)
-
-            entry_query = simplesearch.get_query(query_string, ['pn'])
-            qs1 = init_qs.filter(entry_query).order_by(*order_by)
-            qs1 = recipes_preferred_count(qs1)
-
-            entry_query = simplesearch.get_query(query_string, ['description', 'summary'])
-            qs2 = init_qs.filter(entry_query).order_by(*order_by)
-            qs2 = recipes_preferred_count(qs2)
-
-            qs = list(utils.chain_unique(qs0, qs1, qs2))
+        pn_query = simplesearch.get_query(query_string, ['pn'])
+        if pn_query is not None:
+            # Rank exact name matches first, then partial name matches, then
+            # matches within the summary / description. The latter are found
+            # via the full-text index if the database supports it (matching
+            # words and word prefixes rather than substrings - see
+            # get_fulltext_query()), in which case they're ordered by relevance
+            text_query = simplesearch.get_fulltext_query(query_string, Recipe, ['summary', 'description'])
+            qs = init_qs.filter(pn_query | text_query)
+            qs = qs.annotate(search_rank=Case(
+                When(pn=query_string, then=Value(0)),
+                When(pn_query, then=Value(1)),
+                default=Value(2),
+                output_field=IntegerField()))
+            text_rank = simplesearch.get_fulltext_rank(query_string, Recipe, ['summary', 'description'])
+            if text_rank is not None:
+                qs = qs.annotate(text_rank=Case(
+                    When(pn_query, then=Value(0.0)),
+                    default=text_rank,
+                    output_field=FloatField()))
+                qs = qs.order_by('search_rank', '-text_rank', 'pn', 'layerbranch__layer')
+            else:
+                qs = qs.order_by('search_rank', 'pn', 'layerbranch__layer')
         else:
             if 'q' in self.request.GET:
                 qs = init_qs.order_by('pn', 'layerbranch__layer')
-                qs = list(recipes_preferred_count(qs))
             else:
                 # It's a bit too slow to return all records by default, and most people
                 # won't actually want that (if they do they can just hit the search button
@@ -528,7 +516,7 @@ class DuplicatesView(TemplateView):
             init_qs = init_qs.filter(layerbranch__layer__in=layer_ids)
         dupes = init_qs.values('pn').annotate(Count('layerbranch', distinct=True)).filter(layerbranch__count__gt=1)
         qs = init_qs.all().filter(pn__in=[item['pn'] for item in dupes]).order_by('pn', 'layerbranch__layer', '-pv')
-        return recipes_preferred_count(qs)
+        return qs
 
     def get_classes(self, layer_ids):
         init_qs = BBClass.objects.filter(layerbranch__branch__name=self.kwargs['branch'])
@@ -814,7 +802,7 @@ class EditProfileFormView(UpdateView):
 
 @receiver(pre_save, sender=reversion.models.Version)
 def annotate_revision_version(sender, instance, *args, **kwargs):
-    ignorefields = ['vcs_last_rev', 'vcs_last_fetch', 'vcs_last_commit', 'updated']
+    ignorefields = ['vcs_last_rev', 'vcs_last_tree', 'vcs_last_fetch', 'vcs_last_commit', 'layerconf_hash', 'layerconf_depends', 'layerconf_recommends', 'dependency_closure', 'updated']
     changelist = []
     objclass = instance.content_type.model_class()
     currentVersion = instance.field_dict
@@ -869,9 +857,10 @@ class RecipeDetailView(DetailView):
         if recipe:
             verappendprefix = recipe.filename.split('.bb')[0]
             appendprefix = verappendprefix.split('_')[0]
-            appendprefix = appendprefix.replace('+', r'\+')
             #context['verappends'] = BBAppend.objects.filter(layerbranch__branch=recipe.layerbranch.branch).filter(filename='%s.bbappend' % verappendprefix)
-            context['appends'] = BBAppend.objects.filter(layerbranch__branch=recipe.layerbranch.branch).filter(filename__regex=r'^%s(_[^_]*)?\.bbappend' % appendprefix)
+            # The prefix match lets the database use the filename index
+            # before applying the regex
+            context['appends'] = BBAppend.objects.filter(layerbranch__branch=recipe.layerbranch.branch).filter(filename__startswith=appendprefix).filter(filename__regex=r'^%s(_[^_]*)?\.bbappend' % appendprefix.replace('+', r'\+'))
             verappends = []
             for append in context['appends']:
                 if append.matches_recipe(recipe):
@@ -1137,8 +1126,7 @@ class ClassicRecipeSearchView(RecipeSearchView):
                 init_rqs = init_rqs.filter(layerbranch__layer__id__in=layer_ids)
             excludeclasses_param = self.request.GET.get('excludeclasses', '')
             if excludeclasses_param:
-                for inherit in excludeclasses_param.split(','):
-                    init_rqs = init_rqs.exclude(inherits=inherit).exclude(inherits__startswith=inherit + ' ').exclude(inherits__endswith=' ' + inherit).exclude(inherits__contains=' %s ' % inherit)
+                init_rqs = init_rqs.exclude(inheritedclass__name__in=excludeclasses_param.split(','))
             all_values = []
             if filtered:
                 if isinstance(qs, list):
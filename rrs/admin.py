@@ -15,7 +15,7 @@ from django.core.exceptions import ValidationError
 from rrs.models import Release, Milestone, Maintainer, RecipeMaintainerHistory, \
         RecipeMaintainer, RecipeDistro, RecipeUpgrade, RecipeUpstream, \
         RecipeUpstreamHistory, MaintenancePlan, MaintenancePlanLayerBranch, \
-        RecipeMaintenanceLink
+        RecipeMaintenanceLink, MilestoneStatistics
 
 class MaintenancePlanLayerBranchFormSet(BaseInlineFormSet):
     def __init__(self, *args, **kwargs):
@@ -192,6 +192,11 @@ class RecipeUpstreamAdmin(admin.ModelAdmin):
 class RecipeMaintenanceLinkAdmin(admin.ModelAdmin):
     model = RecipeMaintenanceLink
 
+class MilestoneStatisticsAdmin(admin.ModelAdmin):
+    list_filter = ['milestone__release__plan', 'layerbranch__layer', 'maintainer__name']
+    list_display = ['milestone', 'layerbranch', 'maintainer', 'recipes', 'up_to_date', 'not_updated', 'cant_be_updated', 'unknown', 'updated']
+    model = MilestoneStatistics
+
 admin.site.register(MaintenancePlan, MaintenancePlanAdmin)
 admin.site.register(Release, ReleaseAdmin)
 admin.site.register(Milestone, MilestoneAdmin)
@@ -203,3 +208,4 @@ admin.site.register(RecipeUpgrade, RecipeUpgradeAdmin)
 admin.site.register(RecipeUpstreamHistory, RecipeUpstreamHistoryAdmin)
 admin.site.register(RecipeUpstream, RecipeUpstreamAdmin)
 admin.site.register(RecipeMaintenanceLink, RecipeMaintenanceLinkAdmin)
+admin.site.register(MilestoneStatistics, MilestoneStatisticsAdmin)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2018-10-16 14:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('layerindex', '0035_layerbranch_vcs_last_tree'),
+        ('rrs', '0018_rmh_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MilestoneStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipes', models.IntegerField(default=0)),
+                ('up_to_date', models.IntegerField(default=0)),
+                ('not_updated', models.IntegerField(default=0)),
+                ('cant_be_updated', models.IntegerField(default=0)),
+                ('unknown', models.IntegerField(default=0)),
+                ('upgraded', models.IntegerField(default=0)),
+                ('not_upgraded', models.IntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('layerbranch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='layerindex.LayerBranch')),
+                ('maintainer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='rrs.Maintainer')),
+                ('milestone', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='rrs.Milestone')),
+            ],
+            options={
+                'verbose_name_plural': 'Milestone statistics',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='milestonestatistics',
+            unique_together=set([('milestone', 'layerbranch', 'maintainer')]),
+        ),
+    ]
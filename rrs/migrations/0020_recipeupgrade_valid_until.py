@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.12 on 2018-10-17 10:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def set_valid_until(apps, schema_editor):
+    RecipeUpgrade = apps.get_model('rrs', 'RecipeUpgrade')
+
+    prev = None
+    for upgrade in RecipeUpgrade.objects.order_by('recipe_id', 'commit_date', 'id').only('id', 'recipe_id', 'commit_date').iterator():
+        if prev and prev.recipe_id == upgrade.recipe_id:
+            RecipeUpgrade.objects.filter(id=prev.id).update(valid_until=upgrade.commit_date)
+        prev = upgrade
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rrs', '0019_milestonestatistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipeupgrade',
+            name='valid_until',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='Commit date of the next upgrade to the same recipe (empty if this is the latest)', null=True),
+        ),
+        migrations.RunPython(set_valid_until, reverse_code=migrations.RunPython.noop),
+    ]
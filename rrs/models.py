@@ -12,6 +12,9 @@ sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__), '../
 from datetime import date, datetime
 
 from django.db import models
+from django.db.models import Q
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 from layerindex.models import Recipe, LayerBranch, PythonEnvironment
 from django.core.exceptions import ObjectDoesNotExist
@@ -406,6 +409,21 @@ class RecipeDistro(models.Model):
         return recipe_distros
 
 
+class RecipeUpgradeQuerySet(models.QuerySet):
+    def delete(self):
+        # Deleting upgrades leaves gaps in the timeline of the remaining
+        # ones, so fix it up afterwards (once per recipe rather than for
+        # each upgrade). This is done here rather than with a post_delete
+        # handler so that Django can still delete upgrades in bulk,
+        # including when their recipe is deleted (and the timeline with it).
+        recipe_ids = list(self.order_by().values_list('recipe_id', flat=True).distinct())
+        result = super(RecipeUpgradeQuerySet, self).delete()
+        for recipe_id in RecipeUpgrade.objects.filter(recipe_id__in=recipe_ids).order_by().values_list('recipe_id', flat=True).distinct():
+            RecipeUpgrade.update_timeline(recipe_id)
+        return result
+    delete.alters_data = True
+    delete.queryset_only = True
+
 class RecipeUpgrade(models.Model):
     recipe = models.ForeignKey(Recipe)
     maintainer = models.ForeignKey(Maintainer, blank=True)
@@ -414,6 +432,39 @@ class RecipeUpgrade(models.Model):
     version = models.CharField(max_length=100, blank=True)
     author_date = models.DateTimeField(db_index=True)
     commit_date = models.DateTimeField(db_index=True)
+    valid_until = models.DateTimeField(blank=True, null=True, db_index=True, help_text='Commit date of the next upgrade to the same recipe (empty if this is the latest)')
+
+    objects = RecipeUpgradeQuerySet.as_manager()
+
+    @staticmethod
+    def update_timeline(recipe_id):
+        """
+        Set valid_until for each upgrade of the specified recipe, so that
+        the upgrade current at any date can be found with a simple range
+        lookup rather than needing to rank all of the recipe's upgrades
+        """
+        upgrades = list(RecipeUpgrade.objects.filter(recipe_id=recipe_id).order_by('commit_date', 'id').values_list('id', 'commit_date', 'valid_until'))
+        for i, (upgrade_id, _, valid_until) in enumerate(upgrades):
+            if i + 1 < len(upgrades):
+                next_date = upgrades[i + 1][1]
+            else:
+                next_date = None
+            if valid_until != next_date:
+                RecipeUpgrade.objects.filter(id=upgrade_id).update(valid_until=next_date)
+
+    def get_timeline_neighbours(self):
+        """
+        Get the (id, commit_date) of the upgrades of the same recipe
+        immediately before and after this one (or None for either if there
+        isn't one), for updating valid_until without going through all of
+        the recipe's upgrades
+        """
+        upgrades = RecipeUpgrade.objects.filter(recipe_id=self.recipe_id).exclude(id=self.id).values_list('id', 'commit_date')
+        prev = upgrades.filter(Q(commit_date__lt=self.commit_date) |
+                Q(commit_date=self.commit_date, id__lt=self.id)).order_by('-commit_date', '-id').first()
+        next = upgrades.filter(Q(commit_date__gt=self.commit_date) |
+                Q(commit_date=self.commit_date, id__gt=self.id)).order_by('commit_date', 'id').first()
+        return prev, next
 
     @staticmethod
     def get_by_recipe_and_date(recipe, end_date):
@@ -421,6 +472,14 @@ class RecipeUpgrade(models.Model):
                 commit_date__lte = end_date)
         return ru[len(ru) - 1] if ru else None
 
+    def delete(self, *args, **kwargs):
+        # Link the upgrades either side of this one together
+        prev, next = self.get_timeline_neighbours()
+        result = super(RecipeUpgrade, self).delete(*args, **kwargs)
+        if prev:
+            RecipeUpgrade.objects.filter(id=prev[0]).update(valid_until=next[1] if next else None)
+        return result
+
     def short_sha1(self):
         return self.sha1[0:6]
 
@@ -432,6 +491,31 @@ class RecipeUpgrade(models.Model):
                         self.commit_date)
 
 
+@receiver(pre_save, sender=RecipeUpgrade)
+def recipeupgrade_saving(sender, instance, **kwargs):
+    if instance.pk:
+        instance._old_timeline = RecipeUpgrade.objects.filter(id=instance.pk).values_list('recipe_id', 'commit_date').first()
+
+@receiver(post_save, sender=RecipeUpgrade)
+def recipeupgrade_saved(sender, instance, created, **kwargs):
+    old = getattr(instance, '_old_timeline', None)
+    if not created and old:
+        # Only need to do anything if the upgrade has moved, which is rare
+        if old != (instance.recipe_id, instance.commit_date):
+            RecipeUpgrade.update_timeline(old[0])
+            if old[0] != instance.recipe_id:
+                RecipeUpgrade.update_timeline(instance.recipe_id)
+        return
+    # Slot the new upgrade in between its neighbours
+    prev, next = instance.get_timeline_neighbours()
+    valid_until = next[1] if next else None
+    if instance.valid_until != valid_until:
+        instance.valid_until = valid_until
+        RecipeUpgrade.objects.filter(id=instance.id).update(valid_until=valid_until)
+    if prev:
+        RecipeUpgrade.objects.filter(id=prev[0]).update(valid_until=instance.commit_date)
+
+
 class RecipeMaintenanceLink(models.Model):
     pn_match = models.CharField(max_length=100, help_text='Expression to match against pn of recipes that should be linked (glob expression)')
     pn_target = models.CharField(max_length=100, help_text='Name of recipe to link to')
@@ -451,3 +535,158 @@ class RecipeMaintenanceLink(models.Model):
 
     def __str__(self):
         return '%s -> %s' % (self.pn_match, self.pn_target)
+
+
+class MilestoneStatistics(models.Model):
+    """
+    Recipe counts for a milestone, worked out ahead of time by the RRS
+    update scripts so that pages don't have to compute them on each request.
+    Records with no maintainer hold the totals for the layer branch.
+    """
+    milestone = models.ForeignKey(Milestone)
+    layerbranch = models.ForeignKey(LayerBranch)
+    maintainer = models.ForeignKey(Maintainer, blank=True, null=True)
+    recipes = models.IntegerField(default=0)
+    up_to_date = models.IntegerField(default=0)
+    not_updated = models.IntegerField(default=0)
+    cant_be_updated = models.IntegerField(default=0)
+    unknown = models.IntegerField(default=0)
+    upgraded = models.IntegerField(default=0)
+    not_upgraded = models.IntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('milestone', 'layerbranch', 'maintainer',)
+        verbose_name_plural = "Milestone statistics"
+
+    def add_status(self, status, no_update_reason):
+        if status == 'Y':
+            self.up_to_date += 1
+        elif status == 'N':
+            if no_update_reason:
+                self.cant_be_updated += 1
+            else:
+                self.not_updated += 1
+        # We count downgrade as unknown
+        else:
+            self.unknown += 1
+
+    @staticmethod
+    def calculate(milestone, layerbranch):
+        """
+        Calculate statistics for a milestone and layer branch, returning
+        a list of (unsaved) records - one for the layer branch as a whole
+        followed by one for each maintainer.
+        """
+        total = MilestoneStatistics(milestone=milestone, layerbranch=layerbranch)
+        stats = [total]
+
+        history = RecipeUpstreamHistory.get_last_by_date_range(layerbranch,
+                milestone.start_date, milestone.end_date)
+        upstream = {}
+        if history:
+            for recipe_id, status, no_update_reason in RecipeUpstream.objects.filter(
+                    history=history).values_list('recipe_id', 'status', 'no_update_reason'):
+                upstream[recipe_id] = (status, no_update_reason)
+
+        # Recipes that exist in the layer as of the end of the milestone
+        recipes = set(RecipeUpgrade.objects.filter(recipe__layerbranch=layerbranch,
+                commit_date__lte=milestone.end_date).values_list('recipe_id', flat=True))
+        for recipe_id in recipes:
+            if recipe_id in upstream:
+                total.add_status(*upstream[recipe_id])
+        total.recipes = total.up_to_date + total.not_updated + total.cant_be_updated + total.unknown
+
+        history_first = RecipeUpstreamHistory.get_first_by_date_range(layerbranch,
+                milestone.start_date, milestone.end_date)
+        if history_first:
+            not_upgraded = set(RecipeUpstream.objects.filter(history=history_first,
+                    status='N').values_list('recipe_id', flat=True))
+            if not_upgraded:
+                upgraded = set(RecipeUpgrade.objects.filter(recipe__layerbranch=layerbranch,
+                        commit_date__gte=milestone.start_date,
+                        commit_date__lte=milestone.end_date).values_list('recipe_id', flat=True))
+                total.upgraded = len(upgraded & not_upgraded)
+                total.not_upgraded = len(not_upgraded)
+
+        rmh = RecipeMaintainerHistory.get_by_end_date(layerbranch, milestone.end_date)
+        if rmh:
+            maintainer_recipes = {}
+            for maintainer_id, recipe_id in RecipeMaintainer.objects.filter(
+                    history=rmh).values_list('maintainer_id', 'recipe_id'):
+                maintainer_recipes.setdefault(maintainer_id, set()).add(recipe_id)
+            maintainers = Maintainer.objects.in_bulk(list(maintainer_recipes.keys()))
+            for maintainer_id, recipe_ids in sorted(maintainer_recipes.items()):
+                mstats = MilestoneStatistics(milestone=milestone, layerbranch=layerbranch,
+                        maintainer=maintainers[maintainer_id], recipes=len(recipe_ids))
+                for recipe_id in recipe_ids:
+                    if recipe_id in upstream:
+                        mstats.add_status(*upstream[recipe_id])
+                stats.append(mstats)
+
+        return stats
+
+    @staticmethod
+    def refresh(maintplan, layerbranch, since=None):
+        """
+        Recalculate the stored statistics for a layer branch within a
+        maintenance plan, optionally only for milestones ending on or
+        after the specified date.
+        """
+        milestones = Milestone.objects.filter(release__plan=maintplan)
+        if since:
+            milestones = milestones.filter(end_date__gte=since)
+        for milestone in milestones:
+            MilestoneStatistics.objects.filter(milestone=milestone, layerbranch=layerbranch).delete()
+            MilestoneStatistics.objects.bulk_create(MilestoneStatistics.calculate(milestone, layerbranch))
+        # Drop anything left over from layer branches no longer in the plan
+        MilestoneStatistics.objects.filter(milestone__release__plan=maintplan).exclude(
+                layerbranch__maintenanceplanlayerbranch__plan=maintplan).delete()
+
+    @staticmethod
+    def refresh_milestone(milestone):
+        """
+        Recalculate the stored statistics for a milestone for all layer
+        branches in its maintenance plan
+        """
+        MilestoneStatistics.objects.filter(milestone=milestone).delete()
+        for maintplanlayer in milestone.release.plan.maintenanceplanlayerbranch_set.all():
+            MilestoneStatistics.objects.bulk_create(MilestoneStatistics.calculate(milestone, maintplanlayer.layerbranch))
+
+    @staticmethod
+    def get_by_milestone(milestone):
+        """
+        Get the statistics records for a milestone, calculating them on the
+        fly for any layer branches in the plan that they haven't been stored
+        for yet
+        """
+        layerbranch_ids = list(milestone.release.plan.maintenanceplanlayerbranch_set.values_list('layerbranch_id', flat=True))
+        stats = list(MilestoneStatistics.objects.filter(milestone=milestone,
+                layerbranch_id__in=layerbranch_ids).select_related('maintainer'))
+        stored = set([stat.layerbranch_id for stat in stats])
+        missing = [layerbranch_id for layerbranch_id in layerbranch_ids if layerbranch_id not in stored]
+        if missing:
+            for layerbranch in LayerBranch.objects.filter(id__in=missing):
+                stats.extend(MilestoneStatistics.calculate(milestone, layerbranch))
+        return stats
+
+    def __str__(self):
+        return '%s: %s: %s' % (self.milestone, self.layerbranch, self.maintainer or 'all')
+
+@receiver(post_save, sender=Milestone)
+def milestone_saved(sender, instance, **kwargs):
+    # The milestone's dates may have changed, and the update scripts only
+    # refresh statistics for current milestones
+    MilestoneStatistics.refresh_milestone(instance)
+
+@receiver(post_save, sender=MaintenancePlanLayerBranch)
+def maintplanlayerbranch_saved(sender, instance, **kwargs):
+    # If the layer branch has changed, drop the statistics for the old one
+    # (those for the new one will be calculated on the fly until the update
+    # scripts store them)
+    MilestoneStatistics.objects.filter(milestone__release__plan_id=instance.plan_id).exclude(
+            layerbranch__maintenanceplanlayerbranch__plan_id=instance.plan_id).delete()
+
+@receiver(post_delete, sender=MaintenancePlanLayerBranch)
+def maintplanlayerbranch_deleted(sender, instance, **kwargs):
+    MilestoneStatistics.objects.filter(milestone__release__plan_id=instance.plan_id, layerbranch_id=instance.layerbranch_id).delete()
@@ -55,31 +55,16 @@ def get_pv_type(pv):
     return pv_type
 
 def get_recipe_files(layerdir):
-    from layerindex import recipeparse
-
-    sublayer_dirs = []
-    for root, dirs, files in os.walk(layerdir):
-        for d in dirs:
-            if os.path.exists(os.path.join(root, d, 'conf', 'layer.conf')):
-                sublayer_dirs.append(os.path.join(root, d) + os.sep)
+    from layerindex import recipeparse, utils
 
+    # List the files committed at the revision checked out (ignoring any
+    # layers within this layer)
+    files, _ = utils.list_layer_files(layerdir)
     recipe_files = []
-    for root, dirs, files in os.walk(layerdir):
-        if '.git' in dirs:
-            dirs.remove('.git')
-
-        # remove sublayer dirs
-        for d in dirs[:]:
-            fullpath = os.path.join(root, d) + os.sep
-            if fullpath in sublayer_dirs:
-                dirs.remove(d)
-
-        for f in files:
-            fullpath = os.path.join(root, f)
-            (typename, _, filename) = recipeparse.detect_file_type(fullpath,
-                    layerdir + os.sep)
-            if typename == 'recipe':
-                recipe_files.append(fullpath)
+    for path in files:
+        (typename, _) = recipeparse.classify_layer_file(path)
+        if typename == 'recipe':
+            recipe_files.append(os.path.join(layerdir, path))
     return recipe_files
 
 def load_recipes(layerbranch, bitbakepath, fetchdir, settings, logger,
@@ -157,3 +142,108 @@ def get_recipe_pv_without_srcpv(pv, uri_type):
             pfx = m.group('pfx')
 
     return (pv, pfx, sfx)
+
+def check_upstream_versions(checks, checkfunc, jobs, host_limit, timeout, logger, lock=None):
+    """
+    Run upstream version checks in parallel. checks is a list of
+    (name, host, arg) tuples; checkfunc(arg) is called for each in a
+    process forked from this one (so only its result needs to be
+    picklable), with up to jobs processes at once and no more than
+    host_limit of them checking the same host. Checks that raise an
+    exception are given up on, and those taking longer than timeout
+    seconds are killed along with anything they have started (e.g.
+    fetcher commands); a check's slot is only reused once its process
+    has exited. If lock is specified (a multiprocessing lock) it is held
+    while killing a check, so that checks can use it to guard anything
+    they share with this process from being left half-used. Returns the
+    results in the same order as checks, with None for those that didn't
+    complete.
+    """
+    import multiprocessing
+    import signal
+    import time
+    from collections import deque, Counter
+    from multiprocessing.connection import wait
+
+    mp = multiprocessing.get_context('fork')
+    results = [None] * len(checks)
+    pending = deque(range(len(checks)))
+    running = {}
+    hostcount = Counter()
+
+    def run_check(idx, arg, conn):
+        # Put the check in its own process group, so that if it has to be
+        # killed anything it has started goes with it
+        os.setpgid(0, 0)
+        try:
+            result = checkfunc(arg)
+        except Exception as e:
+            logger.exception('%s: upstream check failed: %s' % (checks[idx][0], str(e)))
+            result = None
+        try:
+            conn.send(result)
+        except Exception as e:
+            logger.error('%s: unable to return upstream check result: %s' % (checks[idx][0], str(e)))
+        conn.close()
+
+    def kill_check(proc):
+        for pid in (-proc.pid, proc.pid):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def finish_check(idx, kill=False):
+        proc, conn, _ = running.pop(idx)
+        if kill:
+            if lock:
+                locked = lock.acquire(timeout=timeout)
+            try:
+                kill_check(proc)
+            finally:
+                if lock and locked:
+                    lock.release()
+        proc.join()
+        conn.close()
+        hostcount[checks[idx][1]] -= 1
+
+    try:
+        while pending or running:
+            # Start as many checks as the limits allow, keeping the rest in order
+            deferred = deque()
+            while pending and len(running) < jobs:
+                idx = pending.popleft()
+                host = checks[idx][1]
+                if hostcount[host] >= host_limit:
+                    deferred.append(idx)
+                    continue
+                hostcount[host] += 1
+                conn, child_conn = mp.Pipe(duplex=False)
+                proc = mp.Process(target=run_check, args=(idx, checks[idx][2], child_conn))
+                proc.start()
+                child_conn.close()
+                running[idx] = (proc, conn, time.time())
+            deferred.extend(pending)
+            pending = deferred
+
+            conns = dict([(running[idx][1], idx) for idx in running])
+            for conn in wait(list(conns.keys()), timeout=0.5):
+                idx = conns[conn]
+                try:
+                    results[idx] = conn.recv()
+                except EOFError:
+                    # The process exited without returning a result
+                    logger.warning('%s: upstream check exited unexpectedly' % checks[idx][0])
+                finish_check(idx)
+
+            now = time.time()
+            for idx, (_, _, started) in list(running.items()):
+                if now - started > timeout:
+                    logger.warning('%s: upstream check timed out after %d seconds' % (checks[idx][0], timeout))
+                    finish_check(idx, kill=True)
+    finally:
+        # Don't leave anything running if we're interrupted
+        for idx in list(running.keys()):
+            finish_check(idx, kill=True)
+
+    return results
@@ -22,7 +22,8 @@ from django.db import transaction
 import settings
 
 from layerindex.models import Recipe, LayerBranch, LayerItem
-from rrs.models import MaintenancePlan, Maintainer, RecipeMaintainerHistory, RecipeMaintainer, RecipeMaintenanceLink
+from rrs.models import MaintenancePlan, Maintainer, RecipeMaintainerHistory, RecipeMaintainer, RecipeMaintenanceLink, \
+        MilestoneStatistics
 from django.core.exceptions import ObjectDoesNotExist
 
 # FIXME we shouldn't be hardcoded to expect RECIPE_MAINTAINER to be set in this file,
@@ -199,6 +200,8 @@ def maintainer_history(options, logger):
                 if maintplan.maintainer_style == 'I':
                     # maintainers.inc
                     maintainers_inc_history(options, logger, maintplan, layerbranch, repodir, layerdir)
+                    if not options.dry_run:
+                        MilestoneStatistics.refresh(maintplan, layerbranch)
                 elif maintplan.maintainer_style == 'L':
                     # Layer-wide, don't need to do anything
                     logger.debug('Skipping maintainer processing for %s - plan %s maintainer style is layer-wide' % (layerbranch, maintplan))
@@ -86,7 +86,8 @@ def run_internal(maintplanlayerbranch, commit, commitdate, options, logger, bitb
     Upgrade history handler.
 """
 def upgrade_history(options, logger):
-    from rrs.models import MaintenancePlan, RecipeUpgrade, Release, Milestone
+    from rrs.models import MaintenancePlan, RecipeUpgrade, Release, Milestone, \
+            MilestoneStatistics
 
     if options.plan:
         maintplans = MaintenancePlan.objects.filter(id=int(options.plan))
@@ -201,6 +202,9 @@ def upgrade_history(options, logger):
                             maintplanbranch.upgrade_rev = ct
                             maintplanbranch.upgrade_date = ctdate
                             maintplanbranch.save()
+
+                if not options.dry_run:
+                    MilestoneStatistics.refresh(maintplan, layerbranch)
     finally:
         utils.unlock_file(lockfile)
 
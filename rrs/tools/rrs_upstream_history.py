@@ -11,12 +11,15 @@ import sys
 import os.path
 import optparse
 import logging
-from datetime import datetime
+from datetime import date, datetime
 import shutil
+import json
+import multiprocessing
+import time
 
 sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(__file__))))
 from common import common_setup, load_recipes, \
-        get_pv_type, get_logger, DryRunRollbackException
+        get_pv_type, get_logger, DryRunRollbackException, check_upstream_versions
 common_setup()
 from layerindex import utils
 
@@ -35,8 +38,9 @@ if not fetchdir:
 bitbakepath = os.path.join(fetchdir, 'bitbake')
 sys.path.insert(0, os.path.join(bitbakepath, 'lib'))
 
-from layerindex.models import Recipe, LayerBranch
-from rrs.models import RecipeUpstream, RecipeUpstreamHistory, MaintenancePlan
+from layerindex.models import LayerBranch
+from rrs.models import RecipeUpstream, RecipeUpstreamHistory, MaintenancePlan, \
+        MilestoneStatistics
 
 def set_regexes(d):
     """
@@ -81,29 +85,69 @@ def set_regexes(d):
                     d.getVar(var, True)))
             break
 
-def get_upstream_info(layerbranch, recipe_data, result):
-    from bb.utils import vercmp_string
-    from oe.recipeutils import get_recipe_upstream_version, \
-            get_recipe_pv_without_srcpv
-
-    pn = recipe_data.getVar('PN', True)
-    recipes = Recipe.objects.filter(layerbranch=layerbranch, pn=pn)
-    if not recipes:
-        logger.warning("%s: in layer branch %s not found." % \
-                (pn, str(layerbranch)))
+def get_upstream_host(recipe_data):
+    """
+    Get the host that the upstream check for a recipe is likely to
+    contact, so that we can limit how many checks hit it at once
+    """
+    import bb.fetch2
+
+    uris = (recipe_data.getVar('UPSTREAM_CHECK_URI', True) or
+            recipe_data.getVar('SRC_URI', True) or '').split()
+    if uris:
+        try:
+            return bb.fetch2.decodeurl(uris[0])[1]
+        except Exception:
+            pass
+    return ''
+
+def check_upstream(recipe_data):
+    from oe.recipeutils import get_recipe_upstream_version
+    return get_recipe_upstream_version(recipe_data)
+
+def share_tinfoil(tinfoil, lock):
+    """
+    Recipe data returned by tinfoil looks up variables over the connection
+    to the bitbake server, which the processes that the upstream checks
+    run in inherit; make sure only one of them sends a command and waits
+    for the reply at a time.
+    """
+    if not hasattr(tinfoil, 'run_command'):
+        # Older bitbake, where the data is held locally
         return
-    recipe = recipes[0]
+    run_command = tinfoil.run_command
+    def locked_run_command(*args, **kwargs):
+        with lock:
+            return run_command(*args, **kwargs)
+    tinfoil.run_command = locked_run_command
+
+def get_stub_checker(filename):
+    """
+    Get a function that answers upstream checks from a JSON file instead
+    of contacting upstream, for testing offline. The file maps PN to a
+    dict with "version" and optionally "type" and "delay" (in seconds,
+    to simulate a slow server); recipes not listed get no answer.
+    """
+    with open(filename, 'r') as f:
+        stub = json.load(f)
+
+    def check_stub(recipe_data):
+        info = stub.get(recipe_data.getVar('PN', True))
+        if info is None:
+            return None
+        time.sleep(info.get('delay', 0))
+        return {'version': info['version'],
+                'type': info.get('type', 'A'),
+                'datetime': datetime.now()}
+    return check_stub
+
+def get_upstream_info(recipe, recipe_data, ru_info):
+    from bb.utils import vercmp_string
+    from oe.recipeutils import get_recipe_pv_without_srcpv
 
     ru = RecipeUpstream()
     ru.recipe = recipe
 
-    ru_info = None
-    try:
-        ru_info = get_recipe_upstream_version(recipe_data)
-    except Exception as e:
-        logger.exception("%s: in layer branch %s, %s" % (pn,
-            str(layerbranch), str(e)))
-
     if ru_info is not None and ru_info['version']:
         ru.version = ru_info['version']
         ru.type = ru_info['type']
@@ -134,7 +178,7 @@ def get_upstream_info(layerbranch, recipe_data, result):
     ru.no_update_reason = recipe_data.getVar('RECIPE_NO_UPDATE_REASON',
             True) or ''
 
-    result.append((recipe, ru))
+    return ru
 
 if __name__=="__main__":
     parser = optparse.OptionParser(usage = """%prog [options]""")
@@ -151,9 +195,31 @@ if __name__=="__main__":
             help = "Do not write any data back to the database",
             action="store_true", dest="dry_run", default=False)
 
+    parser.add_option("-j", "--jobs",
+            help = "Number of upstream checks to run at once (default 16)",
+            type="int", action="store", dest="jobs", default=16)
+
+    parser.add_option("--host-limit",
+            help = "Number of upstream checks to run at once against the same host (default 2)",
+            type="int", action="store", dest="host_limit", default=2)
+
+    parser.add_option("--check-timeout",
+            help = "Time in seconds after which to kill an upstream check (default 300)",
+            type="int", action="store", dest="check_timeout", default=300)
+
+    parser.add_option("--stub",
+            help = "Answer upstream checks from the specified JSON file instead of contacting upstream (for testing)",
+            action="store", dest="stub", default=None)
+
     options, args = parser.parse_args(sys.argv)
     logger.setLevel(options.loglevel)
 
+    if options.stub:
+        checkfunc = get_stub_checker(options.stub)
+    else:
+        checkfunc = check_upstream
+    tinfoil_lock = multiprocessing.get_context('fork').RLock()
+
     if options.plan:
         maintplans = MaintenancePlan.objects.filter(id=int(options.plan))
         if not maintplans.exists():
@@ -178,60 +244,78 @@ if __name__=="__main__":
         for maintplan in maintplans:
             for item in maintplan.maintenanceplanlayerbranch_set.all():
                 layerbranch = item.layerbranch
+                sys.path = origsyspath
+
+                layer = layerbranch.layer
+                urldir = layer.get_fetch_dir()
+                repodir = os.path.join(fetchdir, urldir)
+                layerdir = os.path.join(repodir, layerbranch.vcs_subdir)
+
+                recipe_files = []
+                layerrecipes = {}
+                for recipe in layerbranch.recipe_set.order_by('id'):
+                    file = str(os.path.join(layerdir, recipe.full_path()))
+                    recipe_files.append(file)
+                    layerrecipes.setdefault(recipe.pn, recipe)
+
+                (tinfoil, d, recipes, tempdir) = load_recipes(layerbranch, bitbakepath,
+                        fetchdir, settings, logger,  recipe_files=recipe_files)
                 try:
-                    with transaction.atomic():
-                        sys.path = origsyspath
-
-                        layer = layerbranch.layer
-                        urldir = layer.get_fetch_dir()
-                        repodir = os.path.join(fetchdir, urldir)
-                        layerdir = os.path.join(repodir, layerbranch.vcs_subdir)
-
-                        recipe_files = []
-                        for recipe in layerbranch.recipe_set.all():
-                            file = str(os.path.join(layerdir, recipe.full_path()))
-                            recipe_files.append(file)
-
-                        (tinfoil, d, recipes, tempdir) = load_recipes(layerbranch, bitbakepath,
-                                fetchdir, settings, logger,  recipe_files=recipe_files)
+                    if not recipes:
+                        continue
+
+                    share_tinfoil(tinfoil, tinfoil_lock)
+
+                    utils.setup_core_layer_sys_path(settings, layerbranch.branch.name)
+
+                    checks = []
+                    for recipe_data in recipes:
+                        set_regexes(recipe_data)
+                        pn = recipe_data.getVar('PN', True)
+                        if pn not in layerrecipes:
+                            logger.warning("%s: in layer branch %s not found." % \
+                                    (pn, str(layerbranch)))
+                            continue
+                        checks.append((pn, get_upstream_host(recipe_data), recipe_data))
+
+                    # The checks spend most of their time waiting on the network,
+                    # so run them in parallel and only then write to the database
+                    start_date = datetime.now()
+                    ru_infos = check_upstream_versions(checks, checkfunc, options.jobs,
+                            options.host_limit, options.check_timeout, logger, lock=tinfoil_lock)
+                    end_date = datetime.now()
+
+                    result = []
+                    for (pn, _, recipe_data), ru_info in zip(checks, ru_infos):
+                        # Don't let a problem with one recipe stop the rest
+                        # of the layer (or other layers) being recorded
                         try:
-
-                            if not recipes:
-                                continue
-
-                            utils.setup_core_layer_sys_path(settings, layerbranch.branch.name)
-
-                            for recipe_data in recipes:
-                                set_regexes(recipe_data)
-
-                            history = RecipeUpstreamHistory(layerbranch=layerbranch, start_date=datetime.now())
-
-                            result = []
-                            for recipe_data in recipes:
-                                try:
-                                    get_upstream_info(layerbranch, recipe_data, result)
-                                except:
-                                    import traceback
-                                    traceback.print_exc()
-
-                            history.end_date = datetime.now()
+                            result.append(get_upstream_info(layerrecipes[pn], recipe_data, ru_info))
+                        except Exception as e:
+                            logger.exception("%s: in layer branch %s, %s" % (pn,
+                                str(layerbranch), str(e)))
+
+                    try:
+                        with transaction.atomic():
+                            history = RecipeUpstreamHistory(layerbranch=layerbranch,
+                                    start_date=start_date, end_date=end_date)
                             history.save()
 
-                            for res in result:
-                                (recipe, ru) = res
-
+                            for ru in result:
                                 ru.history = history
-                                ru.save()
-
-                                logger.debug('%s: layer branch %s, pv %s, upstream (%s)' % (recipe.pn,
-                                    str(layerbranch), recipe.pv, str(ru)))
-
-                        finally:
-                            tinfoil.shutdown()
-                            shutil.rmtree(tempdir)
-                        if options.dry_run:
-                            raise DryRunRollbackException
-                except DryRunRollbackException:
-                    pass
+                                logger.debug('%s: layer branch %s, pv %s, upstream (%s)' % (ru.recipe.pn,
+                                    str(layerbranch), ru.recipe.pv, str(ru)))
+                            RecipeUpstream.objects.bulk_create(result)
+
+                            # Only milestones covering the new history are affected
+                            MilestoneStatistics.refresh(maintplan, layerbranch, since=date.today())
+
+                            if options.dry_run:
+                                raise DryRunRollbackException
+                    except DryRunRollbackException:
+                        pass
+                finally:
+                    tinfoil.shutdown()
+                    shutil.rmtree(tempdir)
     finally:
         utils.unlock_file(lockfile)
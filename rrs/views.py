@@ -14,7 +14,7 @@ from django.contrib import messages
 from layerindex.models import Recipe, StaticBuildDep, Patch
 from rrs.models import Release, Milestone, Maintainer, RecipeMaintainerHistory, \
         RecipeMaintainer, RecipeUpstreamHistory, RecipeUpstream, \
-        RecipeDistro, RecipeUpgrade, MaintenancePlan
+        RecipeDistro, RecipeUpgrade, MaintenancePlan, MilestoneStatistics
 
 
 
@@ -77,153 +77,63 @@ class Raw():
         remahi: Recipe Maintainer History
     """
 
+    # Recipes in a layer branch as of a date, i.e. those whose upgrade
+    # current at that date is known (see RecipeUpgrade.valid_until).
+    # Parameters: layerbranch_id, date, date
+    milestone_recipes_qry = """SELECT reupg.recipe_id
+                        FROM rrs_recipeupgrade AS reupg
+                        INNER JOIN layerindex_recipe AS re
+                        ON reupg.recipe_id = re.id
+                        WHERE re.layerbranch_id = %s
+                        AND reupg.commit_date <= %s
+                        AND (reupg.valid_until IS NULL OR reupg.valid_until > %s)"""
+
     @staticmethod
-    def get_re_by_mantainer_and_date(maintainer, date_id):
-        """ Get Recipes based on Maintainer and Recipe Maintainer History """
-        recipes = []
+    def get_ma_by_layerbranch_and_date(layerbranch_id, date, history_id):
+        """ Get Maintainers of the milestone Recipes from a Recipe Maintainer History """
         cur = connection.cursor()
-
-        cur.execute("""SELECT DISTINCT rema.recipe_id
+        cur.execute("""SELECT rema.recipe_id, ma.name
                         FROM rrs_recipemaintainer AS rema
                         INNER JOIN rrs_maintainer AS ma
                         ON rema.maintainer_id = ma.id
-                        WHERE rema.history_id = %s 
-                        AND ma.name = %s;
-                    """, [date_id, maintainer])
-
-        for re in cur.fetchall():
-            recipes.append(re[0])
-        return recipes
-
-    @staticmethod
-    def get_ma_by_recipes_and_date(recipes_id, date_id=None):
-        """ Get Maintainer based on Recipes and Recipe Upstream History """
-        stats = []
-        recipes = str(recipes_id).strip('[]')
-
-        if date_id:
-            qry = """SELECT rema.recipe_id, ma.name
-                    FROM rrs_recipemaintainer AS rema
-                    INNER JOIN rrs_maintainer AS ma
-                    ON rema.maintainer_id = ma.id"""
-            qry += "\nWHERE rema.history_id = '%s'" % str(date_id)
-            qry += "\nAND rema.recipe_id IN (%s);" % recipes
-            cur = connection.cursor()
-            cur.execute(qry)
-            stats = Raw.dictfetchall(cur)
-
-        return stats
-
-    @staticmethod
-    def get_reup_statistics(maintplan, date, date_id):
-        """ Special case to get recipes statistics removing gcc-source duplicates """
-        recipes = []
-        updated = 0
-        not_updated = 0
-        cant = 0
-        unknown = 0
-
-        for maintplanlayer in maintplan.maintenanceplanlayerbranch_set.all():
-            layerbranch = maintplanlayer.layerbranch
-            layerbranch_recipes = Raw.get_reupg_by_date(layerbranch.id, date)
-            for re in layerbranch_recipes:
-                recipes.append(re["id"])
-
-        if date_id and recipes:
-            recipes = str(recipes).strip('[]')
-            qry = """SELECT id, status, no_update_reason
-                    FROM rrs_recipeupstream"""
-            qry += "\nWHERE history_id = '%s'" % str(date_id.id)
-            qry += "\nAND recipe_id IN (%s);" % recipes
-            cur = connection.cursor()
-            cur.execute(qry)
-
-            for re in Raw.dictfetchall(cur):
-                if re["status"] == "Y":
-                    updated += 1
-                elif re["status"]  == "N" and re["no_update_reason"] == "":
-                    not_updated += 1
-                elif re["status"] == "N":
-                    cant += 1
-                # We count downgrade as unknown
-                else:
-                    unknown += 1
-
-        return (updated, not_updated, cant, unknown)
-
-    @staticmethod
-    def get_reup_by_recipes_and_date(recipes_id, date_id=None):
-        """ Get Recipe Upstream based on Recipes and Recipe Upstream History """
-        stats = []
-        recipes = str(recipes_id).strip('[]')
-
-        if date_id:
-            qry = """SELECT recipe_id, status, no_update_reason, version
-                    FROM rrs_recipeupstream"""
-            qry += "\nWHERE history_id = '%s'" % str(date_id)
-            qry += "\nAND recipe_id IN (%s);" % recipes
-            cur = connection.cursor()
-            cur.execute(qry)
-            stats = Raw.dictfetchall(cur)
-
-        return stats
+                        WHERE rema.history_id = %s
+                        AND rema.recipe_id IN (""" + Raw.milestone_recipes_qry + """);
+                    """, [history_id, layerbranch_id, date, date])
+        return Raw.dictfetchall(cur)
 
     @staticmethod
-    def get_reup_by_last_updated(layerbranch_id, date):
-        """ Get last time the Recipes were upgraded """
+    def get_reup_by_layerbranch_and_date(layerbranch_id, date, history_id):
+        """ Get Recipe Upstream of the milestone Recipes from a Recipe Upstream History """
         cur = connection.cursor()
-        cur.execute("""SELECT recipe_id, MAX(commit_date) AS date
-                       FROM rrs_recipeupgrade
-                       INNER JOIN layerindex_recipe AS re
-                       ON rrs_recipeupgrade.recipe_id = re.id
-                       WHERE commit_date <= %s
-                       AND re.layerbranch_id = %s
-                       GROUP BY recipe_id;
-                    """, [date, layerbranch_id])
+        cur.execute("""SELECT recipe_id, status, no_update_reason, version
+                        FROM rrs_recipeupstream
+                        WHERE history_id = %s
+                        AND recipe_id IN (""" + Raw.milestone_recipes_qry + """);
+                    """, [history_id, layerbranch_id, date, date])
         return Raw.dictfetchall(cur)
 
     @staticmethod
-    def get_reup_by_date(date_id):
-        """ Get Recipes not up to date based on Recipe Upstream History """
-        cur = connection.cursor()
-        cur.execute("""SELECT DISTINCT recipe_id
-                        FROM rrs_recipeupstream
-                        WHERE status = 'N'
-                        AND history_id = %s
-                    """, [date_id])
-        return [i[0] for i in cur.fetchall()]
+    def get_reup_by_last_updated(layerbranch_id, date):
+        """ Get last time the Recipes were upgraded """
+        from django.db.models import Max
+        # Use the ORM so that the dates come back as datetimes on all databases
+        qry = RecipeUpgrade.objects.filter(commit_date__lte=date,
+                recipe__layerbranch_id=layerbranch_id)
+        return list(qry.values('recipe_id').annotate(date=Max('commit_date')).order_by())
 
     @staticmethod
     def get_reupg_by_date(layerbranch_id, date):
         """ Get info for Recipes for the milestone """
         cur = connection.cursor()
-        cur.execute("""SELECT re.id, re.pn, re.summary, te.version, rownum FROM (
-                            SELECT recipe_id, version, commit_date, ROW_NUMBER() OVER(
-                                PARTITION BY recipe_id
-                                ORDER BY commit_date DESC
-                            ) AS rownum
-                        FROM rrs_recipeupgrade
-                        WHERE commit_date <= %s) AS te
+        cur.execute("""SELECT re.id, re.pn, re.summary, reupg.version
+                        FROM rrs_recipeupgrade AS reupg
                         INNER JOIN layerindex_recipe AS re
-                        ON te.recipe_id = re.id
-                        WHERE rownum = 1
-                        AND re.layerbranch_id = %s
+                        ON reupg.recipe_id = re.id
+                        WHERE re.layerbranch_id = %s
+                        AND reupg.commit_date <= %s
+                        AND (reupg.valid_until IS NULL OR reupg.valid_until > %s)
                         ORDER BY re.pn;
-                        """, [date, layerbranch_id])
-        return Raw.dictfetchall(cur)
-
-    @staticmethod
-    def get_reupg_by_dates_and_recipes(start_date, end_date, recipes_id):
-        """  Get Recipe Upgrade for the milestone based on Recipes """
-        recipes = str(recipes_id).strip('[]')
-
-        cur = connection.cursor()
-        qry = """SELECT DISTINCT recipe_id
-                FROM rrs_recipeupgrade"""
-        qry += "\nWHERE commit_date >= '%s'" % str(start_date)
-        qry += "\nAND commit_date <= '%s'" % str(end_date)
-        qry += "\nAND recipe_id IN (%s);" % recipes
-        cur.execute(qry)
+                        """, [layerbranch_id, date, date])
         return Raw.dictfetchall(cur)
 
     @staticmethod
@@ -262,7 +172,7 @@ class Raw():
         ]
 
 
-def _get_milestone_statistics(milestone, maintainer_name=None):
+def _get_milestone_statistics(milestone, maintainer_name=None, stats=None):
     milestone_statistics = {}
 
     milestone_statistics['all'] = 0
@@ -275,65 +185,22 @@ def _get_milestone_statistics(milestone, maintainer_name=None):
         milestone_statistics['all_upgraded'] = 0
         milestone_statistics['all_not_upgraded'] = 0
 
-    for maintplanlayer in milestone.release.plan.maintenanceplanlayerbranch_set.all():
-        layerbranch = maintplanlayer.layerbranch
-
-        recipe_upstream_history = RecipeUpstreamHistory.get_last_by_date_range(
-            layerbranch,
-            milestone.start_date,
-            milestone.end_date
-        )
-        recipe_upstream_history_first = \
-            RecipeUpstreamHistory.get_first_by_date_range(
-                layerbranch,
-                milestone.start_date,
-                milestone.end_date,
-        )
+    if stats is None:
+        stats = MilestoneStatistics.get_by_milestone(milestone)
 
+    for ms in stats:
         if maintainer_name is None:
-            t_updated, t_not_updated, t_cant, t_unknown = \
-                Raw.get_reup_statistics(milestone.release.plan, milestone.end_date, recipe_upstream_history)
-            milestone_statistics['all'] += \
-                t_updated + t_not_updated + t_cant + t_unknown
-            milestone_statistics['up_to_date'] = +t_updated
-            milestone_statistics['not_updated'] = +t_not_updated
-            milestone_statistics['cant_be_updated'] += t_cant
-            milestone_statistics['unknown'] += t_unknown
-
-            if recipe_upstream_history_first:
-                recipes_not_upgraded = \
-                    Raw.get_reup_by_date(recipe_upstream_history_first.id)
-                if recipes_not_upgraded:
-                    recipes_upgraded = \
-                        Raw.get_reupg_by_dates_and_recipes(
-                            milestone.start_date, milestone.end_date, recipes_not_upgraded)
-                    milestone_statistics['all_upgraded'] += len(recipes_upgraded)
-                    milestone_statistics['all_not_upgraded'] += len(recipes_not_upgraded)
-
-        else:
-            recipe_maintainer_history = Raw.get_remahi_by_end_date(
-                    layerbranch.id, milestone.end_date)
-            recipe_maintainer_all = Raw.get_re_by_mantainer_and_date(
-                    maintainer_name, recipe_maintainer_history[0])
-            milestone_statistics['all'] += len(recipe_maintainer_all)
-            if recipe_upstream_history:
-                recipe_upstream_all = Raw.get_reup_by_recipes_and_date(
-                        recipe_maintainer_all, recipe_upstream_history.id)
-            else:
-                recipe_upstream_all = Raw.get_reup_by_recipes_and_date(
-                        recipe_maintainer_all)
-
-            for ru in recipe_upstream_all:
-                if ru['status'] == 'Y':
-                    milestone_statistics['up_to_date'] += 1
-                elif ru['status'] == 'N':
-                    if ru['no_update_reason'] == '':
-                        milestone_statistics['not_updated'] += 1
-                    else:
-                        milestone_statistics['cant_be_updated'] += 1
-                else:
-                    milestone_statistics['unknown'] += 1
-
+            if ms.maintainer_id is not None:
+                continue
+            milestone_statistics['all_upgraded'] += ms.upgraded
+            milestone_statistics['all_not_upgraded'] += ms.not_upgraded
+        elif ms.maintainer_id is None or ms.maintainer.name != maintainer_name:
+            continue
+        milestone_statistics['all'] += ms.recipes
+        milestone_statistics['up_to_date'] += ms.up_to_date
+        milestone_statistics['not_updated'] += ms.not_updated
+        milestone_statistics['cant_be_updated'] += ms.cant_be_updated
+        milestone_statistics['unknown'] += ms.unknown
 
     milestone_statistics['percentage'] = '0'
     if maintainer_name is None:
@@ -384,15 +251,17 @@ class RecipeList():
         self.summary = summary
 
 def _get_recipe_list(milestone):
+    from django.db.models import Count, Case, When, IntegerField
+
     recipe_list = []
-    recipes_ids = []
-    recipe_upstream_dict_all = {}
-    recipe_last_updated_dict_all = {}
-    maintainers_dict_all = {}
     current_date = date.today()
 
     for maintplanlayer in milestone.release.plan.maintenanceplanlayerbranch_set.all():
         layerbranch = maintplanlayer.layerbranch
+        recipe_upstream_dict_all = {}
+        recipe_last_updated_dict_all = {}
+        maintainers_dict_all = {}
+        patches_dict_all = {}
 
         recipe_maintainer_history = Raw.get_remahi_by_end_date(layerbranch.id,
                     milestone.end_date)
@@ -404,82 +273,85 @@ def _get_recipe_list(milestone):
         )
 
         recipes = Raw.get_reupg_by_date(layerbranch.id, milestone.end_date)
-        for i,re in enumerate(recipes):
-            if 'pv' in re:
-                recipes[i]['version'] = re['pv']
-            recipes_ids.append(re['id'])
-
-        if recipes:
-            recipe_last_updated = Raw.get_reup_by_last_updated(
-                    layerbranch.id, milestone.end_date)
-            for rela in recipe_last_updated:
-                recipe_last_updated_dict_all[rela['recipe_id']] = rela
+        if not recipes:
+            continue
 
-            if recipe_upstream_history:
-                recipe_upstream_all = Raw.get_reup_by_recipes_and_date(
-                    recipes_ids, recipe_upstream_history.id)
-                for reup in recipe_upstream_all:
-                    recipe_upstream_dict_all[reup['recipe_id']] = reup
-
-            if recipe_maintainer_history:
-                maintainers_all = Raw.get_ma_by_recipes_and_date(
-                    recipes_ids, recipe_maintainer_history[0])
-                for ma in maintainers_all:
-                    maintainers_dict_all[ma['recipe_id']] = ma['name']
-
-    for recipe in recipes:
-        upstream_version = ''
-        upstream_status = ''
-        no_update_reason = ''
-        outdated = ''
+        recipe_last_updated = Raw.get_reup_by_last_updated(
+                layerbranch.id, milestone.end_date)
+        for rela in recipe_last_updated:
+            recipe_last_updated_dict_all[rela['recipe_id']] = rela
 
         if recipe_upstream_history:
-            recipe_upstream = recipe_upstream_dict_all.get(recipe['id'])
-            if not recipe_upstream:
-                recipe_add =  Recipe.objects.filter(id = recipe['id'])[0]
-                recipe_upstream_add = RecipeUpstream()
-                recipe_upstream_add.history = recipe_upstream_history
-                recipe_upstream_add.recipe = recipe_add
-                recipe_upstream_add.version = ''
-                recipe_upstream_add.type = 'M' # Manual
-                recipe_upstream_add.status = 'U' # Unknown
-                recipe_upstream_add.no_update_reason = ''
-                recipe_upstream_add.date = recipe_upstream_history.end_date
-                recipe_upstream_add.save()
-                recipe_upstream = {'version': '', 'status': 'U', 'type': 'M',
-                        'no_update_reason': ''}
-
-            if recipe_upstream['status'] == 'N' and recipe_upstream['no_update_reason']:
-                recipe_upstream['status'] = 'C'
-            upstream_status = \
-                    RecipeUpstream.RECIPE_UPSTREAM_STATUS_CHOICES_DICT[
-                        recipe_upstream['status']]
-            if upstream_status == 'Downgrade':
-                upstream_status = 'Unknown' # Downgrade is displayed as Unknown
-            upstream_version = recipe_upstream['version']
-            no_update_reason = recipe_upstream['no_update_reason']
-
-            #Get how long the recipe hasn't been updated
-            recipe_last_updated = \
-                recipe_last_updated_dict_all.get(recipe['id'])
-            if recipe_last_updated:
-                recipe_date = recipe_last_updated['date']
-                outdated = recipe_date.date().isoformat()
-            else:
-                outdated = ""
-
-        maintainer_name =  maintainers_dict_all.get(recipe['id'], '')
-        recipe_list_item = RecipeList(recipe['id'], recipe['pn'], recipe['summary'])
-        recipe_list_item.version = recipe['version']
-        recipe_list_item.upstream_status = upstream_status
-        recipe_list_item.upstream_version = upstream_version
-        recipe_list_item.outdated = outdated
-        patches = Patch.objects.filter(recipe__id=recipe['id'])
-        recipe_list_item.patches_total = patches.count()
-        recipe_list_item.patches_pending = patches.filter(status='P').count()
-        recipe_list_item.maintainer_name = maintainer_name
-        recipe_list_item.no_update_reason = no_update_reason
-        recipe_list.append(recipe_list_item)
+            recipe_upstream_all = Raw.get_reup_by_layerbranch_and_date(
+                layerbranch.id, milestone.end_date, recipe_upstream_history.id)
+            for reup in recipe_upstream_all:
+                recipe_upstream_dict_all[reup['recipe_id']] = reup
+
+        if recipe_maintainer_history:
+            maintainers_all = Raw.get_ma_by_layerbranch_and_date(
+                layerbranch.id, milestone.end_date, recipe_maintainer_history[0])
+            for ma in maintainers_all:
+                maintainers_dict_all[ma['recipe_id']] = ma['name']
+
+        patches = Patch.objects.filter(recipe__layerbranch=layerbranch).values('recipe_id')
+        patches = patches.annotate(total=Count('id'),
+                pending=Count(Case(When(status='P', then=1), output_field=IntegerField())))
+        for patch in patches.order_by():
+            patches_dict_all[patch['recipe_id']] = patch
+
+        for recipe in recipes:
+            upstream_version = ''
+            upstream_status = ''
+            no_update_reason = ''
+            outdated = ''
+
+            if recipe_upstream_history:
+                recipe_upstream = recipe_upstream_dict_all.get(recipe['id'])
+                if not recipe_upstream:
+                    recipe_add =  Recipe.objects.filter(id = recipe['id'])[0]
+                    recipe_upstream_add = RecipeUpstream()
+                    recipe_upstream_add.history = recipe_upstream_history
+                    recipe_upstream_add.recipe = recipe_add
+                    recipe_upstream_add.version = ''
+                    recipe_upstream_add.type = 'M' # Manual
+                    recipe_upstream_add.status = 'U' # Unknown
+                    recipe_upstream_add.no_update_reason = ''
+                    recipe_upstream_add.date = recipe_upstream_history.end_date
+                    recipe_upstream_add.save()
+                    recipe_upstream = {'version': '', 'status': 'U', 'type': 'M',
+                            'no_update_reason': ''}
+
+                if recipe_upstream['status'] == 'N' and recipe_upstream['no_update_reason']:
+                    recipe_upstream['status'] = 'C'
+                upstream_status = \
+                        RecipeUpstream.RECIPE_UPSTREAM_STATUS_CHOICES_DICT[
+                            recipe_upstream['status']]
+                if upstream_status == 'Downgrade':
+                    upstream_status = 'Unknown' # Downgrade is displayed as Unknown
+                upstream_version = recipe_upstream['version']
+                no_update_reason = recipe_upstream['no_update_reason']
+
+                #Get how long the recipe hasn't been updated
+                recipe_last_updated = \
+                    recipe_last_updated_dict_all.get(recipe['id'])
+                if recipe_last_updated:
+                    recipe_date = recipe_last_updated['date']
+                    outdated = recipe_date.date().isoformat()
+                else:
+                    outdated = ""
+
+            maintainer_name =  maintainers_dict_all.get(recipe['id'], '')
+            recipe_list_item = RecipeList(recipe['id'], recipe['pn'], recipe['summary'])
+            recipe_list_item.version = recipe['version']
+            recipe_list_item.upstream_status = upstream_status
+            recipe_list_item.upstream_version = upstream_version
+            recipe_list_item.outdated = outdated
+            patches = patches_dict_all.get(recipe['id'])
+            recipe_list_item.patches_total = patches['total'] if patches else 0
+            recipe_list_item.patches_pending = patches['pending'] if patches else 0
+            recipe_list_item.maintainer_name = maintainer_name
+            recipe_list_item.no_update_reason = no_update_reason
+            recipe_list.append(recipe_list_item)
 
     return recipe_list
 
@@ -742,6 +614,39 @@ class RecipeDetailView(DetailView):
 
         return context
 
+def _get_upgrade_interval_counts(intervals):
+    """
+    Count the upgrades done by each maintainer within each of the specified
+    intervals, returning a dict of maintainer name -> list of counts in
+    interval order
+    """
+    from django.db.models import Case, When, Value, IntegerField, Count
+
+    keys = sorted(intervals.keys())
+    if not keys:
+        return {}
+
+    # Put each upgrade into an interval within the database so that we only
+    # need a single grouped query rather than one per maintainer and interval
+    whens = []
+    for idx, i in enumerate(keys):
+        whens.append(When(commit_date__gte=intervals[i]['start_date'],
+                          commit_date__lte=intervals[i]['end_date'],
+                          then=Value(idx)))
+    qry = RecipeUpgrade.objects.filter(
+            commit_date__gte=min([intervals[i]['start_date'] for i in keys]),
+            commit_date__lte=max([intervals[i]['end_date'] for i in keys]))
+    qry = qry.annotate(interval=Case(*whens, output_field=IntegerField()))
+    qry = qry.values('maintainer__name', 'interval').annotate(number=Count('id')).order_by()
+
+    interval_counts = {}
+    for row in qry:
+        if row['interval'] is None:
+            continue
+        counts = interval_counts.setdefault(row['maintainer__name'], [0] * len(keys))
+        counts[row['interval']] = row['number']
+    return interval_counts
+
 class MaintainerList():
     name = None
     recipes_all = 0
@@ -778,27 +683,24 @@ class MaintainerListView(ListView):
             intervals = milestone.get_week_intervals()
             interval_type = 'Week'
 
-        self.milestone_statistics = _get_milestone_statistics(milestone)
-
-        self.maintainer_count = 0
-        for maintplanlayer in maintplan.maintenanceplanlayerbranch_set.all():
-            layerbranch = maintplanlayer.layerbranch
-
-            recipe_maintainer_history = RecipeMaintainerHistory.get_by_end_date(
-                layerbranch, milestone.end_date)
-
-            if recipe_maintainer_history:
-                for rm in RecipeMaintainer.objects.filter(history =
-                        recipe_maintainer_history).values(
-                        'maintainer__name').distinct().order_by('maintainer__name'):
-                    maintainer_list.append(MaintainerList(rm['maintainer__name']))
+        stats = MilestoneStatistics.get_by_milestone(milestone)
+        self.milestone_statistics = _get_milestone_statistics(milestone, stats=stats)
 
-                self.maintainer_count += len(maintainer_list)
+        maintainer_names = set([ms.maintainer.name for ms in stats if ms.maintainer_id is not None])
+        for name in sorted(maintainer_names):
+            maintainer_list.append(MaintainerList(name))
+        self.maintainer_count = len(maintainer_list)
 
         self.intervals = sorted(intervals.keys())
         current_date = date.today()
+        self.current_interval = -1
+        for idx, i in enumerate(self.intervals):
+            if current_date >= intervals[i]['start_date'] and current_date <= intervals[i]['end_date']:
+                self.current_interval = idx
+        interval_counts = _get_upgrade_interval_counts(intervals)
+
         for ml in maintainer_list:
-            milestone_statistics = _get_milestone_statistics(milestone, ml.name)
+            milestone_statistics = _get_milestone_statistics(milestone, ml.name, stats)
             ml.recipes_all = milestone_statistics['all']
             ml.recipes_up_to_date = ('' if milestone_statistics['up_to_date'] == 0
                     else milestone_statistics['up_to_date'])
@@ -810,19 +712,8 @@ class MaintainerListView(ListView):
                     else milestone_statistics['unknown'])
             ml.percentage_done = milestone_statistics['percentage'] + '%'
 
-            ml.interval_statistics = []
-            self.current_interval = -1
-            for idx, i in enumerate(sorted(intervals.keys())):
-                start_date = intervals[i]['start_date']
-                end_date = intervals[i]['end_date']
-
-                if current_date >= start_date and current_date <= end_date:
-                    self.current_interval = idx
-
-                number = RecipeUpgrade.objects.filter(maintainer__name = ml.name,
-                        commit_date__gte = start_date,
-                        commit_date__lte = end_date).count()
-                ml.interval_statistics.append('' if number == 0 else number)
+            ml.interval_statistics = ['' if number == 0 else number
+                    for number in interval_counts.get(ml.name, [0] * len(self.intervals))]
 
         # To add Wk prefix after get statics to avoid sorting problems
         if interval_type == 'Week':
@@ -205,6 +205,28 @@ LOGIN_REDIRECT_URL = '/layerindex'
 # Full path to directory where layers should be fetched into by the update script
 LAYER_FETCH_DIR = ""
 
+# How the update script fetches layer repositories:
+#   'full': a standalone clone of each repository
+#   'shared': clones share a single object store in LAYER_FETCH_DIR (using
+#       git alternates), saving a lot of space where repositories are forks
+#       of each other (e.g. of poky / openembedded-core)
+#   'blobless': new clones are partial clones that only fetch file contents
+#       when they are needed (requires git 2.19 or later on both ends)
+LAYER_FETCH_MODE = 'full'
+
+# Set to True to check out layer repositories for each branch in a separate
+# git worktree (within a ".worktrees" subdirectory of LAYER_FETCH_DIR) rather
+# than in the clones themselves, so that updating several branches doesn't
+# need to keep switching the checkouts back and forth. Worktrees are kept
+# between updates and removed when their branch or repository goes away.
+LAYER_WORKTREES = False
+
+# Full path to directory in which to cache the results of parsing recipes, so
+# that reloading a layer only needs to parse the recipes whose files (or the
+# configuration, BitBake or the core layer) have changed. Leave empty to
+# disable; delete the directory contents to clear the cache.
+PARSE_CACHE_DIR = ""
+
 # Base temporary directory in which to create a directory in which to run BitBake
 TEMP_BASE_DIR = "/tmp"
 
@@ -235,9 +257,13 @@ SEND_PUBLISH_EMAIL = True
 RABBIT_BROKER = 'amqp://'
 RABBIT_BACKEND = 'rpc://'
 
-# Used for fetching repo
+# Number of parallel jobs used for fetching repositories and updating layers
 PARALLEL_JOBS = "4"
 
+# Number of layers each update_layer.py worker process updates before it is
+# replaced with a fresh one (set to 1 to use a new process for every layer)
+UPDATE_WORKER_MAX_LAYERS = 20
+
 # Full path to directory to store logs for dynamically executed tasks
 TASK_LOG_DIR = "/tmp/layerindex-task-logs"
 
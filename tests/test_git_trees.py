@@ -0,0 +1,128 @@
+# layerindex-web - tests for git helpers (tree hashes, worktrees)
+#
+# Copyright (C) 2018 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# NOTE: requires pytest-django. Run using "pytest" from the root
+# of the repository
+
+import sys
+import os
+import subprocess
+import pytest
+import logging
+from types import SimpleNamespace
+
+basepath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(basepath, 'layerindex'))
+
+import utils
+import recipeparse
+
+
+def git(repodir, *args):
+    return subprocess.check_output(['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com'] + list(args), cwd=repodir).decode('utf-8').strip()
+
+def write_file(repodir, path, content):
+    fullpath = os.path.join(repodir, path)
+    os.makedirs(os.path.dirname(fullpath), exist_ok=True)
+    with open(fullpath, 'w') as f:
+        f.write(content)
+
+@pytest.fixture
+def repodir(tmpdir):
+    repodir = str(tmpdir)
+    git(repodir, 'init', '-q')
+    for layer in ['meta-one', 'meta-two']:
+        write_file(repodir, '%s/conf/layer.conf' % layer, 'BBFILE_COLLECTIONS += "%s"\n' % layer)
+    git(repodir, 'add', '.')
+    git(repodir, 'commit', '-q', '-m', 'Initial commit')
+    return repodir
+
+def test_subdir_tree_hashes(repodir):
+    import git as gitpython
+    repo = gitpython.Repo(repodir)
+    before = utils.get_subdir_tree_hashes(repodir, 'HEAD', ['meta-one', 'meta-two/', 'meta-missing', ''])
+    assert sorted(before.keys()) == ['meta-one', 'meta-two']
+    for subdir, treehash in before.items():
+        assert utils.get_layer_tree_hash(repo.commit('HEAD'), subdir) == treehash
+    assert utils.get_layer_tree_hash(repo.commit('HEAD'), 'meta-missing') == ''
+    assert utils.get_layer_tree_hash(repo.commit('HEAD'), '') == repo.commit('HEAD').tree.hexsha
+
+    # Only the tree for the subdirectory that changed should differ
+    write_file(repodir, 'meta-two/recipes-test/test.bb', 'LICENSE = "MIT"\n')
+    git(repodir, 'add', '.')
+    git(repodir, 'commit', '-q', '-m', 'Add recipe')
+    after = utils.get_subdir_tree_hashes(repodir, 'HEAD', ['meta-one', 'meta-two'])
+    assert after['meta-one'] == before['meta-one']
+    assert after['meta-two'] != before['meta-two']
+
+def test_worktrees(tmpdir):
+    fetchdir = str(tmpdir)
+    repodir = os.path.join(fetchdir, 'git___example_com_meta-test')
+    os.makedirs(repodir)
+    git(repodir, 'init', '-q')
+    write_file(repodir, 'conf/layer.conf', 'LAYERVERSION = "1"\n')
+    git(repodir, 'add', '.')
+    git(repodir, 'commit', '-q', '-m', 'Initial commit')
+    first = git(repodir, 'rev-parse', 'HEAD')
+    write_file(repodir, 'conf/layer.conf', 'LAYERVERSION = "2"\n')
+    git(repodir, 'commit', '-q', '-a', '-m', 'Bump version')
+    second = git(repodir, 'rev-parse', 'HEAD')
+    urldir = os.path.basename(repodir)
+    logger = logging.getLogger('test')
+
+    settings = SimpleNamespace(LAYER_FETCH_DIR=fetchdir, LAYER_WORKTREES=False)
+    assert utils.get_layer_checkout_dir(settings, 'master') == fetchdir
+    assert utils.checkout_layer_repo(settings, urldir, 'master', first, logger=logger) == repodir
+    assert git(repodir, 'rev-parse', 'HEAD') == first
+    git(repodir, 'checkout', '-q', second)
+
+    # Each branch gets its own worktree, leaving the clone itself alone
+    settings.LAYER_WORKTREES = True
+    olddir = utils.checkout_layer_repo(settings, urldir, 'old', first, logger=logger)
+    newdir = utils.checkout_layer_repo(settings, urldir, 'master', second, logger=logger)
+    assert olddir == os.path.join(utils.get_layer_checkout_dir(settings, 'old'), urldir)
+    assert git(olddir, 'rev-parse', 'HEAD') == first
+    assert git(newdir, 'rev-parse', 'HEAD') == second
+    assert git(repodir, 'rev-parse', 'HEAD') == second
+    with open(os.path.join(olddir, 'conf', 'layer.conf')) as f:
+        assert f.read() == 'LAYERVERSION = "1"\n'
+
+    # Existing worktrees are reused (and cleaned up)
+    write_file(olddir, 'conf/untracked.conf', '')
+    assert utils.checkout_layer_repo(settings, urldir, 'old', second, logger=logger) == olddir
+    assert git(olddir, 'rev-parse', 'HEAD') == second
+    assert not os.path.exists(os.path.join(olddir, 'conf', 'untracked.conf'))
+
+    utils.prune_worktrees(settings, ['master'], logger=logger)
+    assert not os.path.exists(olddir)
+    assert os.path.exists(newdir)
+    assert len(git(repodir, 'worktree', 'list').splitlines()) == 2
+
+def test_list_layer_files(repodir):
+    for path in ['recipes-test/test/test_1.0.bb', 'recipes-test/test/test_%.bbappend', 'conf/machine/testmachine.conf', 'conf/distro/testdistro.conf', 'classes/test.bbclass', 'README', 'meta-nested/conf/layer.conf', 'meta-nested/recipes-test/nested.bb']:
+        write_file(repodir, 'meta-one/%s' % path, '')
+    git(repodir, 'add', '.')
+    git(repodir, 'commit', '-q', '-m', 'Add files')
+    # Untracked files should be ignored
+    write_file(repodir, 'meta-one/recipes-test/untracked.bb', '')
+
+    files, sublayers = utils.list_layer_files(os.path.join(repodir, 'meta-one'), 'HEAD')
+    assert sublayers == ['meta-nested/']
+    assert sorted(files) == ['README', 'classes/test.bbclass', 'conf/distro/testdistro.conf', 'conf/layer.conf', 'conf/machine/testmachine.conf', 'recipes-test/test/test_%.bbappend', 'recipes-test/test/test_1.0.bb']
+    assert [recipeparse.classify_layer_file(path) for path in sorted(files)] == [
+        (None, None),
+        ('bbclass', 'test'),
+        ('distro', 'testdistro'),
+        (None, None),
+        ('machine', 'testmachine'),
+        ('bbappend', 'test_%.bbappend'),
+        ('recipe', 'test_1.0.bb'),
+    ]
+
+    # Listing an older revision shouldn't need it to be checked out
+    files, sublayers = utils.list_layer_files(os.path.join(repodir, 'meta-one'), 'HEAD~1')
+    assert files == ['conf/layer.conf']
+    assert sublayers == []
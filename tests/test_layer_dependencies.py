@@ -0,0 +1,111 @@
+# layerindex-web - tests for recursive layer dependency resolution
+#
+# Copyright (C) 2018 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# NOTE: requires pytest-django. Run using "pytest" from the root
+# of the repository
+
+import json
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+def add_layer(branch, name):
+    from layerindex.models import LayerItem, LayerBranch
+    layer = LayerItem.objects.create(name=name, status='P', layer_type='M', summary=name, description=name, vcs_url='git://example.com/%s' % name)
+    return LayerBranch.objects.create(layer=layer, branch=branch)
+
+def add_dep(layerbranch, deplayerbranch, required=True):
+    from layerindex.models import LayerDependency
+    return LayerDependency.objects.create(layerbranch=layerbranch, dependency=deplayerbranch.layer, required=required)
+
+def dep_names(layerbranch, required=True):
+    from layerindex.models import LayerBranch
+    # Use a fresh instance so that the cached value is read from the database
+    layerbranch = LayerBranch.objects.get(id=layerbranch.id)
+    return [lb.layer.name for lb in layerbranch.get_recursive_dependencies(required=required)]
+
+@pytest.fixture
+def layers(db):
+    from layerindex.models import Branch
+    branch = Branch.objects.create(name='master', bitbake_branch='master')
+    layers = {}
+    for name in ['openembedded-core', 'meta-oe', 'meta-python', 'meta-networking', 'meta-app']:
+        layers[name] = add_layer(branch, name)
+    add_dep(layers['meta-oe'], layers['openembedded-core'])
+    add_dep(layers['meta-python'], layers['meta-oe'])
+    add_dep(layers['meta-python'], layers['openembedded-core'])
+    add_dep(layers['meta-networking'], layers['meta-oe'])
+    add_dep(layers['meta-networking'], layers['meta-python'], required=False)
+    add_dep(layers['meta-app'], layers['meta-networking'])
+    # Circular dependencies shouldn't be a problem
+    add_dep(layers['openembedded-core'], layers['meta-app'], required=False)
+    return layers
+
+def test_recursive_dependencies(layers):
+    assert dep_names(layers['openembedded-core']) == []
+    assert dep_names(layers['meta-python']) == ['meta-oe', 'openembedded-core']
+    assert dep_names(layers['meta-app']) == ['meta-networking', 'meta-oe', 'openembedded-core']
+    assert dep_names(layers['meta-app'], required=False) == ['meta-networking', 'meta-oe', 'openembedded-core', 'meta-python']
+    assert dep_names(layers['openembedded-core'], required=False) == ['meta-app', 'meta-networking', 'meta-oe', 'meta-python']
+    layerbranch = layers['meta-app']
+    assert [lb.layer.name for lb in layerbranch.get_recursive_dependencies(include_self=True)] == ['meta-app', 'meta-networking', 'meta-oe', 'openembedded-core']
+
+def test_dependency_cache(layers):
+    from layerindex.models import LayerBranch
+    layerbranch = LayerBranch.objects.get(id=layers['meta-app'].id)
+    layerbranch.get_recursive_dependencies()
+    with CaptureQueriesContext(connection) as ctx:
+        assert dep_names(layerbranch) == ['meta-networking', 'meta-oe', 'openembedded-core']
+    # One query to get the layer branch and one for the dependencies
+    assert len(ctx.captured_queries) == 2
+
+    # Saving a layer branch excluding the cached value shouldn't write
+    # back a stale copy of it
+    layerbranch.dependency_closure = json.dumps({'required': [], 'all': []})
+    layerbranch.save(update_fields=LayerBranch.fields_except_closure())
+    assert dep_names(layerbranch) == ['meta-networking', 'meta-oe', 'openembedded-core']
+
+    # Adding or removing dependencies anywhere on the branch should invalidate it
+    dep = add_dep(layers['meta-oe'], layers['meta-python'])
+    assert LayerBranch.objects.get(id=layerbranch.id).dependency_closure == ''
+    assert dep_names(layerbranch) == ['meta-networking', 'meta-oe', 'openembedded-core', 'meta-python']
+    dep.delete()
+    assert dep_names(layerbranch) == ['meta-networking', 'meta-oe', 'openembedded-core']
+
+    # As should adding a layer branch that satisfies a dependency
+    newlayerbranch = add_layer(layerbranch.branch, 'meta-new')
+    newlayerbranch.delete()
+    add_dep(layers['meta-oe'], newlayerbranch)
+    assert dep_names(layerbranch) == ['meta-networking', 'meta-oe', 'openembedded-core']
+    newlayerbranch.pk = None
+    newlayerbranch.save()
+    assert dep_names(layerbranch) == ['meta-networking', 'meta-oe', 'openembedded-core', 'meta-new']
+
+def test_dependency_cache_concurrent_change(layers, monkeypatch):
+    from layerindex.models import LayerBranch
+    layerbranch = LayerBranch.objects.get(id=layers['meta-app'].id)
+    get_dependency_closures = LayerBranch.get_dependency_closures
+    def get_dependency_closures_racing(branch_id):
+        # Simulate another process changing the dependencies after we've
+        # read them but before we've stored the result
+        closures = get_dependency_closures(branch_id)
+        add_dep(layers['meta-oe'], layers['meta-python'])
+        return closures
+    monkeypatch.setattr(LayerBranch, 'get_dependency_closures', staticmethod(get_dependency_closures_racing))
+    assert [lb.layer.name for lb in layerbranch.get_recursive_dependencies()] == ['meta-networking', 'meta-oe', 'openembedded-core']
+    monkeypatch.undo()
+    # The stale result should not have been cached
+    assert LayerBranch.objects.get(id=layerbranch.id).dependency_closure == ''
+    assert dep_names(layerbranch) == ['meta-networking', 'meta-oe', 'openembedded-core', 'meta-python']
+
+def test_dependencies_api(layers, client):
+    layerbranch = layers['meta-app']
+    response = client.get('/layerindex/api/layers/%d/dependencies/' % layerbranch.id)
+    assert response.status_code == 200
+    assert [lb['layer']['name'] for lb in response.json()] == ['meta-networking', 'meta-oe', 'openembedded-core']
+    response = client.get('/layerindex/api/layers/%d/dependencies/?recommends=1' % layerbranch.id)
+    assert [lb['layer']['name'] for lb in response.json()] == ['meta-networking', 'meta-oe', 'openembedded-core', 'meta-python']
@@ -0,0 +1,134 @@
+# layerindex-web - query plan checks for hot recipe lookups
+#
+# Copyright (C) 2018 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# NOTE: requires pytest-django. Run using "pytest" from the root
+# of the repository
+
+# These tests seed a moderately sized dataset and then check (via EXPLAIN)
+# that the lookups done by update_layer.py, the RRS scripts and the recipe
+# detail page are satisfied using an index rather than a full table scan.
+# SQLite, MySQL and PostgreSQL are supported.
+
+import pytest
+from django.db import connection
+
+
+NUM_LAYERS = 10
+NUM_RECIPES = 100
+
+@pytest.fixture
+def dataset(db):
+    from layerindex.models import Branch, LayerItem, LayerBranch, Recipe, BBAppend, RecipeFileDependency
+    branch = Branch.objects.create(name='master', bitbake_branch='master')
+    Branch.objects.create(name='otherbranch', bitbake_branch='master')
+    layerbranches = []
+    for i in range(NUM_LAYERS):
+        layer = LayerItem.objects.create(name='meta-layer%d' % i, status='P', layer_type='M', summary='Test', description='Test', vcs_url='git://example.com/meta-layer%d' % i)
+        layerbranch = LayerBranch.objects.create(layer=layer, branch=branch)
+        recipes = []
+        for j in range(NUM_RECIPES):
+            recipes.append(Recipe(layerbranch=layerbranch, pn='recipe%d' % j, pv='1.0', filename='recipe%d_1.0.bb' % j, filepath='recipes-test%d' % (j % 10)))
+        Recipe.objects.bulk_create(recipes)
+        BBAppend.objects.bulk_create([BBAppend(layerbranch=layerbranch, filename='recipe%d_%%.bbappend' % j, filepath='recipes-test') for j in range(0, NUM_RECIPES, 3)])
+        filedeps = []
+        for recipe in Recipe.objects.filter(layerbranch=layerbranch):
+            filedeps.append(RecipeFileDependency(recipe=recipe, layerbranch=layerbranch, path='%s/%s/%s.inc' % (layerbranch.layer.name, recipe.filepath, recipe.pn)))
+            filedeps.append(RecipeFileDependency(recipe=recipe, layerbranch=layerbranch, path='%s/conf/layer.conf' % layerbranch.layer.name))
+        RecipeFileDependency.objects.bulk_create(filedeps)
+        layerbranches.append(layerbranch)
+    # Make sure the planner has statistics to work with
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            for model in [Recipe, BBAppend, RecipeFileDependency]:
+                cursor.execute('ANALYZE TABLE %s' % model._meta.db_table)
+        else:
+            cursor.execute('ANALYZE')
+    return layerbranches
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+        elif connection.vendor == 'mysql':
+            cursor.execute('EXPLAIN ' + sql, params)
+            columns = [col[0] for col in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        elif connection.vendor == 'postgresql':
+            cursor.execute('EXPLAIN ' + sql, params)
+            return [row[0] for row in cursor.fetchall()]
+        else:
+            pytest.skip('EXPLAIN not supported for database backend %s' % connection.vendor)
+
+def index_columns(table):
+    with connection.cursor() as cursor:
+        cursor.execute('SHOW INDEX FROM %s' % table)
+        columns = [col[0] for col in cursor.description]
+        indexes = {}
+        for row in cursor.fetchall():
+            row = dict(zip(columns, row))
+            indexes.setdefault(row['Key_name'], []).append(row['Column_name'])
+    return indexes
+
+def uses_index(plan, table, columns):
+    """
+    Check that the plan looks up the specified table using an index
+    covering all of the specified columns
+    """
+    if connection.vendor == 'sqlite':
+        # e.g. "SEARCH TABLE layerindex_recipe USING INDEX ... (layerbranch_id=? AND pn=?)"
+        # (older versions of SQLite include "TABLE")
+        lines = [line for line in plan if table in line.split()]
+        return bool(lines) and all(line.startswith('SEARCH') and all(('%s=?' % col) in line for col in columns) for line in lines)
+    elif connection.vendor == 'mysql':
+        rows = [row for row in plan if row['table'] == table]
+        indexes = index_columns(table)
+        return bool(rows) and all(row['key'] and row['type'] != 'ALL' and set(columns).issubset(indexes.get(row['key'], [])) for row in rows)
+    else:
+        return not any(('Seq Scan on %s' % table) in line for line in plan)
+
+def hot_queries(layerbranches):
+    from layerindex.models import Recipe, BBAppend, RecipeFileDependency
+    layerbranch = layerbranches[NUM_LAYERS // 2]
+    return [
+        # update_layer.py: finding the existing recipe / append for a file
+        ('recipe by file', Recipe, ['layerbranch_id', 'filepath', 'filename'], Recipe.objects.filter(layerbranch=layerbranch).filter(filepath='recipes-test7').filter(filename='recipe57_1.0.bb')),
+        ('append by file', BBAppend, ['layerbranch_id', 'filename'], BBAppend.objects.filter(layerbranch=layerbranch).filter(filepath='recipes-test').filter(filename='recipe57_%.bbappend')),
+        # update_layer.py: recipes affected by a changed file
+        ('file dependency', RecipeFileDependency, ['layerbranch_id', 'path'], RecipeFileDependency.objects.filter(layerbranch=layerbranch).filter(path='%s/recipes-test7/recipe57.inc' % layerbranch.layer.name)),
+        # RRS scripts
+        ('recipe by name', Recipe, ['layerbranch_id', 'pn'], Recipe.objects.filter(layerbranch=layerbranch, pn='recipe57')),
+        ('recipe by branch name', Recipe, ['layerbranch_id', 'pn'], Recipe.objects.filter(layerbranch__branch__name='master', pn='recipe57')),
+        # RecipeDetailView
+        ('appends for recipe', BBAppend, ['layerbranch_id'], BBAppend.objects.filter(layerbranch__branch=layerbranch.branch).filter(filename__startswith='recipe57').filter(filename__regex=r'^recipe57(_[^_]*)?\.bbappend')),
+    ]
+
+@pytest.fixture
+def no_seqscan(db):
+    if connection.vendor == 'postgresql':
+        # With a dataset this small a sequential scan may well be cheaper,
+        # so just check that an index scan is possible. Reset the setting
+        # afterwards so that it doesn't affect later tests using the same
+        # connection.
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+        try:
+            yield
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('RESET enable_seqscan')
+    else:
+        yield
+
+def test_hot_queries_use_index(dataset, no_seqscan):
+    failed = []
+    for desc, model, columns, queryset in hot_queries(dataset):
+        plan = explain(queryset)
+        assert queryset.exists(), 'Query "%s" returned no results' % desc
+        if not uses_index(plan, model._meta.db_table, columns):
+            failed.append('%s:\n    %s' % (desc, '\n    '.join(str(line) for line in plan)))
+    assert not failed, 'Queries not using an index:\n%s' % '\n'.join(failed)
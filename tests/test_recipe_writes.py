@@ -0,0 +1,236 @@
+# layerindex-web - query count benchmark for writing recipe data
+#
+# Copyright (C) 2018 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# NOTE: requires pytest-django. Run using "pytest" from the root
+# of the repository (add -s to see the query counts)
+
+# These tests do not need bitbake - they feed update_recipe_file() with fake
+# parsed recipe data and count the queries used to write it to the database.
+
+import sys
+import os
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+basepath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(basepath, 'layerindex'))
+
+import update_layer
+
+
+class FakeData:
+    def __init__(self, values=None, packageconfig=None):
+        self.values = values or {}
+        self.packageconfig = packageconfig or {}
+
+    def getVar(self, name, expand=True):
+        return self.values.get(name, None)
+
+    def setVar(self, name, value):
+        self.values[name] = value
+
+    def getVarFlag(self, name, flag, expand=True):
+        return None
+
+    def getVarFlags(self, name):
+        return dict(self.packageconfig)
+
+
+class FakeTinfoil:
+    def __init__(self):
+        self.recipes = {}
+        self.parsed = []
+
+    def parse_recipe_file(self, fn, appends=True, config_data=None):
+        self.parsed.append(fn)
+        return self.recipes[fn]
+
+
+layerdir = '/fake/meta-test'
+layerdir_start = layerdir + os.sep
+
+def make_recipe_data(pn, ndeps, ver=1):
+    values = {
+        'PN': pn,
+        'PV': '1.0',
+        'SUMMARY': 'Test recipe %s' % pn,
+        'DESCRIPTION': '',
+        'SECTION': '',
+        'LICENSE': 'MIT',
+        'HOMEPAGE': '',
+        'DEPENDS': ' '.join(['dep-%d-%d' % (i, ver) for i in range(ndeps)]),
+        'SRC_URI': ' '.join(['http://example.com/%s/%d-%d.tar.gz' % (pn, i, ver) for i in range(ndeps)] + ['file://local.patch']),
+        '__inherit_cache': ['/fake/meta/classes/autotools.bbclass', '/fake/meta-test/classes/test-%d.bbclass' % ver],
+        '__depends': [(os.path.join(layerdir, 'recipes-test', '%s-%d-%d.inc' % (pn, i, ver)), 0) for i in range(ndeps)] + [('/fake/meta-other/classes/other-%d.bbclass' % ver, 0)],
+    }
+    packageconfig = {}
+    for i in range(ndeps):
+        packageconfig['feature%d' % i] = '--enable-%d,--disable-%d,pcdep-%d-%d' % (i, i, i, ver)
+    return FakeData(values, packageconfig)
+
+@pytest.fixture
+def layerbranch(db):
+    from layerindex.models import Branch, LayerItem, LayerBranch
+    branch = Branch.objects.create(name='testbranch', bitbake_branch='master')
+    layer = LayerItem.objects.create(name='meta-test', status='P', layer_type='M', summary='Test', description='Test', vcs_url='git://example.com/meta-test')
+    return LayerBranch.objects.create(layer=layer, branch=branch)
+
+def write_recipes(layerbranch, nrecipes, ndeps, ver=1, profile=False):
+    from layerindex.models import Recipe
+    tinfoil = FakeTinfoil()
+    recipes = []
+    for i in range(nrecipes):
+        pn = 'recipe%d' % i
+        recipe = Recipe.objects.filter(layerbranch=layerbranch, pn=pn).first()
+        if not recipe:
+            recipe = Recipe(layerbranch=layerbranch, filename='%s_1.0.bb' % pn, filepath='recipes-test')
+        tinfoil.recipes[os.path.join(layerdir, 'recipes-test', recipe.filename)] = make_recipe_data(pn, ndeps, ver)
+        recipes.append(recipe)
+    with CaptureQueriesContext(connection) as ctx:
+        batch = update_layer.RecipeDataBatch(profile=profile)
+        for recipe in recipes:
+            update_layer.update_recipe_file(tinfoil, FakeData(), os.path.join(layerdir, 'recipes-test'), recipe, layerdir_start, '/fake', True, skip_patches=True, batch=batch)
+        batch.flush()
+    return recipes, len(ctx.captured_queries)
+
+def test_recipe_data(layerbranch):
+    from layerindex.models import RecipeFileDependency, RecipeExternalFileDependency
+    recipes, _ = write_recipes(layerbranch, 3, 5)
+    recipes, _ = write_recipes(layerbranch, 3, 5, ver=2)
+    for recipe in recipes:
+        assert sorted(recipe.staticbuilddep_set.values_list('name', flat=True)) == sorted(['dep-%d-2' % i for i in range(5)])
+        assert sorted(recipe.dynamicbuilddep_set.values_list('name', flat=True)) == sorted(['pcdep-%d-2' % i for i in range(5)])
+        assert recipe.inherits == 'autotools test-2'
+        assert sorted(recipe.inheritedclass_set.values_list('name', flat=True)) == ['autotools', 'test-2']
+        assert recipe.source_set.count() == 5
+        assert all(url.endswith('-2.tar.gz') for url in recipe.source_set.values_list('url', flat=True))
+        assert recipe.packageconfig_set.count() == 5
+        for package_config in recipe.packageconfig_set.all():
+            assert list(package_config.dynamicbuilddep_set.values_list('name', flat=True)) == [package_config.build_deps]
+        filedeps = RecipeFileDependency.objects.filter(recipe=recipe).values_list('path', flat=True)
+        assert sorted(filedeps) == sorted(['meta-test/recipes-test/%s-%d-2.inc' % (recipe.pn, i) for i in range(5)])
+        externaldeps = RecipeExternalFileDependency.objects.filter(recipe=recipe).values_list('path', flat=True)
+        assert list(externaldeps) == ['fake/meta-other/classes/other-2.bbclass']
+
+def test_query_count(layerbranch):
+    # The number of queries should depend on the number of recipes, but not
+    # on the number of dependencies, sources etc. each of them has
+    _, small = write_recipes(layerbranch, 10, 5)
+    _, small_update = write_recipes(layerbranch, 10, 5, ver=2)
+    _, small_noop = write_recipes(layerbranch, 10, 5, ver=2)
+    from layerindex.models import Recipe
+    Recipe.objects.all().delete()
+    _, large = write_recipes(layerbranch, 10, 50)
+    _, large_update = write_recipes(layerbranch, 10, 50, ver=2)
+    _, large_noop = write_recipes(layerbranch, 10, 50, ver=2)
+    # Allow for the database backend splitting up large bulk inserts
+    assert large - small < 10, 'initial write of 10 recipes took %d queries with 5 dependencies each, %d with 50' % (small, large)
+    assert large_update - small_update < 10, 'update of 10 recipes took %d queries with 5 dependencies each, %d with 50' % (small_update, large_update)
+    assert small_noop == large_noop, 'unchanged write of 10 recipes took %d queries with 5 dependencies each, %d with 50' % (small_noop, large_noop)
+    assert large_update < 10 * 20, 'update of 10 recipes with 50 dependencies each took %d queries' % large_update
+
+def test_filedep_index(layerbranch):
+    recipes, _ = write_recipes(layerbranch, 3, 2)
+    with CaptureQueriesContext(connection) as ctx:
+        depindex = update_layer.RecipeFileDependencyIndex(layerbranch)
+        recipe_ids = depindex.get_recipe_ids(['meta-test/recipes-test/recipe0-0-1.inc', 'meta-test/recipes-test/recipe0-1-1.inc', 'meta-test/recipes-test/recipe2-1-1.inc', 'meta-test/recipes-test/other.inc'])
+    assert len(ctx.captured_queries) == 1
+    assert recipe_ids == {recipes[0].id, recipes[2].id}
+
+def test_profile(layerbranch):
+    from layerindex.models import RecipeParseProfile
+    write_recipes(layerbranch, 3, 2)
+    assert not RecipeParseProfile.objects.exists()
+    # Includes a recipe that is new (i.e. not saved before it is parsed)
+    recipes, _ = write_recipes(layerbranch, 4, 2, ver=2, profile=True)
+    profiles = RecipeParseProfile.objects.all()
+    assert sorted(profiles.values_list('recipe_id', flat=True)) == sorted([recipe.id for recipe in recipes])
+    for profile in profiles:
+        assert profile.parse_time >= 0
+        assert profile.write_time > 0
+        assert profile.peak_memory >= 0
+
+def test_parse_cache(layerbranch, tmpdir):
+    from layerindex.models import Recipe
+    # The cache needs real files to hash
+    recipedir = tmpdir.mkdir('meta-test').mkdir('recipes-test')
+    incfile = tmpdir.join('meta-other', 'common.inc')
+    incfile.write('A = "1"', ensure=True)
+    tinfoil = FakeTinfoil()
+    recipes = []
+    for i in range(3):
+        recipe = Recipe(layerbranch=layerbranch, filename='recipe%d_1.0.bb' % i, filepath='recipes-test')
+        recipedir.join(recipe.filename).write('require common.inc')
+        recipedata = make_recipe_data('recipe%d' % i, 2)
+        if i == 0:
+            recipedata.values['__depends'].append((str(incfile), 0))
+        tinfoil.recipes[str(recipedir.join(recipe.filename))] = recipedata
+        recipes.append(recipe)
+
+    def update(revisions=['bitbake', 'core']):
+        parsecache = update_layer.RecipeParseCache(str(tmpdir.join('cache')), layerbranch, FakeData(), revisions)
+        tinfoil.parsed = []
+        batch = update_layer.RecipeDataBatch()
+        for recipe in recipes:
+            update_layer.update_recipe_file(tinfoil, FakeData(), str(recipedir), recipe, str(tmpdir.join('meta-test')) + os.sep, str(tmpdir), True, skip_patches=True, batch=batch, parsecache=parsecache)
+        batch.flush()
+        parsecache.save()
+        return [os.path.basename(fn) for fn in tinfoil.parsed]
+
+    assert update() == ['recipe0_1.0.bb', 'recipe1_1.0.bb', 'recipe2_1.0.bb']
+    assert update() == []
+    for recipe in recipes:
+        recipe = Recipe.objects.get(id=recipe.id)
+        assert recipe.summary == 'Test recipe %s' % recipe.pn
+        assert recipe.inherits == 'autotools test-1'
+        assert sorted(recipe.staticbuilddep_set.values_list('name', flat=True)) == ['dep-0-1', 'dep-1-1']
+    # Only recipes whose files have changed should be parsed again
+    incfile.write('A = "2"')
+    recipedir.join('recipe2_1.0.bb').write('require common.inc\nB = "1"')
+    assert update() == ['recipe0_1.0.bb', 'recipe2_1.0.bb']
+    # As should all of them if the revision of BitBake changes
+    assert update(['bitbake2', 'core']) == ['recipe0_1.0.bb', 'recipe1_1.0.bb', 'recipe2_1.0.bb']
+
+def test_reconcile_layer_items(layerbranch):
+    from layerindex.models import Machine, BBAppend
+    machines = {('machine%d' % i,): {'description': 'Machine %d' % i} for i in range(20)}
+    assert update_layer.reconcile_layer_items(Machine, layerbranch, ('name',), machines) == (20, 0, 0)
+    ids = dict(Machine.objects.filter(layerbranch=layerbranch).values_list('name', 'id'))
+
+    # Unchanged records should keep their ids, and nothing needs writing
+    # for them
+    del machines[('machine0',)]
+    machines[('machine1',)]['description'] = 'Changed'
+    machines[('newmachine',)] = {'description': 'New'}
+    with CaptureQueriesContext(connection) as ctx:
+        assert update_layer.reconcile_layer_items(Machine, layerbranch, ('name',), machines) == (1, 1, 1)
+    assert len(ctx.captured_queries) < 10
+    newids = dict(Machine.objects.filter(layerbranch=layerbranch).values_list('name', 'id'))
+    assert sorted(newids.keys()) == sorted([key[0] for key in machines])
+    for name, machineid in newids.items():
+        if name != 'newmachine':
+            assert ids[name] == machineid
+    assert Machine.objects.get(layerbranch=layerbranch, name='machine1').description == 'Changed'
+
+    appends = {('recipes-test', 'test_%.bbappend'): {}, ('recipes-other', 'test_%.bbappend'): {}}
+    assert update_layer.reconcile_layer_items(BBAppend, layerbranch, ('filepath', 'filename'), appends) == (2, 0, 0)
+    del appends[('recipes-other', 'test_%.bbappend')]
+    assert update_layer.reconcile_layer_items(BBAppend, layerbranch, ('filepath', 'filename'), appends) == (0, 0, 1)
+    assert list(BBAppend.objects.filter(layerbranch=layerbranch).values_list('filepath', flat=True)) == ['recipes-test']
+
+def test_preferred_count_layer_delete(layerbranch):
+    from layerindex.models import LayerItem, LayerBranch, Recipe
+    from layerindex import utils
+    layer = LayerItem.objects.create(name='meta-other', status='P', layer_type='S', summary='Other', description='Other', vcs_url='git://example.com/meta-other', index_preference=10)
+    otherlayerbranch = LayerBranch.objects.create(layer=layer, branch=layerbranch.branch)
+    recipe = Recipe.objects.create(layerbranch=layerbranch, pn='shadowed', filename='shadowed_1.0.bb', filepath='recipes-test')
+    Recipe.objects.create(layerbranch=otherlayerbranch, pn='shadowed', filename='shadowed_1.0.bb', filepath='recipes-test')
+    utils.update_recipe_preferred_counts(layerbranch.branch)
+    assert Recipe.objects.get(id=recipe.id).preferred_count == 1
+    # Deleting the layer should un-shadow the recipe
+    layer.delete()
+    assert Recipe.objects.get(id=recipe.id).preferred_count == 0
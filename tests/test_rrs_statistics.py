@@ -0,0 +1,269 @@
+# layerindex-web - tests for the precalculated RRS milestone statistics
+#
+# Copyright (C) 2018 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# NOTE: requires pytest-django, and rrs to be in INSTALLED_APPS. Run
+# using "pytest" from the root of the repository
+
+import pytest
+from datetime import date, datetime
+from django.conf import settings
+
+if 'rrs' not in settings.INSTALLED_APPS:
+    pytest.skip('rrs application not enabled', allow_module_level=True)
+
+
+@pytest.fixture
+def maintplan(db):
+    from layerindex.models import Branch, LayerItem, LayerBranch, Recipe
+    from rrs.models import MaintenancePlan, MaintenancePlanLayerBranch, Release, Milestone, \
+            Maintainer, RecipeMaintainerHistory, RecipeMaintainer, RecipeUpstreamHistory, \
+            RecipeUpstream, RecipeUpgrade
+    branch = Branch.objects.create(name='master', bitbake_branch='master')
+    maintplan = MaintenancePlan.objects.create(name='Test', maintainer_style='I')
+    release = Release.objects.create(plan=maintplan, name='2.6', start_date=date(2018, 5, 1), end_date=date(2018, 10, 31))
+    Milestone.objects.create(release=release, name='M1', start_date=date(2018, 5, 1), end_date=date(2018, 7, 31))
+    Milestone.objects.create(release=release, name='M2', start_date=date(2018, 8, 1), end_date=date(2018, 10, 31))
+    alice = Maintainer.objects.create(name='Alice')
+    bob = Maintainer.objects.create(name='Bob')
+    statuses = [('Y', ''), ('N', ''), ('N', 'Needs newer libc'), ('D', '')]
+    for layername in ['openembedded-core', 'meta-oe']:
+        layer = LayerItem.objects.create(name=layername, status='P', layer_type='M', summary=layername, description=layername, vcs_url='git://example.com/%s' % layername)
+        layerbranch = LayerBranch.objects.create(layer=layer, branch=branch)
+        MaintenancePlanLayerBranch.objects.create(plan=maintplan, layerbranch=layerbranch)
+        rmh = RecipeMaintainerHistory.objects.create(layerbranch=layerbranch, date=datetime(2018, 5, 1), author=alice, sha1='%s-1' % layername)
+        first = RecipeUpstreamHistory.objects.create(layerbranch=layerbranch, start_date=datetime(2018, 8, 2), end_date=datetime(2018, 8, 2))
+        last = RecipeUpstreamHistory.objects.create(layerbranch=layerbranch, start_date=datetime(2018, 9, 2), end_date=datetime(2018, 9, 2))
+        for i, (status, reason) in enumerate(statuses):
+            recipe = Recipe.objects.create(layerbranch=layerbranch, pn='recipe%d' % i, pv='1.0', filename='recipe%d_1.0.bb' % i, filepath='recipes-test')
+            maintainer = alice if i < 3 else bob
+            RecipeMaintainer.objects.create(recipe=recipe, maintainer=maintainer, history=rmh)
+            RecipeUpgrade.objects.create(recipe=recipe, maintainer=maintainer, version='1.0', author_date=datetime(2018, 5, 2), commit_date=datetime(2018, 5, 2))
+            RecipeUpstream.objects.create(recipe=recipe, history=first, version='1.1', type='A', status='N', date=datetime(2018, 8, 2))
+            RecipeUpstream.objects.create(recipe=recipe, history=last, version='1.1', type='A', status=status, no_update_reason=reason, date=datetime(2018, 9, 2))
+        # One of the recipes has since been upgraded
+        RecipeUpgrade.objects.create(recipe=recipe, maintainer=bob, version='1.1', author_date=datetime(2018, 8, 20), commit_date=datetime(2018, 8, 20))
+    return maintplan
+
+def test_calculate(maintplan):
+    from rrs.models import MilestoneStatistics, Milestone
+    milestone = Milestone.objects.get(name='M2')
+    layerbranch = maintplan.maintenanceplanlayerbranch_set.first().layerbranch
+    stats = MilestoneStatistics.calculate(milestone, layerbranch)
+    values = [(ms.maintainer.name if ms.maintainer else None, ms.recipes, ms.up_to_date, ms.not_updated, ms.cant_be_updated, ms.unknown, ms.upgraded, ms.not_upgraded) for ms in stats]
+    assert values == [
+        (None, 4, 1, 1, 1, 1, 1, 4),
+        ('Alice', 3, 1, 1, 1, 0, 0, 0),
+        ('Bob', 1, 0, 0, 0, 1, 0, 0),
+    ]
+
+def test_refresh(maintplan):
+    from rrs.models import MilestoneStatistics, Milestone
+    from rrs.views import _get_milestone_statistics, MaintainerListView
+    milestone = Milestone.objects.get(name='M2')
+    # Calculated on the fly until the update scripts have stored them
+    expected = _get_milestone_statistics(milestone)
+    for maintplanlayer in maintplan.maintenanceplanlayerbranch_set.all():
+        MilestoneStatistics.refresh(maintplan, maintplanlayer.layerbranch)
+    assert MilestoneStatistics.objects.filter(milestone=milestone).count() == 6
+    assert _get_milestone_statistics(milestone) == expected
+    assert expected['all'] == 8
+    assert expected['up_to_date'] == 2
+    assert expected['percentage'] == '25'
+    assert _get_milestone_statistics(milestone, 'Alice')['all'] == 6
+
+    # Layer branches dropped from the plan should go away on the next refresh
+    maintplanlayer.delete()
+    MilestoneStatistics.refresh(maintplan, maintplanlayer.layerbranch, since=date(2018, 10, 1))
+    assert MilestoneStatistics.objects.filter(milestone=milestone).count() == 3
+
+    view = MaintainerListView(kwargs={'maintplan_name': 'Test', 'release_name': '2.6', 'milestone_name': 'M2'})
+    maintainer_list = view.get_queryset()
+    assert [(ml.name, ml.recipes_all, ml.percentage_done) for ml in maintainer_list] == [('Alice', 3, '33%'), ('Bob', 1, '0%')]
+    assert view.maintainer_count == 2
+
+def test_statistics_invalidation(maintplan):
+    from rrs.models import MilestoneStatistics, Milestone, MaintenancePlanLayerBranch
+    from rrs.views import _get_milestone_statistics
+    milestone = Milestone.objects.get(name='M2')
+    maintplanlayers = list(maintplan.maintenanceplanlayerbranch_set.all())
+    # Only store statistics for one of the layer branches, the other
+    # should still be calculated on the fly
+    MilestoneStatistics.refresh(maintplan, maintplanlayers[0].layerbranch)
+    assert len(MilestoneStatistics.get_by_milestone(milestone)) == 6
+    assert _get_milestone_statistics(milestone)['all'] == 8
+
+    # Changing a past milestone's dates should update what's stored
+    MilestoneStatistics.refresh(maintplan, maintplanlayers[1].layerbranch)
+    milestone.end_date = date(2018, 8, 10)
+    milestone.save()
+    assert _get_milestone_statistics(milestone)['up_to_date'] == 0
+    assert MilestoneStatistics.objects.filter(milestone=milestone, maintainer__isnull=True, up_to_date=0).count() == 2
+
+    # As should removing a layer branch from the plan or switching it
+    # to a different one
+    maintplanlayers[0].delete()
+    assert MilestoneStatistics.objects.filter(layerbranch=maintplanlayers[0].layerbranch).count() == 0
+    maintplanlayer = maintplanlayers[1]
+    maintplanlayer.layerbranch = maintplanlayers[0].layerbranch
+    maintplanlayer.save()
+    assert MilestoneStatistics.objects.count() == 0
+    assert [ms.layerbranch for ms in MilestoneStatistics.get_by_milestone(milestone) if not ms.maintainer] == [maintplanlayers[0].layerbranch]
+
+def refresh_statistics(maintplan):
+    from rrs.models import MilestoneStatistics
+    for maintplanlayer in maintplan.maintenanceplanlayerbranch_set.all():
+        MilestoneStatistics.refresh(maintplan, maintplanlayer.layerbranch)
+
+def add_maintainers(maintplan, count):
+    from rrs.models import Maintainer, RecipeMaintainer, RecipeMaintainerHistory, RecipeUpgrade
+    layerbranch = maintplan.maintenanceplanlayerbranch_set.first().layerbranch
+    rmh = RecipeMaintainerHistory.objects.get(layerbranch=layerbranch)
+    recipe = layerbranch.recipe_set.first()
+    start = Maintainer.objects.count()
+    for i in range(start, start + count):
+        maintainer = Maintainer.objects.create(name='Maintainer %d' % i)
+        RecipeMaintainer.objects.create(recipe=recipe, maintainer=maintainer, history=rmh)
+        for day in range(1 + i % 5, 29, 4):
+            commit_date = datetime(2018, 8, day, 12)
+            RecipeUpgrade.objects.create(recipe=recipe, maintainer=maintainer, version='1.%d' % day, author_date=commit_date, commit_date=commit_date)
+    refresh_statistics(maintplan)
+
+def test_maintainer_list_queries(maintplan):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from rrs.models import Milestone, RecipeUpgrade
+    from rrs.views import MaintainerListView
+
+    def get_maintainer_list(milestone_name):
+        view = MaintainerListView(kwargs={'maintplan_name': 'Test', 'release_name': '2.6', 'milestone_name': milestone_name})
+        with CaptureQueriesContext(connection) as ctx:
+            maintainer_list = view.get_queryset()
+        return maintainer_list, len(ctx.captured_queries)
+
+    add_maintainers(maintplan, 5)
+    maintainer_list, queries = get_maintainer_list('M2')
+    assert len(maintainer_list) == 7
+
+    # The counts should match those from counting each interval separately
+    intervals = Milestone.objects.get(name='M2').get_week_intervals()
+    for ml in maintainer_list:
+        expected = []
+        for i in sorted(intervals.keys()):
+            number = RecipeUpgrade.objects.filter(maintainer__name=ml.name,
+                    commit_date__gte=intervals[i]['start_date'],
+                    commit_date__lte=intervals[i]['end_date']).count()
+            expected.append('' if number == 0 else number)
+        assert ml.interval_statistics == expected
+    assert maintainer_list[-1].interval_statistics[:4] == [2, 2, 1, 2]
+
+    # Adding more maintainers shouldn't mean more queries
+    add_maintainers(maintplan, 20)
+    maintainer_list, more_queries = get_maintainer_list('M2')
+    assert len(maintainer_list) == 27
+    assert more_queries == queries
+
+def test_recipe_upgrade_timeline(maintplan):
+    from rrs.models import RecipeUpgrade, Maintainer
+    from rrs.views import Raw
+    layerbranch = maintplan.maintenanceplanlayerbranch_set.first().layerbranch
+    recipe = layerbranch.recipe_set.get(pn='recipe1')
+    maintainer = Maintainer.objects.get(name='Alice')
+
+    def add_upgrade(version, commit_date):
+        return RecipeUpgrade.objects.create(recipe=recipe, maintainer=maintainer, version=version, author_date=commit_date, commit_date=commit_date)
+
+    def versions(end_date):
+        return dict([(re['pn'], re['version']) for re in Raw.get_reupg_by_date(layerbranch.id, end_date)])
+
+    # Upgrades don't necessarily get added in order
+    add_upgrade('1.3', datetime(2018, 9, 1))
+    middle = add_upgrade('1.2', datetime(2018, 7, 1))
+    assert versions(date(2018, 4, 1)) == {}
+    assert versions(date(2018, 6, 1)) == {'recipe0': '1.0', 'recipe1': '1.0', 'recipe2': '1.0', 'recipe3': '1.0'}
+    assert versions(date(2018, 8, 1))['recipe1'] == '1.2'
+    assert versions(date(2018, 10, 1)) == {'recipe0': '1.0', 'recipe1': '1.3', 'recipe2': '1.0', 'recipe3': '1.1'}
+
+    # Only one of two upgrades on the same date should be picked
+    add_upgrade('1.2.1', datetime(2018, 7, 1))
+    assert versions(date(2018, 8, 1))['recipe1'] == '1.2.1'
+
+    middle.delete()
+    RecipeUpgrade.objects.filter(recipe=recipe, version='1.3').delete()
+    assert versions(date(2018, 10, 1))['recipe1'] == '1.2.1'
+    assert list(RecipeUpgrade.objects.filter(recipe=recipe).order_by('commit_date').values_list('version', 'valid_until')) == [('1.0', datetime(2018, 7, 1)), ('1.2.1', None)]
+
+    # Moving an upgrade should update the timeline as well
+    upgrade = RecipeUpgrade.objects.get(recipe=recipe, version='1.0')
+    upgrade.commit_date = datetime(2018, 8, 1)
+    upgrade.save()
+    assert list(RecipeUpgrade.objects.filter(recipe=recipe).order_by('commit_date').values_list('version', 'valid_until')) == [('1.2.1', datetime(2018, 8, 1)), ('1.0', None)]
+
+    # Adding an upgrade should only need to touch its neighbours, however
+    # many other upgrades the recipe has
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    for day in range(1, 29):
+        add_upgrade('2.%d' % day, datetime(2018, 10, day))
+    with CaptureQueriesContext(connection) as ctx:
+        add_upgrade('2.0', datetime(2018, 9, 30))
+    assert len(ctx.captured_queries) <= 5, 'Adding an upgrade took %d queries' % len(ctx.captured_queries)
+    expected = list(RecipeUpgrade.objects.filter(recipe=recipe).order_by('id').values_list('id', 'valid_until'))
+    RecipeUpgrade.update_timeline(recipe.id)
+    assert list(RecipeUpgrade.objects.filter(recipe=recipe).order_by('id').values_list('id', 'valid_until')) == expected
+
+    # Deleting a recipe takes its whole timeline with it, so its upgrades
+    # should be deleted in bulk without being loaded first
+    with CaptureQueriesContext(connection) as ctx:
+        recipe.delete()
+    upgrade_queries = [query['sql'] for query in ctx.captured_queries if 'rrs_recipeupgrade' in query['sql']]
+    assert len(upgrade_queries) == 1 and upgrade_queries[0].startswith('DELETE'), 'Unexpected queries: %s' % upgrade_queries
+
+def test_recipe_list_queries(maintplan):
+    from django.db import connection
+    from layerindex.models import Patch
+    from rrs.models import Milestone, RecipeUpstreamHistory, RecipeMaintainerHistory
+    from rrs.views import Raw, _get_recipe_list
+
+    def dictfetchall(qry):
+        cur = connection.cursor()
+        cur.execute(qry)
+        return Raw.dictfetchall(cur)
+
+    milestone = Milestone.objects.get(name='M2')
+    for maintplanlayer in maintplan.maintenanceplanlayerbranch_set.all():
+        layerbranch = maintplanlayer.layerbranch
+        recipe_ids = [re['id'] for re in Raw.get_reupg_by_date(layerbranch.id, milestone.end_date)]
+        # Leave one recipe out, the results should be limited to the milestone's recipes
+        layerbranch.recipe_set.get(pn='recipe0').recipeupgrade_set.all().delete()
+        recipe_ids = recipe_ids[1:]
+        history = RecipeUpstreamHistory.get_last_by_date_range(layerbranch, milestone.start_date, milestone.end_date)
+        rmh = RecipeMaintainerHistory.get_by_end_date(layerbranch, milestone.end_date)
+
+        # Compare against the IN-list queries these replaced
+        expected = dictfetchall("""SELECT recipe_id, status, no_update_reason, version
+                FROM rrs_recipeupstream WHERE history_id = '%s' AND recipe_id IN (%s);""" % (history.id, str(recipe_ids).strip('[]')))
+        actual = Raw.get_reup_by_layerbranch_and_date(layerbranch.id, milestone.end_date, history.id)
+        assert len(actual) == 3
+        assert sorted(actual, key=lambda x: x['recipe_id']) == sorted(expected, key=lambda x: x['recipe_id'])
+
+        expected = dictfetchall("""SELECT rema.recipe_id, ma.name
+                FROM rrs_recipemaintainer AS rema INNER JOIN rrs_maintainer AS ma ON rema.maintainer_id = ma.id
+                WHERE rema.history_id = '%s' AND rema.recipe_id IN (%s);""" % (rmh.id, str(recipe_ids).strip('[]')))
+        actual = Raw.get_ma_by_layerbranch_and_date(layerbranch.id, milestone.end_date, rmh.id)
+        assert len(actual) == 3
+        assert sorted(actual, key=lambda x: x['recipe_id']) == sorted(expected, key=lambda x: x['recipe_id'])
+
+        recipe = layerbranch.recipe_set.get(pn='recipe2')
+        Patch.objects.create(recipe=recipe, path='a.patch', src_path='a.patch', status='P')
+        Patch.objects.create(recipe=recipe, path='b.patch', src_path='b.patch', status='A')
+
+    # Recipes from all of the layers in the plan should be listed
+    recipe_list = _get_recipe_list(milestone)
+    assert [(rl.name, rl.version, rl.upstream_status, rl.maintainer_name, rl.patches_total, rl.patches_pending) for rl in recipe_list] == [
+        ('recipe1', '1.0', 'Not updated', 'Alice', 0, 0),
+        ('recipe2', '1.0', "Can't be updated", 'Alice', 2, 1),
+        ('recipe3', '1.1', 'Unknown', 'Bob', 0, 0),
+    ] * 2
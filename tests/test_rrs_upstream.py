@@ -0,0 +1,94 @@
+# layerindex-web - tests for running RRS upstream checks in parallel
+#
+# Copyright (C) 2018 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# NOTE: requires pytest-django. Run using "pytest" from the root
+# of the repository
+
+import logging
+import os
+import time
+
+from rrs.tools.common import check_upstream_versions
+
+logger = logging.getLogger('test_rrs_upstream')
+
+
+class StubUpstream():
+    """
+    Stand-in for upstream servers that records how busy each one gets.
+    The checks run in separate processes, so each records its PID in a
+    directory and counts those that are still running (i.e. haven't been
+    reaped yet) for the same host.
+    """
+    def __init__(self, tmpdir):
+        self.dir = str(tmpdir)
+
+    def running(self, host=None):
+        count = 0
+        for fn in os.listdir(self.dir):
+            if not fn.startswith('running@'):
+                continue
+            _, checkhost, pid = fn.split('@')
+            if host and checkhost != host:
+                continue
+            try:
+                os.kill(int(pid), 0)
+                count += 1
+            except ProcessLookupError:
+                pass
+        return count
+
+    def record(self, name, value):
+        with open(os.path.join(self.dir, '%s.%d' % (name, os.getpid())), 'w') as f:
+            f.write(str(value))
+
+    def max_recorded(self, name):
+        values = [0]
+        for fn in os.listdir(self.dir):
+            if fn.startswith(name + '.'):
+                with open(os.path.join(self.dir, fn)) as f:
+                    values.append(int(f.read()))
+        return max(values)
+
+    def check(self, arg):
+        host, version, delay = arg
+        open(os.path.join(self.dir, 'running@%s@%d' % (host, os.getpid())), 'w').close()
+        self.record('max_total', self.running())
+        self.record('max_active_%s' % host, self.running(host))
+        time.sleep(delay)
+        open(os.path.join(self.dir, 'done@%s' % version), 'w').close()
+        if version is None:
+            raise Exception('Unable to reach %s' % host)
+        return version
+
+def test_check_upstream_versions(tmpdir):
+    upstream = StubUpstream(tmpdir.mkdir('running'))
+    checks = []
+    for i in range(24):
+        host = 'host%d.example.com' % (i % 3)
+        checks.append(('recipe%d' % i, host, (host, '1.%d' % i, 0.2)))
+    results = check_upstream_versions(checks, upstream.check, 4, 2, 30, logger)
+    assert results == ['1.%d' % i for i in range(24)]
+    # The checks should have run in parallel, but within the limits
+    assert 1 < upstream.max_recorded('max_total') <= 4
+    assert max([upstream.max_recorded('max_active_host%d.example.com' % i) for i in range(3)]) <= 2
+
+def test_check_upstream_versions_failures(tmpdir):
+    upstream = StubUpstream(tmpdir.mkdir('running'))
+    checks = [
+        ('good', 'a.example.com', ('a.example.com', '2.0', 0)),
+        ('broken', 'b.example.com', ('b.example.com', None, 0)),
+        ('hung', 'c.example.com', ('c.example.com', '3.0', 10)),
+        ('good2', 'c.example.com', ('c.example.com', '4.0', 0)),
+    ]
+    results = check_upstream_versions(checks, upstream.check, 2, 1, 1, logger)
+    assert results == ['2.0', None, None, '4.0']
+    # The hung check should have been killed rather than waited for
+    assert not os.path.exists(os.path.join(upstream.dir, 'done@3.0'))
+    # The hung check must have been killed before the next one for the
+    # same host was started
+    assert upstream.max_recorded('max_active_c.example.com') == 1
+    assert upstream.running() == 0
@@ -0,0 +1,284 @@
+# layerindex-web - performance regression benchmarks for the update scripts
+#
+# Copyright (C) 2018 Intel Corporation
+#
+# Licensed under the MIT license, see COPYING.MIT for details
+
+# NOTE: requires pytest-django. Run using "pytest tests/test_update_benchmark.py"
+# from the root of the repository. As with test_update.py these need network
+# access (to fetch BitBake and OE-Core) and a test database that the update
+# scripts can connect to (i.e. not an in-memory SQLite database).
+
+# These tests generate a synthetic layer (recipes sharing include files,
+# bbappends and machines) in a local git repository, import it and then
+# measure the number of database queries, wall time and peak RSS of the
+# update scripts in each of the following modes:
+#
+#   initial:     update.py importing the layer for the first time
+#   reload:      update_layer.py --reload (the slow path - everything parsed)
+#   incremental: update_layer.py after a commit touching a few files (the
+#                fast path - only what's affected by the changes is parsed)
+#   noop:        update.py with nothing changed
+#
+# (query counts are only available for update_layer.py, since that is run
+# in a process forked from this one.)
+#
+# The results are compared against the baseline file specified by
+# LAYERINDEX_BENCHMARK_BASELINE and the tests fail if any of them has
+# regressed by more than the tolerances below. Since the results depend on
+# the machine, no baseline is shipped with the repository - to create one
+# (e.g. before making a change, or after an intentional one) set
+# LAYERINDEX_BENCHMARK_OUTPUT to the path of a file outside the repository
+# to write the results to. If neither is set (or the baseline file doesn't
+# exist) the tests are skipped. The size of the generated layer can be
+# changed with LAYERINDEX_BENCHMARK_RECIPES etc. (see below) but the
+# baseline must then be recreated as well.
+
+import sys
+import os
+import json
+import time
+import shutil
+import resource
+import subprocess
+import multiprocessing
+import pytest
+
+basepath = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(basepath, 'layerindex'))
+
+BASELINE_FILE = os.environ.get('LAYERINDEX_BENCHMARK_BASELINE', '')
+OUTPUT_FILE = os.environ.get('LAYERINDEX_BENCHMARK_OUTPUT', '')
+
+pytestmark = pytest.mark.skipif(not (os.path.exists(BASELINE_FILE) or OUTPUT_FILE),
+                                reason='LAYERINDEX_BENCHMARK_BASELINE does not point to an existing baseline file and LAYERINDEX_BENCHMARK_OUTPUT is not set')
+# Allowed increase over the baseline before a result counts as a regression
+TOLERANCES = {
+    'queries': 0.1,
+    'time': 0.25,
+    'maxrss': 0.25,
+}
+
+NUM_RECIPES = int(os.environ.get('LAYERINDEX_BENCHMARK_RECIPES', '200'))
+NUM_INCLUDES = int(os.environ.get('LAYERINDEX_BENCHMARK_INCLUDES', '10'))
+NUM_APPENDS = int(os.environ.get('LAYERINDEX_BENCHMARK_APPENDS', '20'))
+NUM_MACHINES = int(os.environ.get('LAYERINDEX_BENCHMARK_MACHINES', '10'))
+
+LAYER_NAME = 'meta-layerindex-benchmark'
+
+results = {}
+
+
+def run_cmd(cmd, cwd=None):
+    if not cwd:
+        cwd = basepath
+    subprocess.check_call(cmd, stderr=subprocess.STDOUT, shell=True, cwd=cwd)
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+def recipe_path(repodir, i, version='1.0'):
+    return os.path.join(repodir, 'recipes-bench', 'bench%d' % i, 'bench%d_%s.bb' % (i, version))
+
+def write_recipe(repodir, i, version='1.0'):
+    lines = ['SUMMARY = "Benchmark recipe %d"' % i,
+             'LICENSE = "MIT"',
+             'require recipes-bench/include/common%d.inc' % (i % NUM_INCLUDES)]
+    if i:
+        lines.append('DEPENDS = "bench%d"' % (i - 1))
+    write_file(recipe_path(repodir, i, version), '\n'.join(lines) + '\n')
+
+def write_include(repodir, i, version=1):
+    write_file(os.path.join(repodir, 'recipes-bench', 'include', 'common%d.inc' % i),
+               'HOMEPAGE = "http://example.com/common%d/v%d"\nDEPENDS += "virtual/libc"\n' % (i, version))
+
+def write_append(repodir, i):
+    write_file(os.path.join(repodir, 'recipes-bench', 'bench%d' % i, 'bench%d_%%.bbappend' % i),
+               'PACKAGECONFIG[feature] = "--enable-feature,--disable-feature,bench0"\n')
+
+def write_machine(repodir, i):
+    write_file(os.path.join(repodir, 'conf', 'machine', 'benchmachine%d.conf' % i),
+               '#@TYPE: Machine\n#@NAME: Benchmark machine %d\n#@DESCRIPTION: Machine configuration for benchmark machine %d\n' % (i, i))
+
+def generate_layer(repodir):
+    """Generate the synthetic layer as a new git repository"""
+    write_file(os.path.join(repodir, 'conf', 'layer.conf'), '\n'.join([
+        'BBPATH .= ":${LAYERDIR}"',
+        'BBFILES += "${LAYERDIR}/recipes-*/*/*.bb ${LAYERDIR}/recipes-*/*/*.bbappend"',
+        'BBFILE_COLLECTIONS += "benchmark"',
+        'BBFILE_PATTERN_benchmark = "^${LAYERDIR}/"',
+        'BBFILE_PRIORITY_benchmark = "5"',
+        'LAYERDEPENDS_benchmark = "core"',
+        'LAYERSERIES_COMPAT_benchmark = "${LAYERSERIES_CORENAMES}"',
+    ]) + '\n')
+    for i in range(NUM_INCLUDES):
+        write_include(repodir, i)
+    for i in range(NUM_RECIPES):
+        write_recipe(repodir, i)
+    for i in range(NUM_APPENDS):
+        write_append(repodir, i * (NUM_RECIPES // NUM_APPENDS))
+    for i in range(NUM_MACHINES):
+        write_machine(repodir, i)
+    run_cmd('git init -q', cwd=repodir)
+    run_cmd('git add .', cwd=repodir)
+    run_cmd('git -c user.name=Test -c user.email=test@example.com commit -q -m "Initial commit"', cwd=repodir)
+
+def check_baseline(mode, result):
+    """Record the result and check it against the baseline (if any)"""
+    results[mode] = result
+    if not os.path.exists(BASELINE_FILE):
+        return
+    with open(BASELINE_FILE, 'r') as f:
+        baseline = json.load(f).get(mode, None)
+    resultstr = ', '.join(['%s=%s' % (key, result[key]) for key in sorted(result)])
+    assert baseline is not None, '%s: no baseline for this mode in %s (results: %s)' % (mode, BASELINE_FILE, resultstr)
+    regressions = []
+    for key, tolerance in TOLERANCES.items():
+        if result.get(key) is None or baseline.get(key) is None:
+            continue
+        if result[key] > baseline[key] * (1 + tolerance):
+            regressions.append('%s %s (baseline %s)' % (key, result[key], baseline[key]))
+    assert not regressions, '%s: regressed past baseline: %s (results: %s)' % (mode, ', '.join(regressions), resultstr)
+
+def save_baseline():
+    if not OUTPUT_FILE:
+        return
+    with open(OUTPUT_FILE, 'w') as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+        f.write('\n')
+
+def run_update_script(args):
+    """Run update.py, measuring its wall time and peak RSS"""
+    start = time.time()
+    proc = subprocess.Popen([os.path.join(basepath, 'layerindex', 'update.py')] + args, cwd=basepath)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    assert status == 0, 'update.py %s failed' % ' '.join(args)
+    # ru_maxrss is in kilobytes
+    return {'queries': None, 'time': round(time.time() - start, 2), 'maxrss': rusage.ru_maxrss // 1024}
+
+def run_update_layer(args):
+    """
+    Run update_layer.py in a forked process, measuring the number of
+    queries it executes, its wall time and its peak RSS
+    """
+    from django.db import connections
+
+    def run(conn):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        import update_layer
+        start = time.time()
+        sys.argv = ['update_layer.py'] + args
+        with CaptureQueriesContext(connection) as ctx:
+            try:
+                update_layer.main()
+                ret = 0
+            except SystemExit as e:
+                ret = e.code or 0
+        conn.send({'ret': ret,
+                   'queries': len(ctx.captured_queries),
+                   'time': round(time.time() - start, 2),
+                   'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024})
+
+    # The child needs to open its own database connection
+    connections.close_all()
+    ctx = multiprocessing.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe()
+    proc = ctx.Process(target=run, args=(child_conn,))
+    proc.start()
+    result = parent_conn.recv()
+    proc.join()
+    assert result.pop('ret') == 0, 'update_layer.py %s failed' % ' '.join(args)
+    return result
+
+
+@pytest.fixture(autouse=True)
+def enable_db_access_for_all_tests(db):
+    pass
+
+@pytest.fixture
+def db_access_without_rollback_and_truncate(request, django_db_setup, django_db_blocker):
+    django_db_blocker.unblock()
+    request.addfinalizer(django_db_blocker.restore)
+
+@pytest.fixture(scope="module")
+def backup_settings(tmpdir_factory):
+    stmpdir = tmpdir_factory.mktemp('settings')
+    settingsfile = os.path.join(basepath, 'settings.py')
+    backupfile = os.path.join(stmpdir, 'settings.bak')
+    shutil.copy(settingsfile, backupfile)
+    yield settingsfile
+    shutil.copy(backupfile, settingsfile)
+
+@pytest.fixture(scope="module")
+def hack_settings(backup_settings):
+    # As in test_update.py, the update scripts need to connect to the
+    # testing database rather than whatever is in settings.py
+    from django.conf import settings
+    with open(backup_settings, 'a') as f:
+        f.write('\nDATABASES = %s\n' % settings.DATABASES)
+
+@pytest.fixture(scope="module")
+def upstream(tmpdir_factory):
+    if OUTPUT_FILE:
+        assert not os.path.abspath(OUTPUT_FILE).startswith(basepath + os.sep), 'LAYERINDEX_BENCHMARK_OUTPUT should be outside the repository'
+    repodir = str(tmpdir_factory.mktemp('benchmark').join(LAYER_NAME))
+    os.makedirs(repodir)
+    generate_layer(repodir)
+    yield repodir
+    save_baseline()
+
+@pytest.fixture(scope="module")
+def import_layer(hack_settings, upstream):
+    run_cmd("layerindex/tools/import_layer.py git://git.openembedded.org/openembedded-core -s meta openembedded-core")
+    run_cmd("layerindex/tools/import_layer.py file://%s %s" % (upstream, LAYER_NAME))
+
+@pytest.fixture()
+def repo(db_access_without_rollback_and_truncate):
+    from layerindex.models import LayerItem
+    from django.conf import settings
+    layer = LayerItem.objects.get(name=LAYER_NAME)
+    yield os.path.join(settings.LAYER_FETCH_DIR, layer.get_fetch_dir())
+
+
+def test_initial(import_layer, repo, db_access_without_rollback_and_truncate):
+    from layerindex.models import LayerBranch
+    check_baseline('initial', run_update_script(['-q', '-l', LAYER_NAME]))
+    layerbranch = LayerBranch.objects.get(layer__name=LAYER_NAME, branch__name='master')
+    assert layerbranch.recipe_set.count() == NUM_RECIPES
+    assert layerbranch.bbappend_set.count() == NUM_APPENDS
+    assert layerbranch.machine_set.count() == NUM_MACHINES
+
+def test_reload(import_layer, repo, db_access_without_rollback_and_truncate):
+    from layerindex.models import LayerBranch
+    layerbranch = LayerBranch.objects.get(layer__name=LAYER_NAME, branch__name='master')
+    recipe_ids = set(layerbranch.recipe_set.values_list('id', flat=True))
+    check_baseline('reload', run_update_layer(['-q', '-l', LAYER_NAME, '-b', 'master', '--reload']))
+    assert set(layerbranch.recipe_set.values_list('id', flat=True)) == recipe_ids
+
+def test_incremental(import_layer, upstream, repo, db_access_without_rollback_and_truncate):
+    from layerindex.models import LayerBranch
+    # Change an include file (affecting 1/NUM_INCLUDES of the recipes),
+    # upgrade one recipe, delete another, and add an append and a machine
+    write_include(upstream, 0, version=2)
+    os.remove(recipe_path(upstream, 1))
+    write_recipe(upstream, 1, version='2.0')
+    os.remove(recipe_path(upstream, NUM_RECIPES - 1))
+    write_append(upstream, NUM_RECIPES - 2)
+    write_machine(upstream, NUM_MACHINES)
+    run_cmd('git add -A', cwd=upstream)
+    run_cmd('git -c user.name=Test -c user.email=test@example.com commit -q -m "Make some changes"', cwd=upstream)
+    run_cmd('git fetch -q', cwd=repo)
+
+    check_baseline('incremental', run_update_layer(['-q', '-l', LAYER_NAME, '-b', 'master']))
+    layerbranch = LayerBranch.objects.get(layer__name=LAYER_NAME, branch__name='master')
+    assert layerbranch.recipe_set.count() == NUM_RECIPES - 1
+    assert layerbranch.recipe_set.get(pn='bench1').pv == '2.0'
+    assert layerbranch.recipe_set.get(pn='bench0').homepage == 'http://example.com/common0/v2'
+    assert layerbranch.bbappend_set.count() == NUM_APPENDS + 1
+    assert layerbranch.machine_set.count() == NUM_MACHINES + 1
+
+def test_noop(import_layer, repo, db_access_without_rollback_and_truncate):
+    check_baseline('noop', run_update_script(['-q', '-l', LAYER_NAME, '--nofetch']))